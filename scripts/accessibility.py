@@ -0,0 +1,179 @@
+import argparse
+import json
+import logging
+import os
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import shapely
+from geojson import dump
+
+from scripts.feed import FEED_PATH, load_feed, service_date
+from scripts.geometry import from_plane
+from scripts.metrics import metrics
+from scripts.service_cube import build_cube
+from scripts.spatial_index import GridIndex
+
+# Point datasets to score, one .csv or .geojson per kind of amenity (schools.csv, hospitals.geojson, population.csv)
+AMENITIES_DIRECTORY = "bmtc-data/amenities"
+ACCESSIBILITY_DIRECTORY = "bmtc-data/accessibility"
+# Stops within this many metres of a point serve it, less the further they are
+WALK_RADIUS = 500.0
+# Distance from the centre to each corner of a summary hexagon, in metres
+HEX_SIZE = 250.0
+# Points looked up at once, bounding the size of the point-to-stop pair arrays
+POINTS_PER_CHUNK = 250000
+# Column names tried, in order, for the coordinates and weight of a CSV point
+LAT_COLUMNS = ["lat", "latitude", "stop_lat", "y"]
+LON_COLUMNS = ["lon", "lng", "longitude", "stop_lon", "x"]
+WEIGHT_COLUMNS = ["weight", "population", "count"]
+
+
+def find_column(columns, candidates):
+    lower = {column.lower(): column for column in columns}
+    return next((lower[candidate] for candidate in candidates if candidate in lower), None)
+
+
+# A point dataset as (attributes, lats, lons, weights). GeoJSON features of any geometry count at their centroid;
+# points without a weight column weigh one each.
+def read_points(path):
+    if path.endswith((".geojson", ".json")):
+        with open(path, 'r', encoding='utf-8') as f:
+            features = [feature for feature in json.load(f)["features"] if feature.get("geometry")]
+        centroids = shapely.centroid(shapely.from_geojson([json.dumps(feature["geometry"]) for feature in features]))
+        lons, lats = shapely.get_x(centroids), shapely.get_y(centroids)
+        attributes = pd.DataFrame([feature.get("properties") or {} for feature in features])
+    else:
+        attributes = pd.read_csv(path)
+        lat_column = find_column(attributes.columns, LAT_COLUMNS)
+        lon_column = find_column(attributes.columns, LON_COLUMNS)
+        if lat_column is None or lon_column is None:
+            raise ValueError(f"{path} has no latitude/longitude columns ({', '.join(LAT_COLUMNS + LON_COLUMNS)})")
+        lats, lons = attributes[lat_column].to_numpy(dtype=float), attributes[lon_column].to_numpy(dtype=float)
+    weight_column = find_column(attributes.columns, WEIGHT_COLUMNS)
+    weights = (attributes[weight_column].fillna(0).to_numpy(dtype=float) if weight_column is not None
+               else np.ones(len(lats)))
+    return attributes, lats, lons, weights
+
+
+# Per point: the nearest stop and its distance, the stops within walking radius, the departures they have between
+# them, and a score weighing each stop's departures down linearly with the walk to it (0 when nothing is in reach)
+def score_points(index, stop_ids, departures, lats, lons, radius=WALK_RADIUS):
+    count = len(lats)
+    nearest = np.full(count, -1, dtype=np.int64)
+    nearest_distance = np.full(count, np.nan)
+    stops_within = np.zeros(count, dtype=np.int64)
+    total_departures = np.zeros(count)
+    scores = np.zeros(count)
+    for first in range(0, count, POINTS_PER_CHUNK):
+        chunk = slice(first, min(first + POINTS_PER_CHUNK, count))
+        points, stops, distances = index.query_radius_pairs(lats[chunk], lons[chunk], radius)
+        points += first
+        stops_within += np.bincount(points, minlength=count)
+        total_departures += np.bincount(points, weights=departures[stops], minlength=count)
+        scores += np.bincount(points, weights=departures[stops] * (1 - distances / radius), minlength=count)
+        # Nearest first within each point, then the first pair of each point
+        order = np.lexsort((distances, points))
+        firsts = order[np.unique(points[order], return_index=True)[1]]
+        nearest[points[firsts]] = stops[firsts]
+        nearest_distance[points[firsts]] = distances[firsts]
+    return pd.DataFrame({'nearest_stop_id': np.where(nearest >= 0, stop_ids[np.maximum(nearest, 0)], ""),
+                         'nearest_stop_m': np.round(nearest_distance, 1), 'stops_within': stops_within,
+                         'departures': total_departures.astype(np.int64), 'score': np.round(scores, 2)})
+
+
+# Axial coordinates of the pointy-top hexagon holding each plane point, by rounding in cube coordinates
+def hex_cells(x, y, size=HEX_SIZE):
+    q = (np.sqrt(3) / 3 * x - y / 3) / size
+    r = 2 / 3 * y / size
+    s = -q - r
+    round_q, round_r, round_s = np.round(q), np.round(r), np.round(s)
+    diff_q, diff_r, diff_s = np.abs(round_q - q), np.abs(round_r - r), np.abs(round_s - s)
+    fix_q = (diff_q > diff_r) & (diff_q > diff_s)
+    fix_r = ~fix_q & (diff_r > diff_s)
+    round_q = np.where(fix_q, -round_r - round_s, round_q)
+    round_r = np.where(fix_r, -round_q - round_s, round_r)
+    return round_q.astype(np.int64), round_r.astype(np.int64)
+
+
+def hex_polygons(q, r, origin_lat, size=HEX_SIZE):
+    centre_x = size * (np.sqrt(3) * q + np.sqrt(3) / 2 * r)
+    centre_y = size * 1.5 * r
+    angles = np.radians(60 * np.arange(7) + 30)
+    corners_x = centre_x[:, None] + size * np.cos(angles)
+    corners_y = centre_y[:, None] + size * np.sin(angles)
+    lats, lons = from_plane(corners_x / 1000, corners_y / 1000, origin_lat)
+    return shapely.polygons(np.stack([lons, lats], axis=-1))
+
+
+# Points and their scores summed up per hexagon: how many there are (and their weight), the weighted mean score
+# and departures, and the share of the weight with no stop in walking reach
+def hexbin_layer(index, lats, lons, weights, scores, size=HEX_SIZE):
+    x, y = index.project(lats, lons)
+    q, r = hex_cells(x, y, size)
+    cells = pd.DataFrame({'q': q, 'r': r, 'points': 1, 'weight': weights, 'score': scores['score'] * weights,
+                          'departures': scores['departures'] * weights,
+                          'unserved': (scores['stops_within'] == 0) * weights})
+    cells = cells.groupby(['q', 'r'], sort=False).sum().reset_index()
+    weight = cells['weight'].where(cells['weight'] > 0)
+    polygons = hex_polygons(cells['q'].to_numpy(), cells['r'].to_numpy(), index.origin_lat, size)
+    features = [{"type": "Feature", "geometry": json.loads(geometry),
+                 "properties": {"points": points, "weight": round(total, 2), "score": round(score, 2),
+                                "departures": round(departures, 1), "unserved_share": round(unserved, 3)}}
+                for geometry, points, total, score, departures, unserved in zip(
+                    shapely.to_geojson(polygons).tolist(), cells['points'].tolist(), cells['weight'].tolist(),
+                    (cells['score'] / weight).fillna(0).tolist(), (cells['departures'] / weight).fillna(0).tolist(),
+                    (cells['unserved'] / weight).fillna(0).tolist())]
+    return {"type": "FeatureCollection", "features": features}
+
+
+def score_dataset(path, index, stop_ids, departures, directory=ACCESSIBILITY_DIRECTORY, radius=WALK_RADIUS):
+    name = os.path.splitext(os.path.basename(path))[0]
+    attributes, lats, lons, weights = read_points(path)
+    scores = score_points(index, stop_ids, departures, lats, lons, radius)
+    scores.index = attributes.index
+    pd.concat([attributes, scores], axis=1).to_csv(os.path.join(directory, f"{name}.csv"), index=False)
+    with open(os.path.join(directory, f"{name}-hexbins.geojson"), 'w') as f:
+        dump(hexbin_layer(index, lats, lons, weights, scores), f)
+    metrics.count(f"{name} points", len(lats))
+    logging.info(f"Scored {len(lats)} {name} points, {int((scores['stops_within'] == 0).sum())} with no stop "
+                 f"within {radius:.0f} m")
+
+
+# Score every dataset in the amenities directory against the stops of the feed's service day
+def main(day=None, radius=WALK_RADIUS, amenities_directory=AMENITIES_DIRECTORY, feed_path=FEED_PATH):
+    paths = sorted(os.path.join(amenities_directory, name) for name in os.listdir(amenities_directory)
+                   if name.endswith((".csv", ".geojson", ".json"))) if os.path.isdir(amenities_directory) else []
+    if not paths:
+        logging.warning(f"No point datasets in {amenities_directory}, nothing to score")
+        return
+
+    feed = load_feed(feed_path)
+    stops = feed.stops
+    if 'location_type' in stops.columns:
+        stops = stops.loc[stops['location_type'].fillna(0) != 1]
+    stop_ids = stops['stop_id'].astype(str).to_numpy()
+    # Vehicle departures from each stop on the day, trips run at a headway in frequencies.txt counting once per start
+    departures = build_cube(feed, service_date(feed, day)).stop_departures().reindex(stop_ids, fill_value=0).to_numpy()
+    # Cells as wide as the walk, so every lookup only joins the 3 × 3 cells around a point
+    index = GridIndex(stops['stop_lat'].to_numpy(), stops['stop_lon'].to_numpy(), cell_size=radius)
+
+    os.makedirs(ACCESSIBILITY_DIRECTORY, exist_ok=True)
+    for path in paths:
+        with metrics.stage(os.path.basename(path)):
+            score_dataset(path, index, stop_ids, departures, ACCESSIBILITY_DIRECTORY, radius)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+    parser = argparse.ArgumentParser(description="Score points by the bus service within walking distance")
+    parser.add_argument('--date', type=lambda value: datetime.strptime(value, "%Y-%m-%d").date(),
+                        help="service date as YYYY-MM-DD (default: today, or the feed's first day of service)")
+    parser.add_argument('--amenities', default=AMENITIES_DIRECTORY, help="directory of .csv/.geojson point datasets")
+    parser.add_argument('--radius', type=float, default=WALK_RADIUS, help="walking radius in metres")
+    parser.add_argument('--feed', default=FEED_PATH)
+    args = parser.parse_args()
+    with metrics.stage("accessibility"):
+        main(args.date, args.radius, amenities_directory=args.amenities, feed_path=args.feed)
+    metrics.write()
@@ -0,0 +1,111 @@
+#!/usr/bin/python
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import socket
+import statistics
+import tempfile
+import time
+
+from scripts import mock_api, scrape
+from scripts.manifest import Manifest
+from scripts.raw_store import STORE_PATH, RawStore
+
+# Effectively unlimited rate, so only the concurrency settings are measured
+UNLIMITED_RATE = 1e9
+
+
+def wait_for_port(host, port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        with socket.socket() as sock:
+            if sock.connect_ex((host, port)) == 0:
+                return
+        time.sleep(0.1)
+    raise TimeoutError(f"Mock API did not start on {host}:{port}")
+
+
+def percentile(latencies, pct):
+    if len(latencies) < 2:
+        return latencies[0] if latencies else 0.0
+    return statistics.quantiles(latencies, n=100, method='inclusive')[pct - 1]
+
+
+# Run one full scrape against the mock API into a throwaway manifest and store
+async def run_scrape(base_url, concurrency, max_concurrency, pool_size, rate_limits):
+    with tempfile.TemporaryDirectory() as directory:
+        manifest = Manifest(os.path.join(directory, "manifest.json"))
+        with RawStore(os.path.join(directory, "raw.db")) as store:
+            async with scrape.create_fetcher(base_url, rate_limits=rate_limits, initial_concurrency=concurrency,
+                                             max_concurrency=max_concurrency, pool_size=pool_size) as fetcher:
+                start = time.monotonic()
+                await scrape.scrape(fetcher, manifest, store)
+                wall_time = time.monotonic() - start
+
+    latencies = [latency for stats in fetcher.stats.values() for latency in stats['latencies']]
+    requests = sum(stats['requests'] for stats in fetcher.stats.values())
+    return {
+        "concurrency": concurrency,
+        "max_concurrency": max_concurrency,
+        "pool_size": pool_size,
+        "requests": requests,
+        "failures": sum(stats['failures'] for stats in fetcher.stats.values()),
+        "wall_time": round(wall_time, 3),
+        "requests_per_second": round(requests / wall_time, 1) if wall_time else 0.0,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 1),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 1),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark scraper throughput against the replayed WebAPI")
+    parser.add_argument('--store', default=STORE_PATH, help="raw store to replay")
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[10, 20, 50, 100],
+                        help="initial concurrency for each run")
+    parser.add_argument('--max-concurrency', type=int, default=0,
+                        help="ceiling the adaptive limiter may grow to (default: same as --concurrency)")
+    parser.add_argument('--pool-size', type=int, default=scrape.POOL_SIZE, help="connection pool size")
+    parser.add_argument('--rate-limited', action='store_true', help="keep the production per-endpoint rate limits")
+    parser.add_argument('--latency', default='lognormal:80:0.5', help="latency distribution, see mock_api")
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--burst-every', type=float, default=0.0)
+    parser.add_argument('--burst-length', type=float, default=0.0)
+    parser.add_argument('--output', help="write the results as JSON to this path")
+    args = parser.parse_args()
+
+    host = '127.0.0.1'
+    server = multiprocessing.Process(target=mock_api.serve, daemon=True, kwargs=dict(
+        store_path=args.store, host=host, port=args.port, latency=args.latency, error_rate=args.error_rate,
+        burst_every=args.burst_every, burst_length=args.burst_length))
+    server.start()
+    try:
+        wait_for_port(host, args.port)
+        base_url = f'http://{host}:{args.port}/WebAPI/'
+        rate_limits = scrape.RATE_LIMITS if args.rate_limited else \
+            {endpoint: UNLIMITED_RATE for endpoint in scrape.RATE_LIMITS}
+
+        results = []
+        for concurrency in args.concurrency:
+            max_concurrency = max(concurrency, args.max_concurrency)
+            result = asyncio.run(run_scrape(base_url, concurrency, max_concurrency, args.pool_size, rate_limits))
+            logging.info(f"concurrency={concurrency} max={max_concurrency} pool={args.pool_size}: "
+                         f"{result['requests']} requests in {result['wall_time']}s "
+                         f"({result['requests_per_second']} req/s), p50={result['p50_ms']}ms "
+                         f"p95={result['p95_ms']}ms p99={result['p99_ms']}ms, {result['failures']} failures")
+            results.append(result)
+    finally:
+        server.terminate()
+        server.join()
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
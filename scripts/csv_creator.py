@@ -1,27 +1,86 @@
+import json
+import logging
 import os
 
 import geopandas as gpd
+import numpy as np
+import shapely
 
+from scripts.metrics import metrics
+from scripts.tiles import collect_layer
 
-def main():
-    with os.scandir("bmtc-data/geojson") as raw_directory:
+GEOJSON_DIRECTORY = "bmtc-data/geojson"
+CSV_DIRECTORY = "bmtc-data/csv"
+GEOPARQUET_DIRECTORY = "bmtc-data/geoparquet"
+FLATGEOBUF_DIRECTORY = "bmtc-data/flatgeobuf"
+
+
+# {layer name: layer} for every .geojson file, for when the layers are not already in memory
+def read_layers(directory=GEOJSON_DIRECTORY):
+    layers = {}
+    with os.scandir(directory) as raw_directory:
         for raw_item in raw_directory:
             if raw_item.name.endswith(".geojson"):
-                # Path to your GeoJSON file
-                geojson_path = 'bmtc-data/geojson/' + raw_item.name
-                # Desired output CSV file path
-                csv_path = 'bmtc-data/csv/' + raw_item.name.split(".geojson")[0] + ".csv"
+                with open(raw_item.path, 'r') as f:
+                    layers[raw_item.name.split(".geojson")[0]] = collect_layer(json.load(f)["features"])
+    return layers
+
+
+# The rows GeoDataFrame.from_features would build from the layer's features
+def layer_frame(layer):
+    geometries, properties = layer
+    rows = [{"geometry": geometry, **feature_properties}
+            for geometry, feature_properties in zip(geometries, properties)]
+    return gpd.GeoDataFrame(rows, crs="EPSG:4326")
+
+
+def list_columns(gdf):
+    return [column for column in gdf.columns if column != 'geometry' and
+            gdf[column].map(lambda value: isinstance(value, list)).any()]
+
+
+# Geometry as WKT, encoded in one call. Lists are written as the NumPy arrays gpd.read_file used to give, so the
+# CSVs read the same as they always have.
+def write_csv(gdf, path):
+    df = gdf.drop(columns='geometry')
+    for column in list_columns(gdf):
+        df[column] = [np.array(value) if isinstance(value, list) else value for value in df[column]]
+    df['geometry'] = shapely.to_wkt(gdf.geometry.values, rounding_precision=-1)
+    df.to_csv(path, index=False)
+
+
+def write_geoparquet(gdf, path):
+    gdf.to_parquet(path, index=False)
+
+
+# FlatGeobuf has no list fields, so lists go in as JSON. The packed R-tree lets readers fetch only a bounding box.
+def write_flatgeobuf(gdf, path):
+    gdf = gdf.copy()
+    for column in list_columns(gdf):
+        gdf[column] = [json.dumps(value, ensure_ascii=False) if isinstance(value, list) else value
+                       for value in gdf[column]]
+    gdf.to_file(path, driver="FlatGeobuf", engine="pyogrio", SPATIAL_INDEX="YES")
+
 
-                # Read the GeoJSON file
-                gdf = gpd.read_file(geojson_path)
+# Write each layer as CSV, GeoParquet and FlatGeobuf straight from the layers in memory
+def export_layers(layers):
+    for directory in (CSV_DIRECTORY, GEOPARQUET_DIRECTORY, FLATGEOBUF_DIRECTORY):
+        os.makedirs(directory, exist_ok=True)
+    for name, layer in layers.items():
+        with metrics.stage(name):
+            gdf = layer_frame(layer)
+            write_csv(gdf, f"{CSV_DIRECTORY}/{name}.csv")
+            write_geoparquet(gdf, f"{GEOPARQUET_DIRECTORY}/{name}.parquet")
+            write_flatgeobuf(gdf, f"{FLATGEOBUF_DIRECTORY}/{name}.fgb")
+            metrics.count("features", len(gdf))
+        logging.info(f"Exported {len(gdf)} {name} features")
 
-                # Optionally, convert the geometry to a string if you want to include it in the CSV
-                # This will convert the geometry to Well-Known Text (WKT) format
-                gdf['geometry'] = gdf['geometry'].apply(lambda x: x.wkt)
 
-                # Save the DataFrame to CSV
-                gdf.to_csv(csv_path, index=False)
+def main(layers=None):
+    export_layers(read_layers() if layers is None else layers)
 
 
 if __name__ == '__main__':
-    main()
+    with metrics.stage("exports"):
+        main()
+    metrics.write()
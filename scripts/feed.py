@@ -0,0 +1,286 @@
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import zipfile
+from collections import defaultdict
+from datetime import date, datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+from scripts.manifest import content_hash
+from scripts.trip_builder import format_time
+
+FEED_PATH = "bmtc-data/gtfs/bmtc.zip"
+FEED_CACHE_PATH = "bmtc-data/gtfs/intermediate/feed"
+# Bump whenever the way tables are parsed changes, so tables cached by older code are not reused
+FEED_VERSION = 1
+HASH_CHUNK_SIZE = 1 << 20
+
+# Numeric columns, parsed by read_csv itself so values match what gtfs_kit reads to the last digit
+FLOAT_COLUMNS = {"stop_lat", "stop_lon", "shape_pt_lat", "shape_pt_lon", "shape_dist_traveled"}
+INT_COLUMNS = {"monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday", "exception_type",
+               "route_type", "direction_id", "location_type", "wheelchair_boarding", "wheelchair_accessible",
+               "bikes_allowed", "stop_sequence", "shape_pt_sequence", "pickup_type", "drop_off_type", "timepoint",
+               "headway_secs", "exact_times", "payment_method", "transfers", "transfer_duration", "transfer_type",
+               "min_transfer_time", "is_producer", "is_operator", "is_authority"}
+# "HH:MM:SS" columns, kept as seconds since midnight with MISSING_TIME where the feed leaves them empty
+TIME_COLUMNS = {"arrival_time", "departure_time", "start_time", "end_time"}
+MISSING_TIME = -1
+WEEKDAYS = ["monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday"]
+# Everything else is text, kept as categoricals: IDs, names and dates repeat across many rows
+
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def parse_times(values):
+    categories = pd.Categorical(values)
+    seconds = np.array([MISSING_TIME if not value else
+                        sum(int(part) * unit for part, unit in zip(value.split(':'), (3600, 60, 1)))
+                        for value in categories.categories], dtype=np.int32)
+    return np.where(categories.codes >= 0, seconds[categories.codes], MISSING_TIME).astype(np.int32)
+
+
+# Seconds back to "HH:MM:SS", formatting each distinct time once; missing times become empty strings
+def format_times(seconds):
+    values, inverse = np.unique(np.asarray(seconds), return_inverse=True)
+    strings = np.array(["" if value == MISSING_TIME else format_time(int(value)) for value in values.tolist()],
+                       dtype=object)
+    return strings[inverse]
+
+
+def parse_table(f):
+    numeric = FLOAT_COLUMNS | INT_COLUMNS
+    df = pd.read_csv(f, encoding='utf-8-sig', keep_default_na=False, na_values={column: [""] for column in numeric},
+                     dtype=defaultdict(lambda: str, {column: float for column in numeric}))
+    df.columns = df.columns.str.strip()
+
+    for column in df.columns:
+        if column in FLOAT_COLUMNS:
+            continue
+        elif column in INT_COLUMNS:
+            values = df[column]
+            if values.isna().any():
+                df[column] = values.astype("Int32")
+            else:
+                df[column] = pd.to_numeric(values.astype(np.int64), downcast='integer')
+        elif column in TIME_COLUMNS:
+            df[column] = parse_times(df[column])
+        else:
+            df[column] = df[column].astype("category")
+    return df
+
+
+# A table as gtfs_kit.read_feed would have parsed it: text as objects with NaN for empty values, times as strings
+def gtfs_kit_table(df):
+    df = df.copy()
+    for column in df.columns:
+        values = df[column]
+        if column in TIME_COLUMNS:
+            strings = format_times(values)
+            df[column] = np.where(strings == "", np.nan, strings)
+        elif isinstance(values.dtype, pd.CategoricalDtype):
+            strings = values.astype(object)
+            df[column] = strings.where(strings != "", np.nan)
+        elif isinstance(values.dtype, pd.Int32Dtype):
+            df[column] = values.astype(float)
+        elif column in INT_COLUMNS:
+            df[column] = values.astype(np.int64)
+    return df
+
+
+# Guards the cache directories, which every Feed in the process shares: clearing out stale ones must not race
+# another feed's writes into its own
+_cache_lock = threading.Lock()
+
+
+# A parsed GTFS feed whose tables are read from the zip at most once per version of it, and only when first used.
+# Parsed tables are cached as Feather files next to the feed, so later runs on an unchanged feed skip parsing.
+# Stages running side by side share one Feed: each table is parsed by a single thread while the others wait for it.
+class Feed:
+    def __init__(self, path=FEED_PATH, cache_path=FEED_CACHE_PATH):
+        self.path = path
+        self.digest = content_hash(f"{FEED_VERSION}/{file_hash(path)}")
+        self.cache_path = os.path.join(cache_path, self.digest)
+        self.tables = {}
+        self._names = None
+        self._gtfs_kit = None
+        self._lock = threading.RLock()
+        self._table_locks = {}
+        self._cache_ready = False
+
+    # Tables the feed has, by name without the .txt
+    def names(self):
+        if self._names is None:
+            with zipfile.ZipFile(self.path, 'r') as z:
+                self._names = [os.path.splitext(name)[0] for name in z.namelist() if name.endswith(".txt")]
+        return self._names
+
+    def __contains__(self, name):
+        return name in self.names()
+
+    def table(self, name):
+        if name not in self.tables:
+            with self._lock:
+                lock = self._table_locks.setdefault(name, threading.Lock())
+            with lock:
+                if name not in self.tables:
+                    self.tables[name] = self.load(name)
+        return self.tables[name]
+
+    def load(self, name):
+        cached = os.path.join(self.cache_path, f"{name}.feather")
+        if os.path.exists(cached):
+            return pd.read_feather(cached)
+        with zipfile.ZipFile(self.path, 'r') as z:
+            df = parse_table(z.open(f"{name}.txt"))
+        self.save(name, df)
+        return df
+
+    def save(self, name, df):
+        with _cache_lock:
+            if not self._cache_ready:
+                # Tables cached for other versions of the feed are never read again
+                parent = os.path.dirname(self.cache_path)
+                if os.path.isdir(parent):
+                    for stale in os.listdir(parent):
+                        if stale != self.digest and all(feed.digest != stale for _, feed in _feeds.values()):
+                            shutil.rmtree(os.path.join(parent, stale), ignore_errors=True)
+                self._cache_ready = True
+            os.makedirs(self.cache_path, exist_ok=True)
+            with tempfile.NamedTemporaryFile(dir=self.cache_path, prefix=f"{name}.", suffix=".feather.tmp",
+                                             delete=False) as tmp:
+                tmp_path = tmp.name
+            try:
+                df.to_feather(tmp_path)
+                os.replace(tmp_path, os.path.join(self.cache_path, f"{name}.feather"))
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+        logging.info(f"Cached {len(df)} rows of {name} in {self.cache_path}")
+
+    @property
+    def agency(self):
+        return self.table("agency")
+
+    @property
+    def calendar(self):
+        return self.table("calendar")
+
+    @property
+    def stops(self):
+        return self.table("stops")
+
+    @property
+    def routes(self):
+        return self.table("routes")
+
+    @property
+    def trips(self):
+        return self.table("trips")
+
+    @property
+    def stop_times(self):
+        return self.table("stop_times")
+
+    @property
+    def shapes(self):
+        return self.table("shapes")
+
+    # The same feed as a gtfs_kit.Feed, for its GeoJSON helpers, built from the cached tables instead of the zip
+    def gtfs_kit(self):
+        with self._lock:
+            if self._gtfs_kit is None:
+                # gtfs_kit pulls in geopandas, which would make importing this module anything but free
+                import gtfs_kit
+                known = set(gtfs_kit.constants.GTFS_REF["table"])
+                tables = {name: gtfs_kit_table(self.table(name)) for name in self.names() if name in known}
+                self._gtfs_kit = gtfs_kit.Feed(dist_units='km',
+                                               **{name: df for name, df in tables.items() if len(df)})
+        return self._gtfs_kit
+
+
+# {path: ((mtime, size), Feed)}: the feed last loaded from each path, and the file's stat when it was
+_feeds = {}
+_feeds_lock = threading.Lock()
+
+
+# The feed at path, shared by every caller in this process until the file changes. The file is only hashed again
+# when its modification time or size changes, and a new version replaces the one loaded before it.
+def load_feed(path=FEED_PATH):
+    stat = os.stat(path)
+    version = (stat.st_mtime_ns, stat.st_size)
+    with _feeds_lock:
+        loaded = _feeds.get(path)
+        if loaded is None or loaded[0] != version:
+            feed = Feed(path)
+            if loaded is not None and loaded[1].digest == feed.digest:
+                feed = loaded[1]
+            _feeds[path] = (version, feed)
+        return _feeds[path][1]
+
+
+# IDs of the services running on a date: those calendar.txt has on that weekday within their date range, plus the
+# services calendar_dates.txt adds on the day, less those it removes
+def service_ids(feed, day):
+    stamp = day.strftime("%Y%m%d")
+    services = set()
+    if "calendar" in feed:
+        calendar = feed.calendar
+        running = ((calendar[WEEKDAYS[day.weekday()]] == 1) & (calendar['start_date'].astype(str) <= stamp) &
+                   (calendar['end_date'].astype(str) >= stamp))
+        services = set(calendar.loc[running, 'service_id'].astype(str))
+    if "calendar_dates" in feed:
+        exceptions = feed.table("calendar_dates")
+        exceptions = exceptions.loc[exceptions['date'].astype(str) == stamp]
+        services |= set(exceptions.loc[exceptions['exception_type'] == 1, 'service_id'].astype(str))
+        services -= set(exceptions.loc[exceptions['exception_type'] == 2, 'service_id'].astype(str))
+    return services
+
+
+# {template trip_id: start times} from frequencies.txt, a trip starting every headway from start_time until before
+# end_time. Empty when the feed has no frequencies.
+def frequency_starts(feed):
+    if "frequencies" not in feed:
+        return {}
+    starts = {}
+    frequencies = feed.table("frequencies")
+    for trip_id, start_time, end_time, headway in zip(frequencies['trip_id'].astype(str), frequencies['start_time'],
+                                                      frequencies['end_time'], frequencies['headway_secs']):
+        if headway > 0:
+            starts.setdefault(trip_id, []).append(np.arange(start_time, end_time, headway))
+    return {trip_id: np.concatenate(runs) for trip_id, runs in starts.items()}
+
+
+# How many times each trip runs on a day it runs: once, or once per start time when it is a frequencies.txt template
+def trip_runs(feed, trip_ids):
+    starts = frequency_starts(feed)
+    return np.array([len(starts[trip_id]) if trip_id in starts else 1 for trip_id in trip_ids], dtype=np.int64)
+
+
+# The date to describe the feed by: today when anything runs today, otherwise the first day of the feed with service
+def service_date(feed, day=None):
+    day = day or date.today()
+    if service_ids(feed, day):
+        return day
+    stamps = []
+    if "calendar" in feed:
+        stamps += feed.calendar['start_date'].astype(str).tolist()
+    if "calendar_dates" in feed:
+        stamps += feed.table("calendar_dates")['date'].astype(str).tolist()
+    if not stamps:
+        return day
+    first = datetime.strptime(min(stamps), "%Y%m%d").date()
+    for offset in range(len(WEEKDAYS)):
+        if service_ids(feed, first + timedelta(days=offset)):
+            return first + timedelta(days=offset)
+    return first
@@ -0,0 +1,126 @@
+import asyncio
+import logging
+import time
+from collections import defaultdict
+
+import aiohttp
+
+# Status codes worth retrying, same set the old urllib3 Retry policy used
+RETRY_STATUSES = {500, 502, 503, 504}
+
+
+# Token bucket limiting the request rate of a single endpoint
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+# Concurrency limit that grows additively while latency is healthy and halves on 5xx/timeouts
+class AdaptiveLimiter:
+    def __init__(self, initial=20, minimum=4, maximum=100, target_latency=2.0, cooldown=1.0):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target_latency = target_latency
+        self.cooldown = cooldown
+        self.in_flight = 0
+        self.last_backoff = 0.0
+        self.condition = asyncio.Condition()
+
+    async def acquire(self):
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+
+    async def release(self, latency=None, failed=False):
+        async with self.condition:
+            self.in_flight -= 1
+            now = time.monotonic()
+            if failed:
+                # Back off at most once per cooldown so a burst of errors doesn't collapse the limit
+                if now - self.last_backoff > self.cooldown:
+                    self.limit = max(self.minimum, self.limit / 2)
+                    self.last_backoff = now
+                    logging.debug(f"Backing off, concurrency limit is now {int(self.limit)}")
+            elif latency is not None and latency < self.target_latency:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self.condition.notify_all()
+
+
+# Asyncio client for the Namma BMTC WebAPI with per-endpoint rate limits and adaptive concurrency
+class Fetcher:
+    def __init__(self, base_url, headers, rate_limits=None, default_rate=50.0, initial_concurrency=20,
+                 max_concurrency=100, pool_size=100, timeout=30, retries=5, backoff_factor=0.1):
+        self.base_url = base_url
+        self.headers = headers
+        self.rate_limits = rate_limits or {}
+        self.default_rate = default_rate
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.limiter = AdaptiveLimiter(initial=initial_concurrency, maximum=max_concurrency)
+        self.buckets = {}
+        self.session = None
+        # Per-endpoint request counts, bytes and latencies, read by the benchmark and the metrics report
+        self.stats = defaultdict(lambda: {'requests': 0, 'failures': 0, 'retries': 0, 'bytes': 0, 'latencies': []})
+
+    async def __aenter__(self):
+        connector = aiohttp.TCPConnector(limit=self.pool_size)
+        self.session = aiohttp.ClientSession(connector=connector, headers=self.headers,
+                                             timeout=aiohttp.ClientTimeout(total=self.timeout))
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.session.close()
+
+    def bucket(self, endpoint):
+        if endpoint not in self.buckets:
+            self.buckets[endpoint] = TokenBucket(self.rate_limits.get(endpoint, self.default_rate))
+        return self.buckets[endpoint]
+
+    # POST to an endpoint and return (status, raw body bytes), retrying 5xx responses and timeouts
+    async def post(self, endpoint, data=None):
+        url = f'{self.base_url}{endpoint}'
+        for attempt in range(self.retries + 1):
+            await self.bucket(endpoint).acquire()
+            await self.limiter.acquire()
+            start = time.monotonic()
+            failed = True
+            body = b""
+            try:
+                async with self.session.post(url, data=data) as response:
+                    body = await response.read()
+                    failed = response.status in RETRY_STATUSES
+                    if not failed or attempt == self.retries:
+                        return response.status, body
+                    logging.debug(f"{endpoint} returned {response.status}, retrying")
+            except (asyncio.TimeoutError, aiohttp.ClientError):
+                if attempt == self.retries:
+                    raise
+                logging.debug(f"{endpoint} request failed, retrying")
+            finally:
+                latency = time.monotonic() - start
+                stats = self.stats[endpoint]
+                stats['requests'] += 1
+                stats['failures'] += failed
+                stats['retries'] += attempt > 0
+                stats['bytes'] += len(body)
+                stats['latencies'].append(latency)
+                await self.limiter.release(latency, failed)
+            await asyncio.sleep(self.backoff_factor * (2 ** attempt))
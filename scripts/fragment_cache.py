@@ -0,0 +1,67 @@
+import json
+import logging
+import pickle
+import sqlite3
+import zlib
+
+from scripts.manifest import content_hash
+from scripts.raw_store import LOOKUP_CHUNK_SIZE
+
+FRAGMENTS_PATH = "bmtc-data/gtfs/intermediate/fragments.db"
+# Bump whenever trip_builder changes what a fragment contains, so fragments built by older code are not reused
+FRAGMENT_VERSION = 3
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS fragments (
+    route TEXT PRIMARY KEY,
+    hash TEXT NOT NULL,
+    body BLOB NOT NULL
+);
+"""
+
+
+# Hash of everything a route's fragment is built from: its stop lists, route lines and timetables
+def task_hash(task):
+    return content_hash(json.dumps([FRAGMENT_VERSION, task], sort_keys=True))
+
+
+# Compiled trip fragments of every route from the last build, keyed by the hash of the inputs they were built from
+class FragmentCache:
+    def __init__(self, path=FRAGMENTS_PATH):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    # Return {route: fragment} for the routes whose cached fragment was built from the given input hash
+    def lookup(self, hashes):
+        routes = list(hashes)
+        fragments = {}
+        for start in range(0, len(routes), LOOKUP_CHUNK_SIZE):
+            chunk = routes[start:start + LOOKUP_CHUNK_SIZE]
+            query = f"SELECT route, hash, body FROM fragments WHERE route IN ({', '.join('?' * len(chunk))})"
+            for route, digest, body in self.connection.execute(query, chunk):
+                if digest == hashes[route]:
+                    fragments[route] = pickle.loads(zlib.decompress(body))
+        return fragments
+
+    # Store freshly built fragments and forget routes that are no longer in the feed
+    def update(self, fragments, hashes):
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO fragments (route, hash, body) VALUES (?, ?, ?)",
+                [(route, hashes[route], zlib.compress(pickle.dumps(fragment, protocol=pickle.HIGHEST_PROTOCOL)))
+                 for route, fragment in fragments.items()])
+            existing = [row[0] for row in self.connection.execute("SELECT route FROM fragments")]
+            stale = [(route,) for route in existing if route not in hashes]
+            self.connection.executemany("DELETE FROM fragments WHERE route = ?", stale)
+        if stale:
+            logging.info(f"Dropped {len(stale)} stale route fragments from {self.path}")
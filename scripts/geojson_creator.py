@@ -1,133 +1,202 @@
 import json
 import logging
+import os
 import traceback
-import zipfile
 
 import gtfs_kit
-import pandas as pd
-from geojson import dump
 
-path = 'bmtc-data/gtfs/bmtc.zip'
+from scripts.feed import FEED_PATH, load_feed, service_date
+from scripts.metrics import metrics
+from scripts.redundancy import dump_redundancy
+from scripts.segment_frequency import dump_segments
+from scripts.service_cube import CUBE_PATH, FREQUENCY_PROPERTIES, build_cube
+from scripts.tiles import write_layer, write_tiles
 
-with zipfile.ZipFile(path, 'r') as z:
-    trips = pd.read_csv(z.open("trips.txt"), na_filter=False)
-    stop_times = pd.read_csv(z.open("stop_times.txt"), na_filter=False)
-    stops = pd.read_csv(z.open("stops.txt"), na_filter=False)
-    routes = pd.read_csv(z.open("routes.txt"), na_filter=False)
+path = FEED_PATH
+ROUTES_PATH = "bmtc-data/geojson/routes.geojson"
+STOPS_PATH = "bmtc-data/geojson/stops.geojson"
+AGGREGATED_PATH = "bmtc-data/geojson/aggregated.geojson"
 
 
-def dump_routes():
-    feed = gtfs_kit.read_feed(path, dist_units='km')
-    geojson = gtfs_kit.routes.routes_to_geojson(feed, split_directions=True)
+# Row positions of each group, in file order, so per-feature lookups don't scan whole tables
+def group_positions(df, columns):
+    return df.groupby(columns, sort=False, observed=True).indices
 
-    for i in range(len(geojson["features"])):
+
+# First value of a column for each key, the row a .loc[...].iloc[0] lookup would return
+def first_values(df, key, column):
+    first_rows = df.drop_duplicates(key)
+    return dict(zip(first_rows[key].to_list(), first_rows[column].to_list()))
+
+
+# Route direction features, one at a time, from gtfs_kit's route geometries
+def route_features(feed, cube):
+    geometries = gtfs_kit.routes.geometrize_routes(feed.gtfs_kit(), split_directions=True)
+
+    trips, stop_times = feed.trips, feed.stop_times
+    trips_by_route = group_positions(trips, ['route_id', 'direction_id'])
+    trip_ids = trips['trip_id'].to_list()
+    stop_times_by_trip = group_positions(stop_times, 'trip_id')
+    stop_time_stops = stop_times['stop_id'].to_list()
+    stop_names = first_values(feed.stops, 'stop_id', 'stop_name')
+
+    for feature in geometries.iterfeatures(na='null', drop_id=True):
         try:
-            properties = geojson["features"][i]["properties"]
+            properties = feature["properties"]
 
             route_id = properties["route_id"]
             route_name = properties["route_short_name"]
 
             direction_id = properties["direction_id"]
-            trip_df = trips.loc[trips['route_id'] == route_id].loc[trips['direction_id'] == direction_id]
-            trip_count = len(trip_df)
-            trip_list = []
-            for trip in trip_df['trip_id']:
-                trip_time = stop_times.loc[stop_times['trip_id'] == trip]['arrival_time'].iloc[0]
-                trip_list.append(trip_time)
-            trip_list.sort()
-
-            trip = trip_df['trip_id'].iloc[0]
-            stop_df = stop_times.loc[stop_times['trip_id'] == trip]['stop_id']
-            stop_count = len(stop_df)
-            stop_list = []
-            for stop in stop_df:
-                stop_name = stops.loc[stops['stop_id'] == stop]['stop_name'].iloc[0]
-                stop_list.append(stop_name)
+            route_trips = [trip_ids[position] for position in trips_by_route[(route_id, direction_id)]]
+            trip_count = len(route_trips)
+            frequency = cube.frequency_properties(*cube.direction(route_id, direction_id))
+
+            trip = route_trips[0]
+            stop_list = [stop_names[stop_time_stops[position]] for position in stop_times_by_trip[trip]]
+            stop_count = len(stop_list)
 
             properties = {"name": route_name, "full_name": "{} → {}".format(stop_list[0], stop_list[-1]),
-                          "trip_count": trip_count, "trip_list": trip_list, "stop_count": stop_count,
+                          "trip_count": trip_count, **frequency, "stop_count": stop_count,
                           "stop_list": stop_list, "id": route_id, "direction_id": direction_id}
 
-            geojson["features"][i]["properties"] = properties
+            feature["properties"] = properties
         except Exception:
             logging.error("Failed to process {}".format(route_name))
             logging.error(traceback.format_exc())
+        yield feature
 
-    with open('bmtc-data/geojson/routes.geojson', 'w') as f:
-        dump(geojson, f)
 
+# Stop features, one at a time, from gtfs_kit's stop geometries
+def stop_features(feed, cube):
+    # Parent stations have no trips of their own, they are what aggregated.geojson is built from
+    platforms = feed.gtfs_kit().stops
+    if 'location_type' in platforms.columns:
+        platforms = platforms.loc[platforms['location_type'].fillna(0) != 1]
+    geometries = gtfs_kit.stops.geometrize_stops(feed.gtfs_kit(), stop_ids=platforms['stop_id'])
 
-def dump_stops():
-    feed = gtfs_kit.read_feed(path, dist_units='km')
-    geojson = gtfs_kit.stops.stops_to_geojson(feed)
+    stop_times = feed.stop_times
+    stop_times_by_stop = group_positions(stop_times, 'stop_id')
+    stop_time_trips = stop_times['trip_id'].to_list()
+    trip_routes = first_values(feed.trips, 'trip_id', 'route_id')
+    route_names = first_values(feed.routes, 'route_id', 'route_short_name')
 
-    for i in range(len(geojson["features"])):
+    for feature in geometries.iterfeatures(na='null', drop_id=True):
         try:
-            properties = geojson["features"][i]["properties"]
+            properties = feature["properties"]
 
             stop_id = properties["stop_id"]
             stop_name = properties["stop_name"]
 
-            trip_df = stop_times.loc[stop_times['stop_id'] == stop_id]
-            trip_count = len(trip_df)
-            trip_list = trip_df['arrival_time'].to_list()
-            trip_list.sort()
-
-            route_ids = []
-            for trip in trip_df['trip_id']:
-                route_ids.append(trips.loc[trips['trip_id'] == trip]['route_id'].iloc[0])
-            route_ids = list(set(route_ids))
-            route_list = []
-            route_count = 0
-            for route_id in route_ids:
-                route_count = route_count + 1
-                route_list.append(routes.loc[routes['route_id'] == route_id]['route_short_name'].iloc[0])
-
-            properties = {"name": stop_name, "trip_count": trip_count, "trip_list": trip_list,
+            positions = stop_times_by_stop.get(stop_id, [])
+            trip_count = len(positions)
+            frequency = cube.frequency_properties(*cube.stop(stop_id))
+
+            route_ids = list(set([trip_routes[stop_time_trips[position]] for position in positions]))
+            route_list = [route_names[route_id] for route_id in route_ids]
+            route_count = len(route_list)
+
+            properties = {"name": stop_name, "trip_count": trip_count, **frequency,
                           "route_count": route_count, "route_list": route_list, "id": stop_id}
 
-            geojson["features"][i]["properties"] = properties
+            feature["properties"] = properties
         except Exception as err:
             logging.error("Failed to process {}".format(stop_name))
             logging.error(traceback.format_exc())
-
-    with open('bmtc-data/geojson/stops.geojson', 'w') as f:
-        dump(geojson, f)
-
-
-def aggregate_stops():
-    with open("bmtc-data/geojson/stops.geojson", 'r') as f:
-        geojson_data = json.load(f)
-
-    stops = {}
+        yield feature
+
+
+# Stop features as written to the .ndjson next to the stops layer, read back one line at a time
+def read_stop_features(stops_path=STOPS_PATH):
+    with open(f"{os.path.splitext(stops_path)[0]}.ndjson", 'r', encoding='utf-8') as f:
+        for line in f:
+            yield json.loads(line)
+
+
+# Merge the stops of each parent station into one feature at the station, or stops sharing a name when the feed
+# has no parent stations. Their frequency properties come from the summed service of all the merged stops, so the
+# merged features are only yielded once every stop has been read.
+def aggregated_features(feed, cube, stops_path=STOPS_PATH):
+    stops = feed.stops
+    stations = {}
+    parent_ids = {}
+    if 'parent_station' in stops.columns:
+        for stop in stops.astype({'stop_id': str, 'parent_station': str}).itertuples():
+            if stop.parent_station:
+                parent_ids[stop.stop_id] = stop.parent_station
+            elif str(stop.location_type) == '1':
+                stations[stop.stop_id] = stop
+
+    aggregated_stops = {}
+    members = {}
     features = []
-    for feature in geojson_data["features"]:
-        name = feature["properties"]["name"]
-        if name in stops:
-            stops[name]["trip_count"] = stops[name]["trip_count"] + feature["properties"]["trip_count"]
-            stops[name]["route_count"] = stops[name]["route_count"] + feature["properties"]["route_count"]
-            stops[name]["trip_list"] = stops[name]["trip_list"] + feature["properties"]["trip_list"]
-            stops[name]["route_list"] = stops[name]["route_list"] + feature["properties"]["route_list"]
+    for feature in read_stop_features(stops_path):
+        if stations:
+            key = parent_ids.get(str(feature["properties"]["id"]), str(feature["properties"]["id"]))
+        else:
+            key = feature["properties"]["name"]
+
+        if key in aggregated_stops:
+            stop = aggregated_stops[key]
+            members[key].append(str(feature["properties"]["id"]))
+            stop["trip_count"] = stop["trip_count"] + feature["properties"]["trip_count"]
+            if stations:
+                stop["route_list"] = stop["route_list"] + [route for route in feature["properties"]["route_list"]
+                                                           if route not in stop["route_list"]]
+                stop["route_count"] = len(stop["route_list"])
+            else:
+                stop["route_count"] = stop["route_count"] + feature["properties"]["route_count"]
+                stop["route_list"] = stop["route_list"] + feature["properties"]["route_list"]
         else:
-            stops[name] = {"name": name, "trip_count": feature["properties"]["trip_count"],
-                           "trip_list": feature["properties"]["trip_list"],
-                           "route_count": feature["properties"]["route_count"],
-                           "route_list": feature["properties"]["route_list"]}
+            members[key] = [str(feature["properties"]["id"])]
+            aggregated_stops[key] = {"name": feature["properties"]["name"],
+                                     "trip_count": feature["properties"]["trip_count"],
+                                     **{name: feature["properties"][name] for name in FREQUENCY_PROPERTIES},
+                                     "route_count": feature["properties"]["route_count"],
+                                     "route_list": feature["properties"]["route_list"]}
+            if stations:
+                aggregated_stops[key]["id"] = key
+            if key in stations:
+                aggregated_stops[key]["name"] = stations[key].stop_name
+                feature["geometry"] = {"type": "Point", "coordinates": [float(stations[key].stop_lon),
+                                                                        float(stations[key].stop_lat)]}
             features.append(feature)
-            features[-1]["properties"] = stops[name]
+            features[-1]["properties"] = aggregated_stops[key]
 
-    aggregated = geojson_data
-    aggregated["features"] = features
+    for key, stop_ids in members.items():
+        if len(stop_ids) > 1:
+            aggregated_stops[key].update(cube.frequency_properties(*cube.stop(stop_ids)))
 
-    with open('bmtc-data/geojson/aggregated.geojson', 'w') as f:
-        dump(aggregated, f)
+    yield from features
 
 
+# Each layer is written as GeoJSON and newline-delimited GeoJSON as its features are built, and kept only as the
+# geometries and properties the vector tiles and the exports need
 def main():
-    dump_stops()
-    dump_routes()
-    aggregate_stops()
+    feed = load_feed(path)
+    with metrics.stage("cube"):
+        cube = build_cube(feed, service_date(feed))
+        cube.save(CUBE_PATH)
+    with metrics.stage("stops"):
+        stops = write_layer(stop_features(feed, cube), STOPS_PATH)
+    with metrics.stage("routes"):
+        routes = write_layer(route_features(feed, cube), ROUTES_PATH)
+    with metrics.stage("aggregated"):
+        aggregated = write_layer(aggregated_features(feed, cube), AGGREGATED_PATH)
+    with metrics.stage("segments"):
+        segments = dump_segments(feed)
+    with metrics.stage("redundancy"):
+        redundancy = dump_redundancy(feed)
+    layers = {"routes": routes, "aggregated": aggregated, "stops": stops, "segments": segments,
+              "redundancy": redundancy}
+    for name, (_, properties) in layers.items():
+        metrics.count(f"{name} features", len(properties))
+    with metrics.stage("tiles"):
+        write_tiles(layers)
+    return layers
 
 
 if __name__ == "__main__":
-    main()
+    with metrics.stage("geojson"):
+        main()
+    metrics.write()
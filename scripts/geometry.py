@@ -0,0 +1,98 @@
+import numpy as np
+
+EARTH_RADIUS_KM = 6371.0088
+# A stop this close to two passes of a shape is snapped to the earlier one
+SNAP_TOLERANCE_KM = 0.03
+
+
+# Equirectangular projection to kilometres around a reference latitude, accurate enough at city scale
+def to_plane(lats, lons, origin_lat=None):
+    lats = np.asarray(lats, dtype=float)
+    lons = np.asarray(lons, dtype=float)
+    origin_lat = np.mean(lats) if origin_lat is None else origin_lat
+    x = np.radians(lons) * np.cos(np.radians(origin_lat)) * EARTH_RADIUS_KM
+    y = np.radians(lats) * EARTH_RADIUS_KM
+    return x, y
+
+
+# Back from the plane to latitudes and longitudes, for the same reference latitude
+def from_plane(x, y, origin_lat):
+    lats = np.degrees(np.asarray(y, dtype=float) / EARTH_RADIUS_KM)
+    lons = np.degrees(np.asarray(x, dtype=float) / (np.cos(np.radians(origin_lat)) * EARTH_RADIUS_KM))
+    return lats, lons
+
+
+def path_lengths(x, y):
+    return np.concatenate([[0.0], np.cumsum(np.hypot(np.diff(x), np.diff(y)))])
+
+
+# Distance travelled along a polyline at each of its points, in kilometres from the first point
+def cumulative_distances(lats, lons):
+    return path_lengths(*to_plane(lats, lons))
+
+
+# Distance along a shape of each point, snapped in order: each point onto the nearest part of the shape at or past
+# the previous one, so stops never run backwards and the end of a loop is not mistaken for its start. Where the
+# shape passes a point more than once (a road driven out and back), the first pass within tolerance_km of the
+# nearest one is taken.
+def project_onto_shape(shape_lats, shape_lons, point_lats, point_lons, tolerance_km=SNAP_TOLERANCE_KM):
+    origin_lat = np.mean(np.asarray(shape_lats, dtype=float))
+    shape_x, shape_y = to_plane(shape_lats, shape_lons, origin_lat)
+    point_x, point_y = to_plane(point_lats, point_lons, origin_lat)
+    distances = path_lengths(shape_x, shape_y)
+    if len(shape_x) < 2 or len(point_x) == 0:
+        return np.zeros(len(point_x))
+
+    start_x, start_y = shape_x[:-1], shape_y[:-1]
+    delta_x, delta_y = np.diff(shape_x), np.diff(shape_y)
+    lengths_squared = delta_x ** 2 + delta_y ** 2
+    projected = np.empty(len(point_x))
+    segment, fraction = 0, 0.0
+    for point in range(len(point_x)):
+        # Position of the point's projection along each segment from the previous point's on, clamped to the
+        # segment and, on the previous point's segment, to past where it was
+        with np.errstate(invalid='ignore', divide='ignore'):
+            t = (((point_x[point] - start_x[segment:]) * delta_x[segment:] +
+                  (point_y[point] - start_y[segment:]) * delta_y[segment:]) / lengths_squared[segment:])
+        t = np.clip(np.nan_to_num(t), 0.0, 1.0)
+        t[0] = max(t[0], fraction)
+        offsets = np.hypot(start_x[segment:] + t * delta_x[segment:] - point_x[point],
+                           start_y[segment:] + t * delta_y[segment:] - point_y[point])
+        nearest = int(np.argmax(offsets <= offsets.min() + tolerance_km))
+        segment, fraction = segment + nearest, t[nearest]
+        projected[point] = distances[segment] + fraction * np.sqrt(lengths_squared[segment])
+    return projected
+
+
+# Douglas–Peucker simplification on the plane, returns a mask of the points to keep. Tolerance is in kilometres.
+def simplify_mask(x, y, tolerance):
+    keep = np.zeros(len(x), dtype=bool)
+    if len(x) == 0:
+        return keep
+    keep[[0, -1]] = True
+    stack = [(0, len(x) - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        delta_x, delta_y = x[last] - x[first], y[last] - y[first]
+        offset_x, offset_y = x[first + 1:last] - x[first], y[first + 1:last] - y[first]
+        length = np.hypot(delta_x, delta_y)
+        # A segment that closes a loop has no direction, so fall back to the distance from its end point
+        if length == 0:
+            distances = np.hypot(offset_x, offset_y)
+        else:
+            distances = np.abs(offset_x * delta_y - offset_y * delta_x) / length
+        farthest = int(np.argmax(distances))
+        if distances[farthest] > tolerance:
+            middle = first + 1 + farthest
+            keep[middle] = True
+            stack.extend([(first, middle), (middle, last)])
+    return keep
+
+
+def simplify(lats, lons, tolerance_m):
+    lats = np.asarray(lats, dtype=float)
+    lons = np.asarray(lons, dtype=float)
+    mask = simplify_mask(*to_plane(lats, lons), tolerance_m / 1000)
+    return lats[mask], lons[mask]
@@ -1,13 +1,22 @@
-import datetime
-import json
+import argparse
 import logging
 import os
-import shutil
 import traceback
 import zipfile
 
+import numpy as np
 import transitfeed
 
+from scripts import gtfs_columnar, trip_builder
+from scripts.fragment_cache import FragmentCache
+from scripts.geometry import cumulative_distances
+from scripts.gtfs_columnar import AGENCY, GTFS_PATH, table_length
+from scripts.metrics import metrics
+from scripts.raw_store import RawStore
+from scripts.shapes import SHAPE_TOLERANCE, prepare_shapes, route_shapes
+from scripts.stop_clusters import CLUSTER_RADIUS, NAME_SIMILARITY, ClusterPolicy, parent_stations
+from scripts.timetables import group_timetables, service_dates, service_id, weekly_patterns
+
 # Setup logging configuration
 logging.basicConfig(
     level=logging.INFO,
@@ -18,48 +27,52 @@ logging.basicConfig(
     ]
 )
 
+# "transitfeed" builds and validates a transitfeed.Schedule, "columnar" streams the tables straight to the zip
+ENGINES = ["transitfeed", "columnar"]
+
 schedule = transitfeed.Schedule()
 
 
 def add_agency():
-    schedule.AddAgency("Bengaluru Metropolitan Transport Corporation",
-                       "https://mybmtc.karnataka.gov.in/english", "Asia/Kolkata", agency_id=1)
+    schedule.AddAgency(AGENCY["agency_name"], AGENCY["agency_url"], AGENCY["agency_timezone"],
+                       agency_id=AGENCY["agency_id"])
+
 
+# Add one service period per distinct weekly pattern, with service IDs like "1111100" (Monday to Sunday)
+def add_service_periods(weekly_timetables):
+    service_periods = {}
+    start_date, end_date = service_dates()
 
-def add_service_period():
-    service_period = schedule.GetDefaultServicePeriod()
-    start_date = datetime.datetime.now() + datetime.timedelta(days=1)
-    end_date = datetime.datetime.now() + datetime.timedelta(days=7)
-    service_period.SetStartDate(start_date.strftime("%Y%m%d"))
-    service_period.SetEndDate(end_date.strftime("%Y%m%d"))
-    service_period.SetWeekdayService(True)
-    service_period.SetDayOfWeekHasService(5, True)  # Saturday
-    service_period.SetDayOfWeekHasService(6, True)  # Sunday
+    for days in weekly_patterns(weekly_timetables):
+        service_period = transitfeed.ServicePeriod(service_id(days))
+        service_period.SetStartDate(start_date)
+        service_period.SetEndDate(end_date)
+        for day_index in days:
+            service_period.SetDayOfWeekHasService(day_index, True)
+        schedule.AddServicePeriodObject(service_period)
+        service_periods[days] = service_period
 
+    logging.info(f"Added {len(service_periods)} service periods")
+    return service_periods
 
-def process_json_files(directory, process_function):
+
+def process_responses(responses, process_function):
     results = {"success": [], "failure": []}
-    for filename in os.listdir(directory):
-        if filename.endswith('.json'):
-            file_path = os.path.join(directory, filename)
-            # Check if file is not empty
-            if os.path.getsize(file_path) > 0:
-                try:
-                    with open(file_path, 'r') as file:
-                        data = json.load(file)
-                        process_function(file_path, data, results)
-                except Exception:
-                    logging.info(f"Failed to process {file_path}")
-                    logging.error(traceback.format_exc())
-                    results["failure"].append(file_path.replace(".json", ""))
+    for key, data in responses.items():
+        try:
+            process_function(key, data, results)
+        except Exception:
+            logging.info(f"Failed to process {key}")
+            logging.error(traceback.format_exc())
+            results["failure"].append(key)
     return results
 
 
-def add_stops():
+# Platforms from every stop list, then a parent station for each cluster of them when a ClusterPolicy is given
+def add_stops(stop_lists, clusters=None):
     stops = {}
-    directory = 'bmtc-data/raw/stops/'
 
-    def process_stop_file(file_path, data, results):
+    def process_stop_list(route, data, results):
         for stop in (data.get("up", {}).get("data", []) + data.get("down", {}).get("data", [])):
             if stop["stationid"] not in stops:
                 stops[stop["stationid"]] = schedule.AddStop(
@@ -68,19 +81,33 @@ def add_stops():
                     name=stop["stationname"],
                     stop_id=str(stop["stationid"])
                 )
-        results["success"].append(file_path.replace(".json", ""))
+        results["success"].append(route)
 
-    results = process_json_files(directory, process_stop_file)
+    results = process_responses(stop_lists, process_stop_list)
     logging.info(f"Added {len(stops)} stops ({len(results['failure'])} errors)")
+
+    if clusters is not None:
+        platforms = list(stops.values())
+        stations, parent_ids = parent_stations([stop.stop_id for stop in platforms],
+                                               [stop.stop_name for stop in platforms],
+                                               [float(stop.stop_lat) for stop in platforms],
+                                               [float(stop.stop_lon) for stop in platforms],
+                                               clusters.radius, clusters.name_similarity)
+        for station in stations:
+            station_obj = transitfeed.Stop(lat=station["stop_lat"], lng=station["stop_lon"],
+                                           name=station["stop_name"], stop_id=station["stop_id"])
+            station_obj.location_type = 1
+            schedule.AddStopObject(station_obj)
+        for stop in platforms:
+            if stop.stop_id in parent_ids:
+                stop.parent_station = parent_ids[stop.stop_id]
+        logging.info(f"Added {len(stations)} parent stations for {len(parent_ids)} stops")
     return stops
 
 
-def add_routes():
+def add_routes(store):
     routes = {}
-    json_file = 'bmtc-data/raw/routes.json'
-
-    with open(json_file, 'r') as file:
-        routes_json = json.load(file)
+    routes_json = store.get('GetAllRouteList', 'all')
 
     for route in routes_json["data"]:
         try:
@@ -102,97 +129,68 @@ def add_routes():
     return routes
 
 
-def add_shapes():
-    shapes = {}
-    directory = 'bmtc-data/raw/routelines/'
-
-    def process_shape_file(file_path, data, results):
-        if data.get("data"):
-            shape_id = os.path.basename(file_path).replace(".json", "")
-            shapes[shape_id] = transitfeed.Shape(shape_id)
-            for point in data["data"]:
-                shapes[shape_id].AddPoint(lat=point["latitude"], lon=point["longitude"])
-            schedule.AddShapeObject(shapes[shape_id])
-            results["success"].append(file_path.replace(".json", ""))
-
-    results = process_json_files(directory, process_shape_file)
-    logging.info(f"Added {len(shapes)} shapes ({len(results['failure'])} errors)")
-    return shapes
-
-
-def add_trips(stops_gtfs, routes_gtfs, shapes_gtfs):
-    stops_directory = 'bmtc-data/raw/stops/'
-    # TODO: Iterate through next day maybe rather than Monday always ?
-    timetables_directory = 'bmtc-data/raw/timetables/Monday/'
-
-    trips = []
-    no_stops = []
-    no_timetables = []
-    no_shapes = []
-
-    stops_files = set(os.listdir(stops_directory))
-
-    def process_trip(route, direction, filename):
-        file_path = os.path.join(stops_directory, filename)
-        shape_key = f"{route} {direction}"
-        timetable_path = os.path.join(timetables_directory, filename)
-
-        if filename not in stops_files or os.path.getsize(file_path) == 0:
-            no_stops.append(filename)
-            return
-
-        if shape_key not in shapes_gtfs:
-            no_shapes.append(filename)
-            return
-
-        with open(file_path, 'r') as stops_file:
-            stops_data = json.load(stops_file)
-
-            if not os.path.exists(timetable_path) or os.path.getsize(timetable_path) == 0:
-                no_timetables.append(timetable_path)
-                return
-
-            with open(timetable_path, 'r') as timetables_file:
-                timetables = json.load(timetables_file)
-
-                if timetables["Message"] == "No Records Found.":
-                    no_timetables.append(timetable_path)
-                    return
-
-                for trip in timetables["data"][0]["tripdetails"]:
-                    direction_id = 0 if direction == "UP" else 1
-
-                    # TODO: Better duration calculation
-                    start_time = datetime.datetime.strptime(trip["starttime"], '%H:%M')
-                    end_time = datetime.datetime.strptime(trip["endtime"], '%H:%M')
-                    duration = (end_time - start_time).total_seconds()
-
-                    trip_obj = routes_gtfs[route].AddTrip(schedule, headsign=timetables["data"][0]["tostationname"])
-                    trip_obj.shape_id = shapes_gtfs[shape_key].shape_id
-                    trip_obj.direction_id = direction_id
-                    interval = duration / len(stops_data[direction.lower()]["data"])
-
-                    for stop_index, stop in enumerate(stops_data[direction.lower()]["data"]):
-                        stop_time = (start_time + datetime.timedelta(seconds=stop_index * interval)).strftime(
-                            '%H:%M:%S')
-                        trip_obj.AddStopTime(stops_gtfs[stop["stationid"]], stop_time=stop_time)
-
-                trips.append(filename.replace(".json", ""))
-
-    for routename in routes_gtfs:
-        for direction in ["UP", "DOWN"]:
-            filename = f"{routename} {direction}.json"
-            try:
-                process_trip(routename, direction, filename)
-            except Exception as err:
-                logging.info(f"Failed to process timetable for route {filename}")
-                logging.error(traceback.format_exc())
-
-    logging.info(f"Added {len(trips)} trips")
-    logging.info(f"Missing timetable for {len(no_timetables)} routes")
-    logging.info(f"Missing stops list for {len(no_stops)} routes")
-    logging.info(f"Missing shape for {len(no_shapes)} routes")
-
+# Add the simplified, deduplicated shapes from shapes.prepare_shapes
+def add_shapes(shapes):
+    shapes_gtfs = {}
+
+    def process_shape(shape_id, points, results):
+        lats, lons = points
+        shapes_gtfs[shape_id] = transitfeed.Shape(shape_id)
+        for lat, lon, distance in zip(lats, lons, np.round(cumulative_distances(lats, lons), 3).tolist()):
+            shapes_gtfs[shape_id].AddPoint(lat=lat, lon=lon, distance=distance)
+        schedule.AddShapeObject(shapes_gtfs[shape_id])
+        results["success"].append(shape_id)
+
+    results = process_responses(shapes, process_shape)
+    logging.info(f"Added {len(shapes_gtfs)} shapes ({len(results['failure'])} errors)")
+    return shapes_gtfs
+
+
+# Trip and stop time generation fans out across a process pool by route, then the fragments are added in route order
+def add_trips(weekly_timetables, service_periods, stop_lists, routes_gtfs, route_shapes, workers=None, cache=None,
+              headways=None):
+    routes = {name: route.route_id for name, route in routes_gtfs.items()}
+    fragments, missing = trip_builder.build_all(routes, stop_lists, route_shapes, weekly_timetables, workers, cache,
+                                                headways)
+
+    for fragment in fragments:
+        trip_objs = []
+        trips = fragment["trips"]
+        for route_id, days, headsign, direction_id, shape_id in zip(
+                trips["route_id"], trips["days"], trips["trip_headsign"], trips["direction_id"], trips["shape_id"]):
+            trip_obj = schedule.GetRoute(route_id).AddTrip(schedule, headsign=headsign,
+                                                           service_period=service_periods[days])
+            trip_obj.shape_id = shape_id
+            trip_obj.direction_id = direction_id
+            trip_objs.append(trip_obj)
+
+        stop_times = fragment["stop_times"]
+        for trip_index, stop_time, stop_id, distance in zip(
+                stop_times["trip_index"], stop_times["arrival_time"], stop_times["stop_id"],
+                stop_times["shape_dist_traveled"]):
+            trip_objs[trip_index].AddStopTime(schedule.GetStop(stop_id), stop_time=stop_time,
+                                              shape_dist_traveled=distance)
+
+        frequencies = fragment.get("frequencies", {})
+        for trip_index, start_time, end_time, headway_secs, exact_times in zip(
+                *(frequencies.get(column, []) for column in
+                  ["trip_index", "start_time", "end_time", "headway_secs", "exact_times"])):
+            trip_objs[trip_index].AddFrequency(start_time, end_time, headway_secs, exact_times)
+
+    write_missing(*missing)
+
+
+# transitfeed orders the columns of agency, stops, routes and trips by how the objects' attributes hash, so the same
+# feed could come out differently from one run to the next. Put them in the order gtfs_columnar writes instead.
+def pin_columns():
+    for name, order in gtfs_columnar.COLUMNS.items():
+        table = os.path.splitext(name)[0]
+        if name not in gtfs_columnar.FIXED_COLUMNS and table in schedule._table_columns:
+            schedule.GetTableColumns(table).sort(key=lambda column: order.index(column) if column in order
+                                                 else len(order))
+
+
+def write_missing(no_timetables, no_stops, no_shapes):
     with open('bmtc-data/gtfs/intermediate/missingTimetables.txt', 'w') as file:
         for item in no_timetables:
             file.write("%s\n" % item)
@@ -204,51 +202,119 @@ def add_trips(stops_gtfs, routes_gtfs, shapes_gtfs):
             file.write("%s\n" % item)
 
 
+# Raw archives published next to the store, and the endpoint each one is exported from
+RAW_ARCHIVES = {
+    "routeids": "SearchRoute_v2",
+    "routelines": "RoutePoints",
+    "stops": "SearchByRouteDetails_v4",
+    "timetables": "GetTimetableByRouteid_v3",
+}
 
-def compress_files():
-    with os.scandir("bmtc-data/raw") as raw_directory:
-        for raw_item in raw_directory:
-            if raw_item.is_dir():
-                folder_path = raw_item.name
-                folder_name = os.path.basename(folder_path.rstrip('/\\'))
-                zip_file_path = os.path.join("bmtc-data/raw", os.path.dirname(folder_path), f"{folder_name}.zip")
 
-                with zipfile.ZipFile(zip_file_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-                    for root, dirs, files in os.walk(os.path.join("bmtc-data/raw", folder_path)):
-                        for file in files:
-                            file_path = os.path.join(root, file)
-                            arcname = os.path.relpath(file_path, start=folder_path)
-                            zipf.write(file_path, arcname)
+def compress_files(store):
+    for folder_name, endpoint in RAW_ARCHIVES.items():
+        zip_file_path = os.path.join("bmtc-data/raw", f"{folder_name}.zip")
 
-                logging.info(f"Folder '{folder_path}' compressed into '{zip_file_path}'")
+        with zipfile.ZipFile(zip_file_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
+            for key, day, body in store.iter_raw(endpoint):
+                zipf.writestr(os.path.join(day, f"{key}.json"), body)
 
-                shutil.rmtree(os.path.join("bmtc-data/raw", folder_path))
+        logging.info(f"Responses for '{endpoint}' exported into '{zip_file_path}'")
 
-            else:
-                file_name = raw_item.name
-                if file_name.endswith(".json"):
-                    os.remove(os.path.join("bmtc-data/raw", file_name))
 
-
-def main():
+def build_with_transitfeed(store, stop_lists, weekly_timetables, workers=None, cache=None, headways=None,
+                           shape_tolerance=SHAPE_TOLERANCE, clusters=None):
     add_agency()
-    add_service_period()
-    stops = add_stops()
-    routes = add_routes()
-    shapes = add_shapes()
-    add_trips(stops, routes, shapes)
+    service_periods = add_service_periods(weekly_timetables)
+    add_stops(stop_lists, clusters)
+    routes = add_routes(store)
+    shapes, shape_ids = prepare_shapes(store.load_all('RoutePoints'), shape_tolerance)
+    shapes_gtfs = add_shapes(shapes)
+    # Directions whose shape could not be added are left out of the trips, as for a missing shape
+    shape_ids = {name: shape_id for name, shape_id in shape_ids.items() if shape_id in shapes_gtfs}
+    add_trips(weekly_timetables, service_periods, stop_lists, routes, route_shapes(shapes, shape_ids), workers, cache,
+              headways)
+
+    metrics.count("trips", len(schedule.GetTripList()))
+    metrics.count("stops", len(schedule.GetStopList()))
+    metrics.count("routes", len(schedule.GetRouteList()))
+    metrics.count("shapes", len(schedule.GetShapeList()))
 
     # Basic validation
-    schedule.Validate()
+    with metrics.stage("validate"):
+        schedule.Validate()
 
     # Dump data
     logging.info("Writing GTFS to disk...")
 
-    schedule.WriteGoogleTransitFeed("bmtc-data/gtfs/intermediate/bmtc.zip")
+    with metrics.stage("write"):
+        pin_columns()
+        schedule.WriteGoogleTransitFeed(GTFS_PATH)
+
 
-    compress_files()
+# Same feed without the transitfeed object model or validation, for large inputs
+def build_columnar(store, stop_lists, weekly_timetables, workers=None, cache=None, headways=None,
+                   shape_tolerance=SHAPE_TOLERANCE, clusters=None):
+    tables, missing = gtfs_columnar.build_feed(stop_lists, store.get('GetAllRouteList', 'all'),
+                                               store.load_all('RoutePoints'), weekly_timetables, workers, cache,
+                                               headways, shape_tolerance, clusters)
+    write_missing(*missing)
+    for name, table in tables.items():
+        metrics.count(f"{name.split('.')[0]} rows", table_length(table))
+
+    logging.info("Writing GTFS to disk...")
+    with metrics.stage("write"):
+        gtfs_columnar.write_feed(tables, GTFS_PATH)
+
+
+# Routes whose raw inputs are unchanged since the last build reuse their cached trips unless incremental is False.
+# Pass a trip_builder.HeadwayPolicy as headways to emit frequencies.txt for steady-headway runs of trips, and
+# clusters=None to leave stops without parent stations.
+def main(engine="transitfeed", workers=None, incremental=True, headways=None, shape_tolerance=SHAPE_TOLERANCE,
+         clusters=ClusterPolicy()):
+    store = RawStore()
+    cache = FragmentCache() if incremental else None
+    with metrics.stage("load"):
+        # Each stop list covers both directions of a route, so it is parsed once and shared
+        stop_lists = store.load_all('SearchByRouteDetails_v4')
+        weekly_timetables = group_timetables(store.load_by_day('GetTimetableByRouteid_v3'))
+
+    with metrics.stage("build"):
+        if engine == "columnar":
+            build_columnar(store, stop_lists, weekly_timetables, workers, cache, headways, shape_tolerance, clusters)
+        else:
+            build_with_transitfeed(store, stop_lists, weekly_timetables, workers, cache, headways, shape_tolerance,
+                                   clusters)
+
+    with metrics.stage("export raw"):
+        compress_files(store)
+    store.close()
+    if cache:
+        cache.close()
 
 
 # Main execution
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Build the GTFS feed from the raw store")
+    parser.add_argument('--engine', choices=ENGINES, default="transitfeed")
+    parser.add_argument('--workers', type=int, help="processes building trips (default: one per CPU)")
+    parser.add_argument('--full', action='store_true', help="rebuild every route instead of reusing cached trips")
+    parser.add_argument('--frequencies', action='store_true',
+                        help="replace steady-headway runs of trips with frequencies.txt entries")
+    parser.add_argument('--headway-tolerance', type=int, default=trip_builder.HEADWAY_TOLERANCE,
+                        help="seconds a start time may drift from the run's headway")
+    parser.add_argument('--min-headway-trips', type=int, default=trip_builder.MIN_HEADWAY_TRIPS,
+                        help="fewest trips a run needs to become a frequency")
+    parser.add_argument('--shape-tolerance', type=float, default=SHAPE_TOLERANCE,
+                        help="metres route lines may be simplified by, 0 keeps every point")
+    parser.add_argument('--no-parent-stations', action='store_true', help="leave stops without parent stations")
+    parser.add_argument('--cluster-radius', type=float, default=CLUSTER_RADIUS,
+                        help="metres within which platforms can share a parent station")
+    parser.add_argument('--name-similarity', type=float, default=NAME_SIMILARITY,
+                        help="0 to 1, how alike platform names must be to share a parent station")
+    args = parser.parse_args()
+    headways = trip_builder.HeadwayPolicy(args.headway_tolerance, args.min_headway_trips) if args.frequencies else None
+    clusters = None if args.no_parent_stations else ClusterPolicy(args.cluster_radius, args.name_similarity)
+    with metrics.stage("gtfs"):
+        main(args.engine, args.workers, not args.full, headways, args.shape_tolerance, clusters)
+    metrics.write()
@@ -0,0 +1,240 @@
+import csv
+import io
+import logging
+import traceback
+import zipfile
+from itertools import repeat
+
+import numpy as np
+
+from scripts import trip_builder
+from scripts.geometry import cumulative_distances
+from scripts.shapes import SHAPE_TOLERANCE, prepare_shapes, route_shapes
+from scripts.stop_clusters import parent_stations
+from scripts.timetables import service_dates, service_id, weekly_patterns
+
+GTFS_PATH = "bmtc-data/gtfs/intermediate/bmtc.zip"
+AGENCY = {
+    "agency_id": 1,
+    "agency_name": "Bengaluru Metropolitan Transport Corporation",
+    "agency_url": "https://mybmtc.karnataka.gov.in/english",
+    "agency_timezone": "Asia/Kolkata",
+}
+ROUTE_TYPE_BUS = 3
+
+# Files in the order transitfeed writes them, with their columns in the order both engines write them. transitfeed
+# itself orders agency, stops, routes and trips columns by hash, so gtfs.py pins it to this order before writing.
+COLUMNS = {
+    "agency.txt": ["agency_id", "agency_name", "agency_url", "agency_timezone"],
+    "calendar.txt": ["service_id", "start_date", "end_date", "monday", "tuesday", "wednesday", "thursday",
+                     "friday", "saturday", "sunday"],
+    "stops.txt": ["stop_id", "stop_name", "stop_lat", "stop_lon", "location_type", "parent_station"],
+    "routes.txt": ["route_id", "agency_id", "route_short_name", "route_long_name", "route_type"],
+    "trips.txt": ["route_id", "service_id", "trip_id", "trip_headsign", "direction_id", "shape_id"],
+    "frequencies.txt": ["trip_id", "start_time", "end_time", "headway_secs", "exact_times"],
+    "stop_times.txt": ["trip_id", "arrival_time", "departure_time", "stop_id", "stop_sequence", "stop_headsign",
+                       "pickup_type", "drop_off_type", "shape_dist_traveled", "timepoint"],
+    "shapes.txt": ["shape_id", "shape_pt_lat", "shape_pt_lon", "shape_pt_sequence", "shape_dist_traveled"],
+}
+# transitfeed writes every column of these files, empty where nothing fills it, and only the columns some row sets
+# in the others
+FIXED_COLUMNS = {"calendar.txt", "frequencies.txt", "stop_times.txt", "shapes.txt"}
+
+
+def new_table(name, columns=None):
+    return {column: [] for column in (columns or COLUMNS[name])}
+
+
+def table_length(table):
+    return max((len(values) for values in table.values()), default=0)
+
+
+def build_agency():
+    return {column: [value] for column, value in AGENCY.items()}
+
+
+# One calendar row per distinct weekly pattern, returns the table and {days: service_id}
+def build_calendar(weekly_timetables):
+    table = new_table("calendar.txt")
+    start_date, end_date = service_dates()
+    service_ids = {}
+
+    for days in weekly_patterns(weekly_timetables):
+        service_ids[days] = service_id(days)
+        table["service_id"].append(service_ids[days])
+        table["start_date"].append(start_date)
+        table["end_date"].append(end_date)
+        for day_index, column in enumerate(COLUMNS["calendar.txt"][3:]):
+            table[column].append(1 if day_index in days else 0)
+
+    logging.info(f"Added {len(service_ids)} service periods")
+    return table, service_ids
+
+
+# Platforms from every stop list, then a parent station for each cluster of them when a ClusterPolicy is given
+def build_stops(stop_lists, clusters=None):
+    table = new_table("stops.txt", ["stop_id", "stop_name", "stop_lat", "stop_lon", "location_type"])
+    stops = set()
+    failures = 0
+
+    for route, data in stop_lists.items():
+        try:
+            for stop in (data.get("up", {}).get("data", []) + data.get("down", {}).get("data", [])):
+                if stop["stationid"] not in stops:
+                    stops.add(stop["stationid"])
+                    table["stop_id"].append(str(stop["stationid"]))
+                    table["stop_name"].append(stop["stationname"])
+                    table["stop_lat"].append(float(stop["centerlat"]))
+                    table["stop_lon"].append(float(stop["centerlong"]))
+                    table["location_type"].append(0)
+        except Exception:
+            logging.info(f"Failed to process {route}")
+            logging.error(traceback.format_exc())
+            failures += 1
+
+    logging.info(f"Added {len(stops)} stops ({failures} errors)")
+
+    if clusters is not None:
+        stations, parent_ids = parent_stations(table["stop_id"], table["stop_name"], table["stop_lat"],
+                                               table["stop_lon"], clusters.radius, clusters.name_similarity)
+        table["parent_station"] = [parent_ids.get(stop_id, "") for stop_id in table["stop_id"]]
+        for station in stations:
+            for column, value in station.items():
+                table[column].append(value)
+            table["location_type"].append(1)
+            table["parent_station"].append("")
+        logging.info(f"Added {len(stations)} parent stations for {len(parent_ids)} stops")
+    return table, stops
+
+
+# Returns the table and {route name: route_id}, keeping the first route_id seen for each name as gtfs.add_routes does
+def build_routes(routes_json):
+    table = new_table("routes.txt")
+    routes = {}
+
+    for route in routes_json["data"]:
+        try:
+            route_id_name = route["routeno"].replace(" UP", "").replace(" DOWN", "")
+            if route_id_name not in routes:
+                routes[route_id_name] = route["routeid"]
+                table["route_id"].append(route["routeid"])
+                table["agency_id"].append(AGENCY["agency_id"])
+                table["route_short_name"].append(route_id_name)
+                table["route_long_name"].append(f"{route['fromstation']} ⇔ {route['tostation']}")
+                table["route_type"].append(ROUTE_TYPE_BUS)
+        except Exception:
+            logging.info(f"Failed to process {route['routeno']}")
+            logging.error(traceback.format_exc())
+
+    logging.info(f"Added {len(routes)} routes")
+    return table, routes
+
+
+# shapes.txt rows for the shapes.prepare_shapes output
+def build_shapes(shapes):
+    table = new_table("shapes.txt")
+
+    for shape_id, (lats, lons) in shapes.items():
+        table["shape_id"].extend([shape_id] * len(lats))
+        table["shape_pt_lat"].extend(lats)
+        table["shape_pt_lon"].extend(lons)
+        table["shape_pt_sequence"].extend(range(1, len(lats) + 1))
+        table["shape_dist_traveled"].extend(np.round(cumulative_distances(lats, lons), 3).tolist())
+
+    logging.info(f"Added {len(shapes)} shapes")
+    return table
+
+
+# Number the trips of every route fragment in route order and expand them into the trips, stop_times and
+# frequencies tables
+def merge_fragments(fragments, service_ids):
+    trips = new_table("trips.txt")
+    frequencies = new_table("frequencies.txt")
+    stop_times = new_table("stop_times.txt", ["trip_id", "arrival_time", "departure_time", "stop_id",
+                                              "stop_sequence", "shape_dist_traveled"])
+
+    for fragment in fragments:
+        offset = len(trips["trip_id"])
+        fragment_trips, fragment_stop_times = fragment["trips"], fragment["stop_times"]
+        trips["route_id"].extend(fragment_trips["route_id"])
+        trips["service_id"].extend(service_ids[days] for days in fragment_trips["days"])
+        trips["trip_id"].extend(str(offset + index) for index in range(len(fragment_trips["route_id"])))
+        trips["trip_headsign"].extend(fragment_trips["trip_headsign"])
+        trips["direction_id"].extend(fragment_trips["direction_id"])
+        trips["shape_id"].extend(fragment_trips["shape_id"])
+
+        stop_times["trip_id"].extend(str(offset + index) for index in fragment_stop_times["trip_index"])
+        stop_times["arrival_time"].extend(fragment_stop_times["arrival_time"])
+        stop_times["departure_time"].extend(fragment_stop_times["arrival_time"])
+        stop_times["stop_id"].extend(fragment_stop_times["stop_id"])
+        stop_times["stop_sequence"].extend(fragment_stop_times["stop_sequence"])
+        # transitfeed writes a zero distance as an empty value
+        stop_times["shape_dist_traveled"].extend(distance or ""
+                                                 for distance in fragment_stop_times["shape_dist_traveled"])
+
+        fragment_frequencies = fragment.get("frequencies")
+        if fragment_frequencies:
+            frequencies["trip_id"].extend(str(offset + index) for index in fragment_frequencies["trip_index"])
+            frequencies["start_time"].extend(map(trip_builder.format_time, fragment_frequencies["start_time"]))
+            frequencies["end_time"].extend(map(trip_builder.format_time, fragment_frequencies["end_time"]))
+            frequencies["headway_secs"].extend(fragment_frequencies["headway_secs"])
+            frequencies["exact_times"].extend(fragment_frequencies["exact_times"])
+
+    return trips, stop_times, frequencies
+
+
+# Trips, stop times and frequencies for every route direction, returns the three tables and the (no_timetables,
+# no_stops, no_shapes) lists
+def build_trips(weekly_timetables, service_ids, stop_lists, routes, route_shapes, workers=None, cache=None,
+                headways=None):
+    fragments, missing = trip_builder.build_all(routes, stop_lists, route_shapes, weekly_timetables, workers, cache,
+                                                headways)
+    trips, stop_times, frequencies = merge_fragments(fragments, service_ids)
+    return trips, stop_times, frequencies, missing
+
+
+# Build every table of the feed, returns ({file name: table}, missing lists)
+def build_feed(stop_lists, routes_json, route_lines, weekly_timetables, workers=None, cache=None, headways=None,
+               shape_tolerance=SHAPE_TOLERANCE, clusters=None):
+    calendar, service_ids = build_calendar(weekly_timetables)
+    stops, _ = build_stops(stop_lists, clusters)
+    routes, route_ids = build_routes(routes_json)
+    shapes, shape_ids = prepare_shapes(route_lines, shape_tolerance)
+    trips, stop_times, frequencies, missing = build_trips(weekly_timetables, service_ids, stop_lists, route_ids,
+                                                          route_shapes(shapes, shape_ids), workers, cache, headways)
+
+    tables = {
+        "agency.txt": build_agency(),
+        "calendar.txt": calendar,
+        "stops.txt": stops,
+        "routes.txt": routes,
+        "trips.txt": trips,
+        "stop_times.txt": stop_times,
+        "shapes.txt": build_shapes(shapes),
+    }
+    # Like transitfeed, only write frequencies.txt when some trip has a frequency
+    if frequencies["trip_id"]:
+        tables["frequencies.txt"] = frequencies
+    return tables, missing
+
+
+# Stream a table into the archive as CSV, row by row, without building the file in memory
+def write_table(archive, name, table, columns=None):
+    columns = columns or COLUMNS[name]
+    length = table_length(table)
+    info = zipfile.ZipInfo(name)
+    info.external_attr = 0o666 << 16
+    info.compress_type = zipfile.ZIP_DEFLATED
+
+    with archive.open(info, 'w') as raw, io.TextIOWrapper(raw, encoding='utf-8', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(columns)
+        writer.writerows(zip(*[table.get(column) or repeat("", length) for column in columns]))
+
+
+def write_feed(tables, path):
+    with zipfile.ZipFile(path, 'w') as archive:
+        for name in COLUMNS:
+            if name in tables:
+                columns = COLUMNS[name] if name in FIXED_COLUMNS else [c for c in COLUMNS[name] if c in tables[name]]
+                write_table(archive, name, tables[name], columns)
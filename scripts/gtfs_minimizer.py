@@ -0,0 +1,220 @@
+import argparse
+import logging
+import os
+import zipfile
+
+import numpy as np
+import pandas as pd
+from pandas._libs.parsers import STR_NA_VALUES
+
+from scripts.feed import FEED_PATH
+from scripts.gtfs_columnar import COLUMNS, GTFS_PATH, write_table
+from scripts.metrics import metrics
+
+DIGITS = "0123456789abcdefghijklmnopqrstuvwxyz"
+# IDs a default pd.read_csv (and so gtfs_kit) reads as missing or as a float rather than as a string: "nan" is
+# number 30191 in base 36, well within the trips of a feed
+UNREADABLE_IDS = {value.lower() for value in STR_NA_VALUES} | {"inf", "infinity"}
+# Columns holding each kind of ID, by table, for remapping them all at once
+REFERENCES = {
+    'stop_id': {'stops.txt': ['stop_id', 'parent_station'], 'stop_times.txt': ['stop_id'],
+                'transfers.txt': ['from_stop_id', 'to_stop_id']},
+    'route_id': {'routes.txt': ['route_id'], 'trips.txt': ['route_id']},
+    'trip_id': {'trips.txt': ['trip_id'], 'stop_times.txt': ['trip_id'], 'frequencies.txt': ['trip_id']},
+    'shape_id': {'shapes.txt': ['shape_id'], 'trips.txt': ['shape_id']},
+    'service_id': {'calendar.txt': ['service_id'], 'calendar_dates.txt': ['service_id'], 'trips.txt': ['service_id']},
+}
+
+
+# count base 36 strings counting up from 0, the shortest IDs a CSV can hold without quoting, skipping the
+# UNREADABLE_IDS
+def short_ids(count):
+    ids = []
+    number = 0
+    while len(ids) < count:
+        digits, rest = DIGITS[number % 36], number // 36
+        while rest:
+            digits = DIGITS[rest % 36] + digits
+            rest //= 36
+        if digits not in UNREADABLE_IDS:
+            ids.append(digits)
+        number += 1
+    return ids
+
+
+def read_tables(path):
+    with zipfile.ZipFile(path, 'r') as z:
+        return {name: pd.read_csv(z.open(name), dtype=str, keep_default_na=False, encoding='utf-8-sig')
+                for name in z.namelist() if name.endswith(".txt")}
+
+
+def write_tables(tables, path):
+    names = [name for name in COLUMNS if name in tables] + sorted(set(tables) - set(COLUMNS))
+    with zipfile.ZipFile(path, 'w') as archive:
+        for name in names:
+            df = tables[name]
+            write_table(archive, name, {column: df[column].tolist() for column in df.columns}, list(df.columns))
+
+
+# Replace IDs through {old: new}, leaving IDs without an entry (and empty references) as they are
+def remap(tables, kind, mapping):
+    if not mapping:
+        return
+    for name, columns in REFERENCES[kind].items():
+        if name not in tables:
+            continue
+        for column in columns:
+            if column in tables[name].columns:
+                values = tables[name][column]
+                tables[name][column] = values.map(mapping).fillna(values)
+
+
+# {duplicate ID: ID of the first row with the same key}, for rows whose keys are identical
+def duplicates(ids, keys):
+    ids = np.asarray(ids, dtype=object)
+    first = pd.Series(ids).groupby(np.asarray(keys, dtype=object), sort=False).transform('first').to_numpy()
+    duplicate = first != ids
+    return dict(zip(ids[duplicate].tolist(), first[duplicate].tolist()))
+
+
+# Every column of each row joined into one string, so whole rows compare and group as single values
+def row_keys(df, columns):
+    keys = pd.Series("", index=df.index)
+    for column in columns:
+        keys = keys + df[column] + "\x1f"
+    return keys
+
+
+# Stops alike in everything but their ID. Stations go first, so platforms of merged stations become alike too.
+def merge_stops(tables):
+    stops = tables['stops.txt']
+    merged = {}
+    for _ in range(2):
+        mapping = duplicates(stops['stop_id'], row_keys(stops, [c for c in stops.columns if c != 'stop_id']))
+        remap(tables, 'stop_id', mapping)
+        stops = tables['stops.txt'] = stops.drop_duplicates('stop_id').reset_index(drop=True)
+        merged.update(mapping)
+    return len(merged)
+
+
+# Shapes with the same points, in the same order
+def merge_shapes(tables):
+    shapes = tables['shapes.txt']
+    points = row_keys(shapes, [c for c in shapes.columns if c != 'shape_id'])
+    keys = points.groupby(shapes['shape_id'], sort=False).agg('\x1e'.join)
+    mapping = duplicates(keys.index, keys.to_numpy())
+    tables['shapes.txt'] = shapes.loc[~shapes['shape_id'].isin(mapping)].reset_index(drop=True)
+    remap(tables, 'shape_id', mapping)
+    return len(mapping)
+
+
+# Services running on the same days between the same dates, with the same exceptions
+def merge_services(tables):
+    ids = pd.Index(tables['calendar.txt']['service_id'] if 'calendar.txt' in tables else [])
+    if 'calendar_dates.txt' in tables:
+        ids = ids.append(pd.Index(tables['calendar_dates.txt']['service_id'])).unique()
+    keys = pd.Series("", index=ids)
+    for name in ('calendar.txt', 'calendar_dates.txt'):
+        if name in tables:
+            df = tables[name]
+            rows = row_keys(df, [c for c in df.columns if c != 'service_id'])
+            keys = keys + "\x1d" + (rows.groupby(df['service_id'].to_numpy(), sort=False).agg('\x1e'.join)
+                                    .reindex(ids, fill_value=""))
+    mapping = duplicates(ids, keys.to_numpy())
+    for name in ('calendar.txt', 'calendar_dates.txt'):
+        if name in tables:
+            tables[name] = tables[name].loc[~tables[name]['service_id'].isin(mapping)].reset_index(drop=True)
+    remap(tables, 'service_id', mapping)
+    return len(mapping)
+
+
+# Trips identical in every column, stop time and frequency, which riders could not tell apart
+def merge_trips(tables):
+    trips = tables['trips.txt']
+    keys = row_keys(trips, [c for c in trips.columns if c != 'trip_id']).set_axis(trips['trip_id'].to_numpy())
+    for name in ('stop_times.txt', 'frequencies.txt'):
+        if name in tables:
+            df = tables[name]
+            rows = row_keys(df, [c for c in df.columns if c != 'trip_id'])
+            keys = keys + "\x1d" + (rows.groupby(df['trip_id'].to_numpy(), sort=False).agg('\x1e'.join)
+                                    .reindex(keys.index, fill_value=""))
+    mapping = duplicates(keys.index, keys.to_numpy())
+    for name in ('trips.txt', 'stop_times.txt', 'frequencies.txt'):
+        if name in tables:
+            tables[name] = tables[name].loc[~tables[name]['trip_id'].isin(mapping)].reset_index(drop=True)
+    return len(mapping)
+
+
+def keep(tables, name, column, used):
+    if name not in tables:
+        return 0
+    df = tables[name]
+    kept = df[column].isin(used)
+    tables[name] = df.loc[kept].reset_index(drop=True)
+    return int((~kept).sum())
+
+
+# Drop what no trip leads to: routes, agencies, services and shapes without trips, stops nothing calls at
+def drop_unreferenced(tables):
+    trips = tables['trips.txt']
+    trip_ids = set(trips['trip_id'])
+    dropped = keep(tables, 'stop_times.txt', 'trip_id', trip_ids) + keep(tables, 'frequencies.txt', 'trip_id', trip_ids)
+    dropped += keep(tables, 'routes.txt', 'route_id', set(trips['route_id']))
+    if 'agency_id' in tables['routes.txt'].columns:
+        dropped += keep(tables, 'agency.txt', 'agency_id', set(tables['routes.txt']['agency_id']))
+    dropped += keep(tables, 'calendar.txt', 'service_id', set(trips['service_id']))
+    dropped += keep(tables, 'calendar_dates.txt', 'service_id', set(trips['service_id']))
+    if 'shape_id' in trips.columns:
+        dropped += keep(tables, 'shapes.txt', 'shape_id', set(trips['shape_id']))
+
+    stops = tables['stops.txt']
+    used = set(tables['stop_times.txt']['stop_id'])
+    if 'parent_station' in stops.columns:
+        used |= set(stops.loc[stops['stop_id'].isin(used), 'parent_station']) - {""}
+    dropped += keep(tables, 'stops.txt', 'stop_id', used)
+    return dropped
+
+
+# Renumber every kind of ID densely, in the order the table defining them (first in REFERENCES) lists them
+def shorten_ids(tables):
+    for kind, references in REFERENCES.items():
+        ids = {}
+        for name, columns in references.items():
+            for column in columns:
+                if name in tables and column in tables[name].columns:
+                    ids.update(dict.fromkeys(tables[name][column].unique().tolist()))
+        ids.pop("", None)
+        remap(tables, kind, dict(zip(ids, short_ids(len(ids)))))
+
+
+# In-process take on gtfstidy -SCRmcdsOeD: merge duplicate stops, shapes, services and trips, drop unreferenced
+# entities and shorten IDs. Returns the number of rows the feed lost.
+def minimize(input_path=GTFS_PATH, output_path=FEED_PATH):
+    tables = read_tables(input_path)
+    rows_in = sum(len(df) for df in tables.values())
+
+    merged = {'stops': merge_stops(tables), 'shapes': merge_shapes(tables), 'services': merge_services(tables),
+              'trips': merge_trips(tables)}
+    dropped = drop_unreferenced(tables)
+    shorten_ids(tables)
+
+    os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+    write_tables(tables, output_path)
+    rows_out = sum(len(df) for df in tables.values())
+    for kind, count in merged.items():
+        metrics.count(f"merged {kind}", count)
+    metrics.count("rows in", rows_in)
+    metrics.count("rows out", rows_out)
+    logging.info(f"Minimized {input_path} to {output_path}: merged " +
+                 ", ".join(f"{count} {kind}" for kind, count in merged.items()) +
+                 f", dropped {dropped} unreferenced rows, {rows_in} rows down to {rows_out}")
+    return rows_in - rows_out
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+    parser = argparse.ArgumentParser(description="Minimize a GTFS feed without gtfstidy")
+    parser.add_argument('input', nargs='?', default=GTFS_PATH)
+    parser.add_argument('output', nargs='?', default=FEED_PATH)
+    args = parser.parse_args()
+    minimize(args.input, args.output)
@@ -0,0 +1,88 @@
+import hashlib
+import json
+import logging
+import os
+import time
+
+MANIFEST_PATH = "bmtc-data/raw/manifest.json"
+
+# How long a successful response stays fresh, per endpoint (seconds)
+TTLS = {
+    'SearchRoute_v2': 24 * 3600,
+    'RoutePoints': 7 * 24 * 3600,
+    'GetTimetableByRouteid_v3': 24 * 3600,
+    'SearchByRouteDetails_v4': 7 * 24 * 3600,
+}
+DEFAULT_TTL = 24 * 3600
+# Failed fetches are retried on every run until this many attempts, then wait for the TTL
+MAX_FAILURES = 3
+
+
+def content_hash(body):
+    return hashlib.sha256(body.encode('utf-8') if isinstance(body, str) else body).hexdigest()
+
+
+# Persistent record of every fetch, used to make scrapes incremental
+class Manifest:
+    def __init__(self, path=MANIFEST_PATH, ttls=None, max_failures=MAX_FAILURES):
+        self.path = path
+        self.ttls = TTLS if ttls is None else ttls
+        self.max_failures = max_failures
+        self.entries = {}
+        self.changed = set()
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            with open(path, 'r', encoding='utf-8') as f:
+                self.entries = json.load(f)
+
+    def ttl(self, endpoint):
+        return self.ttls.get(endpoint, DEFAULT_TTL)
+
+    def get(self, endpoint, key):
+        return self.entries.get(f"{endpoint}/{key}")
+
+    # Whether an entry is missing, expired or a failure that still has retries left
+    def should_fetch(self, endpoint, key, now=None):
+        entry = self.get(endpoint, key)
+        if entry is None:
+            return True
+        now = now or time.time()
+        expired = now - entry['fetched_at'] >= self.ttl(endpoint)
+        if entry['status'] == 'failed':
+            return expired or entry['failures'] < self.max_failures
+        return expired
+
+    # Record a fetch outcome and return whether the response differs from the last one seen
+    def record(self, endpoint, key, payload, status, body=None):
+        name = f"{endpoint}/{key}"
+        entry = self.entries.get(name, {})
+        now = time.time()
+
+        if status == 'failed':
+            failures = entry.get('failures', 0) if entry.get('status') == 'failed' else 0
+            # A new budget starts once the previous one has been spent and the TTL has expired
+            if failures >= self.max_failures:
+                failures = 0
+            self.entries[name] = {**entry, 'payload': payload, 'status': status, 'fetched_at': now,
+                                  'failures': failures + 1}
+            return False
+
+        digest = content_hash(body) if body is not None else None
+        changed = digest != entry.get('hash')
+        self.entries[name] = {
+            'payload': payload,
+            'hash': digest,
+            'status': status,
+            'fetched_at': now,
+            'changed_at': now if changed else entry.get('changed_at', now),
+            'failures': 0,
+        }
+        if changed:
+            self.changed.add(name)
+        return changed
+
+    def save(self):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.entries, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.path)
+        logging.info(f"Saved manifest with {len(self.entries)} entries ({len(self.changed)} changed)")
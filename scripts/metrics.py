@@ -0,0 +1,218 @@
+import json
+import logging
+import os
+import resource
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+
+import numpy as np
+
+METRICS_DIRECTORY = "bmtc-data/metrics"
+# Comma-separated stage names to run under the sampling profiler, e.g. BMTC_PROFILE=gtfs,geojson/routes
+PROFILE_ENV = "BMTC_PROFILE"
+PROFILE_INTERVAL = 0.005
+RSS_INTERVAL = 0.05
+# Upper edges of the request latency histogram buckets, in milliseconds
+LATENCY_BUCKETS = [10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000]
+
+
+def rss_mb(usage):
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    return usage.ru_maxrss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+
+# Resident set size of this process now. Without /proc (macOS), the high-water mark so far is the closest there is.
+def current_rss_mb():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+    except OSError:
+        return rss_mb(resource.getrusage(resource.RUSAGE_SELF))
+
+
+# Samples the process's RSS at a fixed interval while a stage runs and keeps the largest value
+class RssSampler:
+    def __init__(self, interval=RSS_INTERVAL):
+        self.interval = interval
+        self.peak = current_rss_mb()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="rss-sampler", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        self.peak = max(self.peak, current_rss_mb())
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.peak = max(self.peak, current_rss_mb())
+
+
+# Samples one thread's stack at a fixed interval and counts each distinct stack, for flame graphs
+class SamplingProfiler:
+    def __init__(self, thread_id, interval=PROFILE_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples = Counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="sampling-profiler", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                frame = frame.f_back
+            if stack:
+                self.samples[";".join(reversed(stack))] += 1
+
+    # Collapsed stacks, one "frame;frame;frame count" line each, as flamegraph.pl and speedscope read them
+    def write(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            for stack, count in self.samples.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+def latency_summary(latencies):
+    latencies_ms = np.asarray(latencies, dtype=float) * 1000
+    if not len(latencies_ms):
+        return {}
+    counts = np.histogram(latencies_ms, bins=[0] + LATENCY_BUCKETS + [np.inf])[0]
+    return {
+        'mean_ms': round(float(latencies_ms.mean()), 3),
+        'p50_ms': round(float(np.percentile(latencies_ms, 50)), 3),
+        'p90_ms': round(float(np.percentile(latencies_ms, 90)), 3),
+        'p99_ms': round(float(np.percentile(latencies_ms, 99)), 3),
+        'max_ms': round(float(latencies_ms.max()), 3),
+        'histogram': {f"<={edge}" if edge != np.inf else f">{LATENCY_BUCKETS[-1]}": int(count)
+                      for edge, count in zip(LATENCY_BUCKETS + [np.inf], counts)},
+    }
+
+
+# Timings, memory and counts of every stage in this process, written out as one JSON report per run.
+# Stages nest: a stage opened inside another is recorded as "outer/inner". Each thread has its own stack of open
+# stages, so stages the pipeline runs side by side are timed separately. Worker processes are only counted in stages
+# opened with children=True: the OS totals them for the whole process, so they cannot be told apart per thread.
+class Metrics:
+    def __init__(self):
+        self.started_at = time.time()
+        self.stages = {}
+        self.endpoints = {}
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    def current(self):
+        stack = getattr(self.local, 'stack', None)
+        return stack[-1] if stack else None
+
+    def entry(self, name):
+        with self.lock:
+            return self.stages.setdefault(name, {'counts': {}})
+
+    @contextmanager
+    def stage(self, name, profile=None, children=False):
+        parent = self.current()
+        name = f"{parent}/{name}" if parent else name
+        entry = self.entry(name)
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        self.local.stack.append(name)
+
+        if profile is None:
+            # Either the full name ("geojson/routes") or the last part of it ("routes") selects a stage
+            profiled = os.getenv(PROFILE_ENV, "").split(',')
+            profile = name in profiled or name.split('/')[-1] in profiled
+        profiler = SamplingProfiler(threading.get_ident()) if profile else None
+        if profiler:
+            profiler.start()
+        rss = RssSampler()
+        rss.start()
+        wall, cpu = time.perf_counter(), time.thread_time()
+        children_before = resource.getrusage(resource.RUSAGE_CHILDREN) if children else None
+        status = 'failed'
+        try:
+            yield entry
+            status = 'ok'
+        finally:
+            self.local.stack.pop()
+            rss.stop()
+            entry.update({
+                'status': status,
+                'wall_s': round(time.perf_counter() - wall, 3),
+                # This thread's own CPU time
+                'cpu_s': round(time.thread_time() - cpu, 3),
+                # Largest RSS of this process sampled while the stage ran, stages alongside it included
+                'peak_rss_mb': round(rss.peak, 1),
+            })
+            if children:
+                usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+                entry.update({
+                    # CPU time of worker processes that finished during the stage, and the largest of them so far.
+                    # Another children=True stage running at the same time would be counted in both.
+                    'child_cpu_s': round(usage.ru_utime - children_before.ru_utime +
+                                         usage.ru_stime - children_before.ru_stime, 3),
+                    'peak_child_rss_mb': round(rss_mb(usage), 1),
+                })
+            if profiler:
+                profiler.stop()
+                os.makedirs(METRICS_DIRECTORY, exist_ok=True)
+                path = os.path.join(METRICS_DIRECTORY, f"profile-{name.replace('/', '-')}.txt")
+                profiler.write(path)
+                entry['profile'] = path
+                logging.info(f"Wrote {sum(profiler.samples.values())} profile samples of {name} to {path}")
+
+    # Add to a count (rows, features, ...) of the innermost open stage, or of the named one
+    def count(self, key, value, stage=None):
+        counts = self.entry(stage or self.current() or "main")['counts']
+        with self.lock:
+            counts[key] = counts.get(key, 0) + value
+
+    # Per-endpoint request counts, bytes, retries and latencies from a Fetcher's stats
+    def record_requests(self, stats):
+        for endpoint, endpoint_stats in stats.items():
+            self.endpoints[endpoint] = {
+                'requests': endpoint_stats['requests'],
+                'failures': endpoint_stats['failures'],
+                'retries': endpoint_stats['retries'],
+                'bytes': endpoint_stats['bytes'],
+                'latency': latency_summary(endpoint_stats['latencies']),
+            }
+
+    def report(self):
+        return {
+            'started_at': datetime.fromtimestamp(self.started_at).isoformat(timespec='seconds'),
+            'finished_at': datetime.now().isoformat(timespec='seconds'),
+            'stages': self.stages,
+            'endpoints': self.endpoints,
+        }
+
+    # Write the report as latest.json and as a timestamped copy, so nightly runs can be compared
+    def write(self, directory=METRICS_DIRECTORY):
+        os.makedirs(directory, exist_ok=True)
+        report = self.report()
+        stamp = datetime.fromtimestamp(self.started_at).strftime('%Y%m%d-%H%M%S')
+        for name in (f"run-{stamp}.json", "latest.json"):
+            with open(os.path.join(directory, name), 'w', encoding='utf-8') as f:
+                json.dump(report, f, indent=1)
+        logging.info(f"Wrote metrics for {len(self.stages)} stages to {directory}")
+        return report
+
+
+# Shared by every module in the process, so one report covers the whole run
+metrics = Metrics()
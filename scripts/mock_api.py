@@ -0,0 +1,134 @@
+#!/usr/bin/python
+import argparse
+import asyncio
+import json
+import logging
+import random
+import time
+from datetime import datetime
+
+from aiohttp import web
+
+from scripts.raw_store import STORE_PATH, RawStore
+
+# Bodies the real API returns when it has nothing for a request
+EMPTY_RESPONSES = {
+    'GetAllRouteList': {"data": [], "Issuccess": False, "Message": "No Records Found"},
+    'SearchRoute_v2': {"data": [], "Issuccess": False, "Message": "No Records Found"},
+    'RoutePoints': {"data": [], "Issuccess": False, "Message": "No Records Found"},
+    'GetTimetableByRouteid_v3': {"data": [], "Issuccess": False, "Message": "No Records Found"},
+    'SearchByRouteDetails_v4': {"up": {}, "down": {}, "issuccess": False, "message": "Data not found"},
+}
+
+
+# Parse a latency spec such as "fixed:50", "uniform:20:200" or "lognormal:80:0.6" (milliseconds)
+def latency_sampler(spec):
+    kind, *params = spec.split(':')
+    params = [float(param) for param in params]
+    if kind == 'fixed':
+        return lambda: params[0] / 1000
+    if kind == 'uniform':
+        return lambda: random.uniform(params[0], params[1]) / 1000
+    if kind == 'lognormal':
+        median, sigma = params
+        return lambda: random.lognormvariate(0, sigma) * median / 1000
+    raise ValueError(f"Unknown latency distribution: {spec}")
+
+
+# Index the recorded responses by what the WebAPI receives in the request body
+class Recording:
+    def __init__(self, store):
+        self.bodies = {}
+        for endpoint in EMPTY_RESPONSES:
+            for key, day, body in store.iter_raw(endpoint):
+                self.bodies[(endpoint, key, day)] = body
+
+        routes = store.get('GetAllRouteList', 'all') or {"data": []}
+        self.routenos = {route['routeid']: route['routeno'].replace('\t', '') for route in routes['data']}
+        self.route_parents = {}
+        for data in store.load_all('SearchRoute_v2').values():
+            for route in data['data']:
+                self.route_parents[route['routeparentid']] = route['routeno'].replace('\t', '')
+        self.timetable_days = {}
+        for (endpoint, key, day) in self.bodies:
+            if endpoint == 'GetTimetableByRouteid_v3':
+                self.timetable_days.setdefault(key, []).append(day)
+        logging.info(f"Replaying {len(self.bodies)} recorded responses")
+
+    def lookup(self, endpoint, payload):
+        if endpoint == 'GetAllRouteList':
+            return self.bodies.get((endpoint, 'all', ''))
+        if endpoint == 'SearchRoute_v2':
+            return self.bodies.get((endpoint, payload.get('routetext'), ''))
+        if endpoint == 'RoutePoints':
+            return self.bodies.get((endpoint, self.routenos.get(payload.get('routeid')), ''))
+        if endpoint == 'SearchByRouteDetails_v4':
+            return self.bodies.get((endpoint, self.route_parents.get(payload.get('routeid')), ''))
+        if endpoint == 'GetTimetableByRouteid_v3':
+            routeno = self.routenos.get(payload.get('routeid'))
+            days = self.timetable_days.get(routeno)
+            if not days:
+                return None
+            # Serve the recorded day matching the requested date, or any recorded day of that route
+            dow = datetime.strptime(payload['current_date'][:10], "%Y-%m-%d").strftime("%A")
+            return self.bodies.get((endpoint, routeno, dow if dow in days else days[0]))
+        return None
+
+
+# Stand-in for the Namma BMTC WebAPI that replays a raw store with configurable latency and failures
+def create_app(recording, latency='fixed:0', error_rate=0.0, burst_every=0.0, burst_length=0.0):
+    sample_latency = latency_sampler(latency)
+    started = time.monotonic()
+
+    async def handle(request):
+        endpoint = request.match_info['endpoint']
+        if endpoint not in EMPTY_RESPONSES:
+            raise web.HTTPNotFound()
+        body = await request.read()
+        payload = json.loads(body) if body else {}
+
+        await asyncio.sleep(sample_latency())
+
+        # Fail every request inside a burst window, and a random share of the rest
+        elapsed = time.monotonic() - started
+        if burst_every and elapsed % burst_every < burst_length:
+            return web.Response(status=503, text="Service Unavailable")
+        if random.random() < error_rate:
+            return web.Response(status=500, text="Internal Server Error")
+
+        recorded = recording.lookup(endpoint, payload)
+        if recorded is None:
+            return web.json_response(EMPTY_RESPONSES[endpoint])
+        return web.Response(body=recorded, content_type='application/json')
+
+    app = web.Application()
+    app.router.add_post('/WebAPI/{endpoint}', handle)
+    return app
+
+
+def serve(store_path=STORE_PATH, host='127.0.0.1', port=8080, **options):
+    with RawStore(store_path) as store:
+        recording = Recording(store)
+    web.run_app(create_app(recording, **options), host=host, port=port, print=None, access_log=None)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded Namma BMTC WebAPI responses")
+    parser.add_argument('--store', default=STORE_PATH, help="raw store to replay")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', default='fixed:0',
+                        help="fixed:MS, uniform:MIN_MS:MAX_MS or lognormal:MEDIAN_MS:SIGMA")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="share of requests answered with a 500")
+    parser.add_argument('--burst-every', type=float, default=0.0, help="seconds between 503 bursts")
+    parser.add_argument('--burst-length', type=float, default=0.0, help="length of each 503 burst in seconds")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+    logging.info(f"Serving {args.store} on http://{args.host}:{args.port}/WebAPI/")
+    serve(args.store, args.host, args.port, latency=args.latency, error_rate=args.error_rate,
+          burst_every=args.burst_every, burst_length=args.burst_length)
+
+
+if __name__ == "__main__":
+    main()
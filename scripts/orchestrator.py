@@ -1,17 +1,26 @@
+import argparse
 import json
+import logging
 import os
+import shutil
 from datetime import datetime
-from dotenv import load_dotenv
-
-from python_on_whales import DockerClient
+from functools import partial
 
-from scripts import geojson_creator, csv_creator, scrape, gtfs
-
-docker = DockerClient(compose_files=["./docker-compose.yml"])
+from dotenv import load_dotenv
+from python_on_whales import DockerClient, DockerException
 
+from scripts import accessibility, csv_creator, geojson_creator, gtfs, gtfs_minimizer, reachability, scrape
+from scripts.feed import FEED_PATH
+from scripts.metrics import PROFILE_ENV
+from scripts.pipeline import MAX_PARALLEL_STAGES, Pipeline, Stage
+from scripts.raw_store import STORE_PATH, RawStore
 
-# Load environment variables from the .env file
-load_dotenv()
+COMPOSE_FILES = ["./docker-compose.yml"]
+CONFIG_PATH = "bmtc-data/html/config.json"
+# How the tidy stage minimizes the feed; auto uses gtfstidy when docker is available and gtfs_minimizer otherwise
+MINIMIZERS = ["auto", "gtfstidy", "in-process"]
+# Stages that only exist as docker services
+DOCKER_STAGES = ["gtfs-validator", "gtfsvtor", "transport-validator", "html"]
 
 
 # Function to read, edit, and save JSON
@@ -28,14 +37,135 @@ def modify_json(file_path, key, new_value):
         json.dump(data, file, indent=4)
 
 
-config_path = "bmtc-data/html/config.json"
-scrape.main()
-gtfs.main()
-modify_json(config_path, "effectiveDate", datetime.now().strftime("%B %d, %Y"))
-modify_json(config_path, "mapboxAccessToken", os.getenv("MAPBOX_ACCESS_TOKEN"))
-docker.compose.build()
-docker.compose.up()
-docker.compose.down()
-geojson_creator.main()
-csv_creator.main()
-modify_json(config_path, "mapboxAccessToken", "")
+def docker_available():
+    # Without a docker binary python_on_whales would try to download one
+    if shutil.which("docker") is None:
+        return False
+    try:
+        DockerClient(compose_files=COMPOSE_FILES).info()
+        return True
+    except DockerException:
+        return False
+
+
+# Run one docker compose service on its own; the pipeline, not compose's depends_on, decides what runs before it
+def run_service(service):
+    docker = DockerClient(compose_files=COMPOSE_FILES)
+    docker.compose.build([service])
+    docker.compose.run(service, tty=False, dependencies=False, remove=True)
+
+
+def run_scrape(results):
+    return scrape.main()
+
+
+def run_gtfs(results, **options):
+    gtfs.main(**options)
+
+
+def run_tidy(results, minimizer):
+    if minimizer == "gtfstidy":
+        run_service("gtfstidy")
+    else:
+        gtfs_minimizer.minimize(gtfs.GTFS_PATH, FEED_PATH)
+
+
+def run_html(results):
+    modify_json(CONFIG_PATH, "effectiveDate", datetime.now().strftime("%B %d, %Y"))
+    modify_json(CONFIG_PATH, "mapboxAccessToken", os.getenv("MAPBOX_ACCESS_TOKEN"))
+    try:
+        run_service("gtfs-to-html")
+        run_service("html-minifier")
+    finally:
+        modify_json(CONFIG_PATH, "mapboxAccessToken", "")
+
+
+def run_geojson(results):
+    return geojson_creator.main()
+
+
+def run_reachability(results):
+    reachability.main()
+
+
+def run_accessibility(results):
+    accessibility.main()
+
+
+# The exports are written from the layers geojson_creator already holds when it ran in this process, and read
+# back from disk when it was skipped
+def run_exports(results):
+    csv_creator.main(results.get("geojson"))
+
+
+def store_fingerprint():
+    with RawStore() as store:
+        return store.fingerprint()
+
+
+def stages(gtfs_options=None, minimizer="gtfstidy"):
+    gtfs_options = gtfs_options or {}
+    return [
+        # The scraper decides for itself what to refetch, so it runs every time
+        Stage("scrape", run_scrape, outputs=[STORE_PATH]),
+        Stage("gtfs", partial(run_gtfs, **gtfs_options), inputs=[STORE_PATH], outputs=[gtfs.GTFS_PATH],
+              params=gtfs_options, fingerprint=store_fingerprint),
+        Stage("tidy", partial(run_tidy, minimizer=minimizer), inputs=[gtfs.GTFS_PATH], outputs=[FEED_PATH],
+              params={"minimizer": minimizer}),
+        Stage("gtfs-validator", lambda results: run_service("gtfs-validator"), inputs=[FEED_PATH],
+              outputs=["bmtc-data/validation/gtfs-validator"]),
+        Stage("gtfsvtor", lambda results: run_service("gtfsvtor"), inputs=[FEED_PATH],
+              outputs=["bmtc-data/validation/gtfsvtor"]),
+        Stage("transport-validator", lambda results: run_service("transport-validator"), inputs=[FEED_PATH],
+              outputs=["bmtc-data/validation/transport-validator"]),
+        Stage("html", run_html, inputs=[FEED_PATH], outputs=["bmtc-data/html/bmtc"]),
+        Stage("geojson", run_geojson, inputs=[FEED_PATH], outputs=["bmtc-data/geojson", "bmtc-data/tiles",
+                                                                   "bmtc-data/cube"]),
+        Stage("reachability", run_reachability, inputs=[FEED_PATH], outputs=[reachability.REACHABILITY_DIRECTORY]),
+        Stage("accessibility", run_accessibility, inputs=[FEED_PATH, accessibility.AMENITIES_DIRECTORY],
+              outputs=[accessibility.ACCESSIBILITY_DIRECTORY]),
+        Stage("exports", run_exports, inputs=["bmtc-data/geojson"],
+              outputs=[csv_creator.CSV_DIRECTORY, csv_creator.GEOPARQUET_DIRECTORY,
+                       csv_creator.FLATGEOBUF_DIRECTORY]),
+    ]
+
+
+def main(only=None, force=(), max_parallel=MAX_PARALLEL_STAGES, gtfs_options=None, minimizer="auto"):
+    # Load environment variables from the .env file
+    load_dotenv()
+    docker = docker_available()
+    if minimizer == "auto":
+        minimizer = "gtfstidy" if docker else "in-process"
+    pipeline_stages = stages(gtfs_options, minimizer)
+    if not docker:
+        logging.warning(f"Docker is not available, leaving out {', '.join(DOCKER_STAGES)}")
+        pipeline_stages = [stage for stage in pipeline_stages if stage.name not in DOCKER_STAGES]
+        only = [name for name in only or [stage.name for stage in pipeline_stages] if name not in DOCKER_STAGES]
+        force = [name for name in force if name not in DOCKER_STAGES]
+    outcomes = Pipeline(pipeline_stages, max_parallel=max_parallel).run(only, force)
+    return all(outcome in ('ran', 'skipped') for outcome in outcomes.values())
+
+
+if __name__ == "__main__":
+    names = [stage.name for stage in stages()]
+    parser = argparse.ArgumentParser(description="Run the pipeline, skipping stages whose inputs are unchanged")
+    parser.add_argument('stages', nargs='*', metavar='stage',
+                        help=f"stages to run, taking the rest as they are on disk (default: all of {', '.join(names)})")
+    parser.add_argument('--force', nargs='+', default=[], choices=names, metavar='stage',
+                        help="stages to run even if their inputs are unchanged")
+    parser.add_argument('--force-all', action='store_true', help="run every selected stage")
+    parser.add_argument('--parallel', type=int, default=MAX_PARALLEL_STAGES, help="stages to run at once")
+    parser.add_argument('--engine', choices=gtfs.ENGINES, help="GTFS engine for the gtfs stage")
+    parser.add_argument('--profile', nargs='+', default=[], metavar='stage',
+                        help="stages to run under the sampling profiler, written next to the metrics report")
+    parser.add_argument('--minimizer', choices=MINIMIZERS, default="auto",
+                        help="how the tidy stage minimizes the feed (default: gtfstidy if docker is available)")
+    args = parser.parse_args()
+    unknown = set(args.stages) - set(names)
+    if unknown:
+        parser.error(f"unknown stages: {', '.join(sorted(unknown))}")
+    force = (args.stages or names) if args.force_all else args.force
+    if args.profile:
+        os.environ[PROFILE_ENV] = ",".join(args.profile)
+    if not main(args.stages, force, args.parallel, {"engine": args.engine} if args.engine else None, args.minimizer):
+        raise SystemExit(1)
@@ -0,0 +1,202 @@
+import json
+import logging
+import os
+import time
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from scripts.feed import file_hash
+from scripts.manifest import content_hash
+from scripts.metrics import metrics
+
+STATE_PATH = "bmtc-data/pipeline.json"
+# Stages running at once; most of them wait on docker or on their own process pools
+MAX_PARALLEL_STAGES = 4
+
+# One step of the pipeline. run(results) gets the return values of the stages that ran before it in this process,
+# by stage name. Stages depend on the stages whose outputs they list as inputs, and are skipped when neither their
+# inputs nor their params changed since they last succeeded and their outputs are still as they left them.
+# fingerprint, when given, hashes the inputs in place of their file contents; a stage without inputs always runs.
+Stage = namedtuple('Stage', ['name', 'run', 'inputs', 'outputs', 'params', 'fingerprint'],
+                   defaults=[(), (), None, None])
+
+
+# Content hash of a file, or of every file under a directory with their relative paths
+def path_hash(path):
+    if os.path.isfile(path):
+        return file_hash(path)
+    if not os.path.isdir(path):
+        return "missing"
+    entries = []
+    for root, directories, files in os.walk(path):
+        directories.sort()
+        for name in sorted(files):
+            file_path = os.path.join(root, name)
+            entries.append(f"{os.path.relpath(file_path, path)}:{file_hash(file_path)}")
+    return content_hash("\n".join(entries))
+
+
+# Cheap signature of a file or directory tree from sizes and modification times, to notice outputs changed or
+# deleted behind the pipeline's back without hashing them
+def path_signature(path):
+    if os.path.isfile(path):
+        stat = os.stat(path)
+        return f"{stat.st_size}:{stat.st_mtime_ns}"
+    if not os.path.isdir(path):
+        return "missing"
+    entries = []
+    for root, directories, files in os.walk(path):
+        directories.sort()
+        for name in sorted(files):
+            file_path = os.path.join(root, name)
+            entries.append(f"{os.path.relpath(file_path, path)}:{path_signature(file_path)}")
+    return content_hash("\n".join(entries))
+
+
+def overlaps(first, second):
+    first, second = os.path.normpath(first), os.path.normpath(second)
+    return first == second or first.startswith(second + os.sep) or second.startswith(first + os.sep)
+
+
+# What each stage has finished with, kept across runs so an interrupted pipeline resumes where it stopped
+class State:
+    def __init__(self, path=STATE_PATH):
+        self.path = path
+        self.entries = {}
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            with open(path, 'r', encoding='utf-8') as f:
+                self.entries = json.load(f)
+
+    def get(self, name):
+        return self.entries.get(name)
+
+    def record(self, name, inputs, outputs, duration):
+        self.entries[name] = {'inputs': inputs, 'outputs': outputs, 'finished_at': time.time(),
+                              'duration': round(duration, 3)}
+        self.save()
+
+    def forget(self, name):
+        if self.entries.pop(name, None) is not None:
+            self.save()
+
+    def save(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.entries, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+
+class Pipeline:
+    def __init__(self, stages, state_path=STATE_PATH, max_parallel=MAX_PARALLEL_STAGES):
+        self.stages = {stage.name: stage for stage in stages}
+        if len(self.stages) != len(stages):
+            raise ValueError("Stage names must be unique")
+        self.state = State(state_path)
+        self.max_parallel = max_parallel
+        self.results = {}
+        self.upstream = {stage.name: {other.name for other in stages if other.name != stage.name and
+                                      any(overlaps(path, output) for path in stage.inputs for output in other.outputs)}
+                         for stage in stages}
+        self.check_acyclic()
+
+    def check_acyclic(self):
+        visiting, done = set(), set()
+
+        def visit(name):
+            if name in done:
+                return
+            if name in visiting:
+                raise ValueError(f"Stage {name} depends on itself")
+            visiting.add(name)
+            for upstream in self.upstream[name]:
+                visit(upstream)
+            visiting.discard(name)
+            done.add(name)
+
+        for name in self.stages:
+            visit(name)
+
+    def input_hash(self, stage):
+        if stage.fingerprint is not None:
+            inputs = stage.fingerprint()
+        else:
+            inputs = {path: path_hash(path) for path in stage.inputs}
+        return content_hash(json.dumps([inputs, stage.params], sort_keys=True, default=str))
+
+    def output_signature(self, stage):
+        return content_hash(json.dumps({path: path_signature(path) for path in stage.outputs}, sort_keys=True))
+
+    # Whether a stage's last successful run still stands, returns (up to date, input hash)
+    def up_to_date(self, stage):
+        if not stage.inputs and stage.fingerprint is None:
+            return False, None
+        inputs = self.input_hash(stage)
+        entry = self.state.get(stage.name)
+        return (entry is not None and entry['inputs'] == inputs and
+                entry['outputs'] == self.output_signature(stage)), inputs
+
+    def execute(self, stage, inputs):
+        start = time.monotonic()
+        logging.info(f"Running stage {stage.name}")
+        with metrics.stage(stage.name):
+            result = stage.run(self.results)
+        return result, inputs, time.monotonic() - start
+
+    # Run the selected stages (all by default) in dependency order, as many at once as their dependencies allow.
+    # Forced stages run even when up to date. Stages left out of the selection are taken as they are on disk.
+    # Returns {stage: 'ran', 'skipped', 'failed' or 'blocked'}.
+    def run(self, only=None, force=()):
+        selected = set(self.stages) if not only else set(only)
+        unknown = (selected | set(force)) - set(self.stages)
+        if unknown:
+            raise ValueError(f"Unknown stages: {', '.join(sorted(unknown))}")
+        for name in force:
+            self.state.forget(name)
+
+        outcomes = {}
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.max_parallel) as executor:
+            while True:
+                for name in self.stages:
+                    if name not in selected or name in outcomes or name in running.values():
+                        continue
+                    upstream = self.upstream[name] & selected
+                    if any(outcomes.get(other) in ('failed', 'blocked') for other in upstream):
+                        outcomes[name] = 'blocked'
+                        logging.error(f"Not running stage {name}: a stage it needs failed")
+                    elif all(other in outcomes for other in upstream):
+                        stage = self.stages[name]
+                        current, inputs = self.up_to_date(stage)
+                        if current:
+                            outcomes[name] = 'skipped'
+                            logging.info(f"Skipping stage {name}: inputs unchanged since its last run")
+                        else:
+                            running[executor.submit(self.execute, stage, inputs)] = name
+                if not running:
+                    break
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    stage = self.stages[name]
+                    try:
+                        result, inputs, duration = future.result()
+                    except Exception:
+                        outcomes[name] = 'failed'
+                        self.state.forget(name)
+                        logging.exception(f"Stage {name} failed")
+                        continue
+                    self.results[name] = result
+                    outcomes[name] = 'ran'
+                    if inputs is not None:
+                        self.state.record(name, inputs, self.output_signature(stage), duration)
+                    logging.info(f"Finished stage {name} in {duration:.1f}s")
+
+        logging.info("Pipeline: " + ", ".join(f"{name} {outcomes.get(name, 'not selected')}" for name in self.stages))
+        for name, outcome in outcomes.items():
+            metrics.entry(name)['outcome'] = outcome
+        metrics.write()
+        return outcomes
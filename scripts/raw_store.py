@@ -0,0 +1,204 @@
+import hashlib
+import json
+import logging
+import queue
+import sqlite3
+import threading
+import zlib
+
+from scripts.manifest import content_hash
+
+STORE_PATH = "bmtc-data/raw/raw.db"
+# Number of writes the background writer groups into one transaction
+WRITE_BATCH_SIZE = 200
+# SQLite's default limit on bound parameters is 999, so hash lookups are chunked below it
+LOOKUP_CHUNK_SIZE = 500
+
+# Parsed responses by content hash, shared by every store in this process so a response the scraper
+# already parsed is handed to gtfs.py as is instead of being decompressed and parsed again.
+# Consumers must treat these objects as read-only.
+parsed_responses = {}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS blobs (
+    hash TEXT PRIMARY KEY,
+    body BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS responses (
+    endpoint TEXT NOT NULL,
+    key TEXT NOT NULL,
+    day TEXT NOT NULL DEFAULT '',
+    hash TEXT NOT NULL REFERENCES blobs (hash),
+    PRIMARY KEY (endpoint, key, day)
+);
+"""
+
+
+# Single-file store of raw API responses, keyed by endpoint/route/day with zlib-compressed bodies.
+# Bodies are content-addressed, so identical responses are only stored once.
+class RawStore:
+    def __init__(self, path=STORE_PATH):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def put(self, endpoint, key, body, day='', parsed=None):
+        digest = content_hash(body)
+        if parsed is not None:
+            parsed_responses[digest] = parsed
+        with self.connection:
+            write_response(self.connection, endpoint, key, day, body, digest)
+        return digest
+
+    # Background writer for the scraper, so compression and inserts stay off the event loop
+    def writer(self):
+        return StoreWriter(self.path)
+
+    def delete(self, endpoint, key, day=''):
+        with self.connection:
+            self.connection.execute("DELETE FROM responses WHERE endpoint = ? AND key = ? AND day = ?",
+                                    (endpoint, key, day))
+
+    def has(self, endpoint, key, day=''):
+        row = self.connection.execute("SELECT 1 FROM responses WHERE endpoint = ? AND key = ? AND day = ?",
+                                      (endpoint, key, day)).fetchone()
+        return row is not None
+
+    def get(self, endpoint, key, day=''):
+        row = self.connection.execute("SELECT hash FROM responses WHERE endpoint = ? AND key = ? AND day = ?",
+                                      (endpoint, key, day)).fetchone()
+        return self.parse([row[0]])[row[0]] if row else None
+
+    # Return {hash: parsed response}, decompressing and parsing only hashes not already parsed in-process
+    def parse(self, digests):
+        missing = list({digest for digest in digests if digest not in parsed_responses})
+        for start in range(0, len(missing), LOOKUP_CHUNK_SIZE):
+            chunk = missing[start:start + LOOKUP_CHUNK_SIZE]
+            query = f"SELECT hash, body FROM blobs WHERE hash IN ({', '.join('?' * len(chunk))})"
+            for digest, body in self.connection.execute(query, chunk):
+                parsed_responses[digest] = json.loads(zlib.decompress(body))
+        return {digest: parsed_responses[digest] for digest in digests}
+
+    # Yield (key, day, raw bytes) for every response of an endpoint, optionally for a single day
+    def iter_raw(self, endpoint, day=None):
+        query = ("SELECT r.key, r.day, b.body FROM responses r JOIN blobs b ON b.hash = r.hash "
+                 "WHERE r.endpoint = ?")
+        params = [endpoint]
+        if day is not None:
+            query += " AND r.day = ?"
+            params.append(day)
+        for key, row_day, body in self.connection.execute(query + " ORDER BY r.day, r.key", params):
+            yield key, row_day, zlib.decompress(body)
+
+    # Return {key: parsed response} for an endpoint in one query
+    def load_all(self, endpoint, day=None):
+        query = "SELECT key, hash FROM responses WHERE endpoint = ?"
+        params = [endpoint]
+        if day is not None:
+            query += " AND day = ?"
+            params.append(day)
+        rows = self.connection.execute(query + " ORDER BY day, key", params).fetchall()
+        parsed = self.parse([digest for _, digest in rows])
+        return {key: parsed[digest] for key, digest in rows}
+
+    # Return {day: {key: parsed response}} for an endpoint stored per day
+    def load_by_day(self, endpoint):
+        rows = self.connection.execute("SELECT day, key, hash FROM responses WHERE endpoint = ? ORDER BY day, key",
+                                       (endpoint,)).fetchall()
+        parsed = self.parse([digest for _, _, digest in rows])
+        responses = {}
+        for day, key, digest in rows:
+            responses.setdefault(day, {})[key] = parsed[digest]
+        return responses
+
+    # Hash of which body every endpoint/key/day points at, which only changes when a response's content does
+    def fingerprint(self):
+        digest = hashlib.sha256()
+        for row in self.connection.execute("SELECT endpoint, key, day, hash FROM responses "
+                                           "ORDER BY endpoint, key, day"):
+            digest.update(("\0".join(row) + "\n").encode('utf-8'))
+        return digest.hexdigest()
+
+    # Drop blobs no response points at any more
+    def vacuum_blobs(self):
+        with self.connection:
+            removed = self.connection.execute(
+                "DELETE FROM blobs WHERE hash NOT IN (SELECT hash FROM responses)").rowcount
+        logging.info(f"Removed {removed} unreferenced blobs from {self.path}")
+
+
+def write_response(connection, endpoint, key, day, body, digest):
+    connection.execute("INSERT OR IGNORE INTO blobs (hash, body) VALUES (?, ?)", (digest, zlib.compress(body)))
+    connection.execute("INSERT OR REPLACE INTO responses (endpoint, key, day, hash) VALUES (?, ?, ?, ?)",
+                       (endpoint, key, day, digest))
+
+
+# Streams responses into the store from a worker thread with its own connection, committing in batches
+class StoreWriter:
+    def __init__(self, path, batch_size=WRITE_BATCH_SIZE):
+        self.path = path
+        self.batch_size = batch_size
+        self.queue = queue.Queue()
+        self.error = None
+        self.thread = threading.Thread(target=self.run, name="raw-store-writer", daemon=True)
+        self.thread.start()
+
+    def put(self, endpoint, key, body, day='', parsed=None):
+        digest = content_hash(body)
+        if parsed is not None:
+            parsed_responses[digest] = parsed
+        self.queue.put(('put', endpoint, key, day, body, digest))
+
+    def delete(self, endpoint, key, day=''):
+        self.queue.put(('delete', endpoint, key, day, None, None))
+
+    # Block until everything queued so far is committed
+    def flush(self):
+        self.queue.join()
+        if self.error:
+            raise self.error
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.error:
+            raise self.error
+
+    def run(self):
+        connection = sqlite3.connect(self.path)
+        pending = 0
+        try:
+            while True:
+                item = self.queue.get()
+                try:
+                    if item is None:
+                        break
+                    action, endpoint, key, day, body, digest = item
+                    if action == 'put':
+                        write_response(connection, endpoint, key, day, body, digest)
+                    else:
+                        connection.execute("DELETE FROM responses WHERE endpoint = ? AND key = ? AND day = ?",
+                                           (endpoint, key, day))
+                    pending += 1
+                    if pending >= self.batch_size or self.queue.qsize() == 0:
+                        connection.commit()
+                        pending = 0
+                except Exception as err:
+                    logging.error(f"Failed to write to {self.path}: {err!r}")
+                    self.error = err
+                finally:
+                    self.queue.task_done()
+        finally:
+            connection.commit()
+            connection.close()
@@ -0,0 +1,299 @@
+import argparse
+import json
+import logging
+import math
+import os
+from bisect import bisect_left
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from functools import partial
+
+import numpy as np
+import pandas as pd
+import shapely
+from geojson import dump
+
+from scripts.feed import FEED_PATH, frequency_starts, load_feed, service_date, service_ids
+from scripts.geometry import from_plane
+from scripts.metrics import metrics
+from scripts.spatial_index import GridIndex
+from scripts.trip_builder import parse_time
+
+REACHABILITY_DIRECTORY = "bmtc-data/reachability"
+# Default query: leaving at 8am, for up to 45 minutes
+DEPARTURE = 8 * 3600
+TIME_BUDGET = 45 * 60
+# Stops this close are connected by walking, in metres, at WALK_SPEED metres per second
+TRANSFER_RADIUS = 400.0
+WALK_SPEED = 1.2
+# Travel times are stored as whole minutes in a byte, this one meaning out of reach
+UNREACHABLE = 255
+# Sources per task handed to a worker process
+SOURCES_PER_TASK = 64
+
+
+# The timetable of one service day as flat arrays: connections (one vehicle going from a stop to the next one)
+# sorted by departure, and walking transfers between nearby stops as a CSR adjacency list (the transfers of stop i are
+# transfer_stops[transfer_offsets[i]:transfer_offsets[i + 1]]). Stops are numbered by their position in stop_ids.
+class Timetable:
+    def __init__(self, stop_ids, stop_names, lats, lons, connections, transfers):
+        self.stop_ids = stop_ids
+        self.stop_names = stop_names
+        self.lats = lats
+        self.lons = lons
+        self.departure_stops, self.arrival_stops, self.departure_times, self.arrival_times, self.trips = connections
+        self.transfer_offsets, self.transfer_stops, self.transfer_times = transfers
+        self._lists = None
+
+    def __len__(self):
+        return len(self.stop_ids)
+
+    # The same arrays as Python lists, which the scan indexes one element at a time far faster than NumPy arrays
+    def lists(self):
+        if self._lists is None:
+            self._lists = tuple(array.tolist() for array in (
+                self.departure_stops, self.arrival_stops, self.departure_times, self.arrival_times, self.trips,
+                self.transfer_offsets, self.transfer_stops, self.transfer_times))
+        return self._lists
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_lists'] = None
+        return state
+
+
+# Connections between consecutive timed stops of each trip, as a DataFrame. Stop times without a time are passed
+# over, so a trip connects the timed stops on either side of them.
+def trip_connections(stop_times, trips, stop_index):
+    timed = (stop_times['trip_id'].astype(str).isin(trips) & (stop_times['arrival_time'] >= 0) &
+             (stop_times['departure_time'] >= 0))
+    stop_times = stop_times.loc[timed]
+    trip_codes, trip_ids = pd.factorize(stop_times['trip_id'].astype(str))
+    order = np.lexsort((stop_times['stop_sequence'].to_numpy(), trip_codes))
+    trip_codes = trip_codes[order]
+    stops = stop_index.get_indexer(stop_times['stop_id'].astype(str))[order]
+    arrivals = stop_times['arrival_time'].to_numpy()[order]
+    departures = stop_times['departure_time'].to_numpy()[order]
+
+    pairs = np.flatnonzero(trip_codes[1:] == trip_codes[:-1])
+    connections = pd.DataFrame({'departure_stop': stops[pairs], 'arrival_stop': stops[pairs + 1],
+                                'departure_time': departures[pairs], 'arrival_time': arrivals[pairs + 1],
+                                'trip': trip_codes[pairs]})
+    connections = connections.loc[(connections['departure_stop'] >= 0) & (connections['arrival_stop'] >= 0)]
+    return connections.reset_index(drop=True), trip_ids
+
+
+# Trips run at a headway in frequencies.txt are templates: each start time gets a copy of the template's
+# connections, shifted to that start and numbered as a trip of its own
+def expand_frequencies(connections, trip_ids, template_starts):
+    positions = trip_ids.get_indexer(list(template_starts))
+    if not (positions >= 0).any():
+        return connections
+    templates = connections.groupby('trip').indices
+    next_trip = len(trip_ids)
+    copies = []
+    for trip, starts in zip(positions, template_starts.values()):
+        if trip not in templates:
+            continue
+        template = connections.iloc[templates[trip]]
+        shifts = np.repeat(starts - template['departure_time'].min(), len(template))
+        copy = template.iloc[np.tile(np.arange(len(template)), len(starts))].copy()
+        copy['departure_time'] += shifts
+        copy['arrival_time'] += shifts
+        copy['trip'] = next_trip + np.repeat(np.arange(len(starts)), len(template))
+        next_trip += len(starts)
+        copies.append(copy)
+    connections = connections.loc[~connections['trip'].isin(positions)]
+    return pd.concat([connections] + copies, ignore_index=True)
+
+
+# Walking transfers both ways between every pair of stops within radius metres, in CSR form
+def walking_transfers(lats, lons, radius=TRANSFER_RADIUS, speed=WALK_SPEED):
+    firsts, seconds, distances = GridIndex(lats, lons).pairs_within(radius)
+    sources = np.concatenate([firsts, seconds])
+    targets = np.concatenate([seconds, firsts])
+    times = np.ceil(np.concatenate([distances, distances]) / speed).astype(np.int64)
+    order = np.argsort(sources, kind='stable')
+    offsets = np.searchsorted(sources[order], np.arange(len(lats) + 1))
+    return offsets, targets[order], times[order]
+
+
+def build_timetable(feed, day, radius=TRANSFER_RADIUS, speed=WALK_SPEED):
+    # Parent stations have no stop times; riders walk to and from their platforms
+    stops = feed.stops
+    if 'location_type' in stops.columns:
+        stops = stops.loc[stops['location_type'].fillna(0) != 1]
+    stop_ids = stops['stop_id'].astype(str).to_numpy()
+    lats, lons = stops['stop_lat'].to_numpy(), stops['stop_lon'].to_numpy()
+
+    trips = feed.trips
+    day_trips = set(trips.loc[trips['service_id'].astype(str).isin(service_ids(feed, day)), 'trip_id'].astype(str))
+    connections, trip_ids = trip_connections(feed.stop_times, day_trips, pd.Index(stop_ids))
+    connections = expand_frequencies(connections, trip_ids, frequency_starts(feed))
+    connections = connections.sort_values('departure_time', kind='stable')
+    transfers = walking_transfers(lats, lons, radius, speed)
+
+    logging.info(f"Built the timetable of {day:%Y-%m-%d}: {len(connections)} connections of "
+                 f"{connections['trip'].nunique()} trips, {len(transfers[1])} walking transfers "
+                 f"between {len(stop_ids)} stops")
+    metrics.count("connections", len(connections))
+    metrics.count("transfers", len(transfers[1]))
+    columns = ['departure_stop', 'arrival_stop', 'departure_time', 'arrival_time', 'trip']
+    return Timetable(stop_ids, stops['stop_name'].astype(str).to_numpy(), lats, lons,
+                     tuple(connections[column].to_numpy(dtype=np.int64) for column in columns), transfers)
+
+
+# Earliest arrival at every stop from a source stop leaving at departure, by one connection scan over the
+# connections departing within the budget. A connection is usable when its trip was already boarded or its stop is
+# reached by the time it leaves; walks only start where a vehicle (or the source) left the rider. Returns arrival
+# times in seconds, math.inf where nothing arrives.
+def earliest_arrivals(timetable, source, departure, budget):
+    (departure_stops, arrival_stops, departure_times, arrival_times, trips,
+     transfer_offsets, transfer_stops, transfer_times) = timetable.lists()
+    arrival = [math.inf] * len(timetable)
+    arrival[source] = departure
+    for transfer in range(transfer_offsets[source], transfer_offsets[source + 1]):
+        arrival[transfer_stops[transfer]] = min(arrival[transfer_stops[transfer]], departure + transfer_times[transfer])
+
+    alighted = [math.inf] * len(timetable)
+    boarded = set()
+    limit = departure + budget
+    for connection in range(bisect_left(departure_times, departure), len(departure_times)):
+        leaves = departure_times[connection]
+        if leaves > limit:
+            break
+        trip = trips[connection]
+        if trip in boarded or arrival[departure_stops[connection]] <= leaves:
+            boarded.add(trip)
+            stop, arrives = arrival_stops[connection], arrival_times[connection]
+            # Walks are not chained, so a stop first reached on foot still walks on from its earliest vehicle arrival
+            if arrives < alighted[stop]:
+                alighted[stop] = arrives
+                if arrives < arrival[stop]:
+                    arrival[stop] = arrives
+                for transfer in range(transfer_offsets[stop], transfer_offsets[stop + 1]):
+                    walked = arrives + transfer_times[transfer]
+                    if walked < arrival[transfer_stops[transfer]]:
+                        arrival[transfer_stops[transfer]] = walked
+    return arrival
+
+
+# Whole minutes from departure to each stop, UNREACHABLE beyond the budget
+def travel_minutes(arrival, departure, budget):
+    seconds = np.asarray(arrival, dtype=float) - departure
+    minutes = np.full(len(seconds), UNREACHABLE, dtype=np.uint8)
+    reached = seconds <= budget
+    minutes[reached] = seconds[reached] // 60
+    return minutes
+
+
+_timetable = None
+
+
+def init_worker(timetable):
+    global _timetable
+    _timetable = timetable
+
+
+def minutes_from(sources, departure, budget):
+    return np.stack([travel_minutes(earliest_arrivals(_timetable, source, departure, budget), departure, budget)
+                     for source in sources])
+
+
+# Travel minutes from every stop to every stop, as a stops × stops byte matrix, queries spread over processes
+def travel_times(timetable, departure=DEPARTURE, budget=TIME_BUDGET, workers=None):
+    if budget // 60 >= UNREACHABLE:
+        raise ValueError(f"A time budget of {budget // 60} minutes does not fit in a byte")
+    workers = workers or os.cpu_count() or 1
+    tasks = [range(start, min(start + SOURCES_PER_TASK, len(timetable)))
+             for start in range(0, len(timetable), SOURCES_PER_TASK)]
+    query = partial(minutes_from, departure=departure, budget=budget)
+    if workers == 1 or len(tasks) < 2:
+        init_worker(timetable)
+        rows = [query(task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(timetable,)) as executor:
+            rows = list(executor.map(query, tasks))
+    metrics.count("queries", len(timetable))
+    return np.concatenate(rows) if rows else np.zeros((0, 0), dtype=np.uint8)
+
+
+# The area reachable from a stop: every stop reached within the budget, with a walk around it for the time left,
+# capped at the transfer radius. Returns a FeatureCollection of the area followed by the stops and their minutes.
+def isochrone(timetable, source, departure=DEPARTURE, budget=TIME_BUDGET, radius=TRANSFER_RADIUS, speed=WALK_SPEED):
+    arrival = np.asarray(earliest_arrivals(timetable, source, departure, budget), dtype=float)
+    reached = np.flatnonzero(arrival <= departure + budget)
+    index = GridIndex(timetable.lats[reached], timetable.lons[reached])
+    distances = np.minimum((departure + budget - arrival[reached]) * speed, radius)
+    area = shapely.union_all(shapely.buffer(shapely.points(index.x, index.y), distances))
+    area = shapely.transform(area, lambda xy: np.stack(
+        from_plane(xy[:, 0] / 1000, xy[:, 1] / 1000, index.origin_lat)[::-1], axis=1))
+
+    minutes = travel_minutes(arrival[reached], departure, budget)
+    features = [{"type": "Feature", "geometry": json.loads(shapely.to_geojson(area)),
+                 "properties": {"id": timetable.stop_ids[source], "name": timetable.stop_names[source],
+                                "departure": departure, "budget": budget // 60}}]
+    features += [{"type": "Feature",
+                  "geometry": {"type": "Point",
+                               "coordinates": [float(timetable.lons[stop]), float(timetable.lats[stop])]},
+                  "properties": {"id": timetable.stop_ids[stop], "name": timetable.stop_names[stop],
+                                 "minutes": int(stop_minutes)}}
+                 for stop, stop_minutes in zip(reached.tolist(), minutes.tolist())]
+    return {"type": "FeatureCollection", "features": features}
+
+
+# The travel time matrix, and a layer of stops with how many others each reaches within the budget
+def write_reachability(timetable, minutes, day, departure, budget, directory=REACHABILITY_DIRECTORY):
+    os.makedirs(directory, exist_ok=True)
+    np.savez_compressed(os.path.join(directory, "travel_times.npz"), stop_ids=timetable.stop_ids.astype(str),
+                        minutes=minutes, date=day.strftime("%Y%m%d"), departure=departure, budget=budget)
+    reachable = (minutes != UNREACHABLE).sum(axis=1) - 1
+    features = [{"type": "Feature", "geometry": {"type": "Point", "coordinates": [lon, lat]},
+                 "properties": {"id": stop_id, "name": name, "reachable_count": count}}
+                for stop_id, name, lat, lon, count in zip(timetable.stop_ids.tolist(), timetable.stop_names.tolist(),
+                                                          timetable.lats.tolist(), timetable.lons.tolist(),
+                                                          reachable.tolist())]
+    with open(os.path.join(directory, "reachability.geojson"), 'w') as f:
+        dump({"type": "FeatureCollection", "features": features}, f)
+    logging.info(f"Wrote travel times between {len(timetable)} stops to {directory}")
+
+
+def main(day=None, departure=DEPARTURE, budget=TIME_BUDGET, workers=None, feed_path=FEED_PATH):
+    feed = load_feed(feed_path)
+    day = service_date(feed, day)
+    with metrics.stage("timetable"):
+        timetable = build_timetable(feed, day)
+    with metrics.stage("queries", children=True):
+        minutes = travel_times(timetable, departure, budget, workers)
+    write_reachability(timetable, minutes, day, departure, budget)
+    return minutes
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+    parser = argparse.ArgumentParser(description="Travel times between all stops, or the isochrone of one stop")
+    parser.add_argument('--date', type=lambda value: datetime.strptime(value, "%Y-%m-%d").date(),
+                        help="service date as YYYY-MM-DD (default: today, or the feed's first day of service)")
+    parser.add_argument('--at', type=parse_time, default=DEPARTURE, help="departure time as HH:MM (default: 08:00)")
+    parser.add_argument('--within', type=int, default=TIME_BUDGET // 60, help="time budget in minutes")
+    parser.add_argument('--workers', type=int, help="processes running queries (default: one per CPU)")
+    parser.add_argument('--from', dest='source', metavar='stop_id',
+                        help="write the isochrone of this stop instead of the all-stops matrix")
+    parser.add_argument('--output', help="isochrone GeoJSON path (default: isochrone-<stop_id>.geojson here)")
+    parser.add_argument('--feed', default=FEED_PATH)
+    args = parser.parse_args()
+
+    if args.source is None:
+        with metrics.stage("reachability"):
+            main(args.date, args.at, args.within * 60, args.workers, args.feed)
+        metrics.write()
+    else:
+        feed = load_feed(args.feed)
+        timetable = build_timetable(feed, service_date(feed, args.date))
+        sources = np.flatnonzero(timetable.stop_ids == args.source)
+        if not len(sources):
+            parser.error(f"unknown stop {args.source}")
+        output = args.output or f"isochrone-{args.source}.geojson"
+        with open(output, 'w') as f:
+            dump(isochrone(timetable, int(sources[0]), args.at, args.within * 60), f)
+        logging.info(f"Wrote the isochrone of stop {args.source} to {output}")
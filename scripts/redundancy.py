@@ -0,0 +1,153 @@
+import argparse
+import logging
+
+import numpy as np
+import pandas as pd
+
+from scripts.feed import FEED_PATH, load_feed
+from scripts.geometry import to_plane
+from scripts.spatial_index import cell_key
+from scripts.tiles import write_layer
+
+REDUNDANCY_PATH = "bmtc-data/geojson/redundancy.geojson"
+# Shapes are sampled every SAMPLE_SPACING metres, and samples snapped to a grid of CELL_SIZE metres. Two routes
+# share a stretch of road where one's sample falls in the 2 × 2 cells nearest to the other's, which matches shapes
+# drawn up to about 35 metres apart along one road.
+SAMPLE_SPACING = 20.0
+CELL_SIZE = 30.0
+# Routes sharing less than this fraction of a route direction are left out of its list of overlapping routes
+MIN_SHARED = 0.1
+# Overlap histogram buckets: the length served by 0, 1, ... other routes, the last bucket holding this many or more
+MAX_OVERLAP = 10
+# Route directions compared at once, bounding the size of the sample-to-route join
+DIRECTIONS_PER_CHUNK = 256
+
+
+# One row per route and direction, with the shape most of its trips follow
+def route_directions(feed):
+    trips = feed.trips.astype({'route_id': str, 'shape_id': str})
+    if 'direction_id' not in trips.columns:
+        trips = trips.assign(direction_id=0)
+    trips = trips.assign(direction_id=trips['direction_id'].fillna(0).astype(int))
+    shape_trips = trips.loc[trips['shape_id'] != ""].groupby(['route_id', 'direction_id', 'shape_id']).size()
+    directions = (shape_trips.reset_index(name='trips').sort_values('trips', ascending=False, kind='stable')
+                  .drop_duplicates(['route_id', 'direction_id']).sort_values(['route_id', 'direction_id'])
+                  .reset_index(drop=True))
+    routes = feed.routes
+    names = dict(zip(routes['route_id'].astype(str), routes['route_short_name'].astype(str)))
+    return directions.assign(name=directions['route_id'].map(names))
+
+
+# Points every `spacing` metres along each shape (at the middle of each stretch), in one pass over all shapes.
+# Returns the shape position, plane coordinates and length represented by every sample, and the shape points
+# (lon, lat) by shape position.
+def sample_shapes(shapes, shape_ids, origin_lat, spacing=SAMPLE_SPACING):
+    shapes = shapes.loc[shapes['shape_id'].astype(str).isin(shape_ids)]
+    positions = pd.Index(shape_ids).get_indexer(shapes['shape_id'].astype(str))
+    order = np.lexsort((shapes['shape_pt_sequence'].to_numpy(), positions))
+    positions = positions[order]
+    lats, lons = shapes['shape_pt_lat'].to_numpy()[order], shapes['shape_pt_lon'].to_numpy()[order]
+    x, y = to_plane(lats, lons, origin_lat)
+    x, y = x * 1000, y * 1000
+
+    # Distance along every shape, laid end to end, so one np.interp samples them all
+    steps = np.hypot(np.diff(x), np.diff(y)) * (positions[1:] == positions[:-1])
+    along = np.concatenate([[0.0], np.cumsum(steps)])
+    starts = np.searchsorted(positions, np.arange(len(shape_ids)))
+    ends = np.searchsorted(positions, np.arange(len(shape_ids)), side='right')
+    present = ends > starts
+    lengths = np.where(present, along[np.maximum(ends - 1, 0)] - along[np.minimum(starts, len(along) - 1)], 0.0)
+    counts = np.where(present, np.maximum(np.ceil(lengths / spacing), 1), 0).astype(np.int64)
+
+    sample_shapes = np.repeat(np.arange(len(shape_ids)), counts)
+    first_sample = np.repeat(np.cumsum(counts) - counts, counts)
+    offsets = (np.arange(counts.sum()) - first_sample) * spacing
+    sample_lengths = np.minimum(spacing, lengths[sample_shapes] - offsets)
+    middles = along[starts[sample_shapes]] + offsets + sample_lengths / 2
+    points = {position: np.stack([lons[start:end], lats[start:end]], axis=1)
+              for position, (start, end) in enumerate(zip(starts, ends)) if end > start}
+    return sample_shapes, np.interp(middles, along, x), np.interp(middles, along, y), sample_lengths, points
+
+
+# How much of each route direction other routes run along, and which ones, as one feature per route direction
+def route_redundancy(feed, spacing=SAMPLE_SPACING, cell_size=CELL_SIZE, min_shared=MIN_SHARED):
+    directions = route_directions(feed)
+    shape_ids = directions['shape_id'].unique().tolist()
+    origin_lat = float(feed.shapes['shape_pt_lat'].mean())
+    shape_samples, x, y, lengths, points = sample_shapes(feed.shapes, shape_ids, origin_lat, spacing)
+
+    # Samples of each direction, through the shape it follows
+    sample_order = np.argsort(shape_samples, kind='stable')
+    shape_starts = np.searchsorted(shape_samples[sample_order], np.arange(len(shape_ids) + 1))
+    direction_shapes = pd.Index(shape_ids).get_indexer(directions['shape_id'])
+    route_codes, route_ids = pd.factorize(directions['route_id'])
+    sample_rows = [sample_order[shape_starts[shape]:shape_starts[shape + 1]] for shape in direction_shapes]
+    sample_directions = np.repeat(np.arange(len(directions)), [len(rows) for rows in sample_rows])
+    sample_rows = np.concatenate(sample_rows) if sample_rows else np.array([], dtype=np.int64)
+    samples = pd.DataFrame({'direction': sample_directions, 'route': route_codes[sample_directions],
+                            'x': x[sample_rows], 'y': y[sample_rows], 'length': lengths[sample_rows]})
+
+    # Cells each route passes through, and for every sample the 2 × 2 block of cells nearest to it
+    cells_x = np.floor(samples['x'].to_numpy() / cell_size)
+    cells_y = np.floor(samples['y'].to_numpy() / cell_size)
+    occupied = pd.DataFrame({'key': cell_key(cells_x, cells_y), 'other': samples['route']}).drop_duplicates()
+    half = cell_size / 2
+    lows_x = np.floor((samples['x'].to_numpy() - half) / cell_size)
+    lows_y = np.floor((samples['y'].to_numpy() - half) / cell_size)
+
+    direction_lengths = samples.groupby('direction')['length'].sum().reindex(range(len(directions)), fill_value=0.0)
+    overlap = np.zeros((len(directions), MAX_OVERLAP + 1))
+    shared = []
+    for first in range(0, len(directions), DIRECTIONS_PER_CHUNK):
+        chunk = samples.loc[(samples['direction'] >= first) & (samples['direction'] < first + DIRECTIONS_PER_CHUNK)]
+        rows = chunk.index.to_numpy()
+        queries = pd.concat([pd.DataFrame({'sample': rows, 'route': chunk['route'].to_numpy(),
+                                           'key': cell_key(lows_x[rows] + dx, lows_y[rows] + dy)})
+                             for dx in (0, 1) for dy in (0, 1)])
+        hits = queries.merge(occupied, on='key')
+        hits = hits.loc[hits['other'] != hits['route'], ['sample', 'other']].drop_duplicates()
+        hits = hits.join(chunk[['direction', 'length']], on='sample')
+        shared.append(hits.groupby(['direction', 'other'])['length'].sum())
+
+        others = hits.groupby('sample').size().reindex(chunk.index, fill_value=0).clip(upper=MAX_OVERLAP)
+        np.add.at(overlap, (chunk['direction'].to_numpy(), others.to_numpy()), chunk['length'].to_numpy())
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        overlap = np.nan_to_num(overlap / direction_lengths.to_numpy()[:, None])
+    shared = pd.concat(shared) if shared else pd.Series(dtype=float)
+    shared = (shared / direction_lengths.reindex(shared.index.get_level_values('direction')).to_numpy()).rename('share')
+    shared = shared.loc[shared >= min_shared].reset_index().sort_values(['direction', 'share'],
+                                                                        ascending=[True, False], kind='stable')
+    names = dict(zip(directions['route_id'], directions['name']))
+    shared_routes = {direction: ([names[route_ids[other]] for other in group['other']],
+                                 group['share'].round(3).tolist())
+                     for direction, group in shared.groupby('direction')}
+
+    logging.info(f"Compared {len(directions)} route directions over {len(samples)} samples and "
+                 f"{len(occupied)} occupied cells")
+    for direction, row in enumerate(directions.itertuples()):
+        fractions = overlap[direction]
+        overlapping, shares = shared_routes.get(direction, ([], []))
+        properties = {"name": row.name, "id": row.route_id, "direction_id": row.direction_id,
+                      "length_km": round(float(direction_lengths[direction]) / 1000, 3),
+                      "shared_fraction": round(float(fractions[1:].sum()), 3),
+                      "mean_overlap": round(float((fractions * np.arange(MAX_OVERLAP + 1)).sum()), 2),
+                      "overlap_fractions": [round(float(fraction), 3) for fraction in fractions],
+                      "overlapping_routes": overlapping, "overlapping_fractions": shares}
+        shape = points.get(direction_shapes[direction])
+        geometry = None if shape is None else {"type": "LineString", "coordinates": shape.tolist()}
+        yield {"type": "Feature", "geometry": geometry, "properties": properties}
+
+
+# The redundancy layer: every route direction with the share of its length other routes also serve
+def dump_redundancy(feed, path=REDUNDANCY_PATH):
+    return write_layer(route_redundancy(feed), path)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+    parser = argparse.ArgumentParser(description="How much of each route other routes run along")
+    parser.add_argument('--feed', default=FEED_PATH)
+    parser.add_argument('--output', default=REDUNDANCY_PATH)
+    args = parser.parse_args()
+    dump_redundancy(load_feed(args.feed), args.output)
@@ -1,14 +1,16 @@
 #!/usr/bin/python
+import asyncio
 import json
 import logging
 import os
 import traceback
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from collections import namedtuple
 from datetime import datetime, timedelta
 
-import requests
-from requests.adapters import HTTPAdapter
-from urllib3.util.retry import Retry
+from scripts.fetcher import Fetcher
+from scripts.manifest import Manifest
+from scripts.metrics import metrics
+from scripts.raw_store import RawStore, parsed_responses
 
 # Setup logging configuration
 logging.basicConfig(
@@ -32,57 +34,65 @@ HEADERS = {
 }
 BASE_URL = 'https://bmtcmobileapistaging.amnex.com/WebAPI/'
 
-# Configure requests session with retries and connection pooling
-session = requests.Session()
-retries = Retry(total=5, backoff_factor=0.1, status_forcelist=[500, 502, 503, 504])
-adapter = HTTPAdapter(max_retries=retries, pool_connections=100, pool_maxsize=100)
-session.mount('http://', adapter)
-session.mount('https://', adapter)
+# Requests per second allowed for each endpoint, shared by every task hitting it
+RATE_LIMITS = {
+    'GetAllRouteList': 1,
+    'SearchRoute_v2': 10,
+    'RoutePoints': 30,
+    'GetTimetableByRouteid_v3': 30,
+    'SearchByRouteDetails_v4': 30,
+}
+INITIAL_CONCURRENCY = 20
+MAX_CONCURRENCY = 100
+POOL_SIZE = 100
+
+# Everything a fetch needs: the HTTP client, the fetch manifest, and the raw store with its background writer
+Context = namedtuple('Context', ['fetcher', 'manifest', 'store', 'writer'])
 
 
 # Function to fetch all routes
-def get_routes():
-    response = session.post(f'{BASE_URL}GetAllRouteList', headers=HEADERS)
-    if response.status_code != 200:
-        logging.error(f'Failed to get route list: {response.text}')
+async def get_routes(ctx):
+    status, body = await ctx.fetcher.post('GetAllRouteList')
+    if status != 200:
+        logging.error(f'Failed to get route list: {body.decode("utf-8", "replace")}')
         return None
-    with open("bmtc-data/raw/routes.json", "w", encoding='utf-8') as f:
-        f.write(response.text)
-    return response.json()
+    routes = json.loads(body)
+    ctx.writer.put('GetAllRouteList', 'all', body, parsed=routes)
+    return routes
 
 
-# Function to fetch route IDs and save them if necessary
-def get_route_ids():
-    route_parents = {}
+# Function to fetch a single route ID search
+async def fetch_route_ids(ctx, possible_search):
+    logging.debug(f"Fetching {possible_search}.json")
 
-    logging.info("Fetching route IDs...")
+    data = json.dumps({"routetext": possible_search})
+    body, response_data = await post_recorded(ctx, 'SearchRoute_v2', possible_search, data)
 
-    directory_path = "bmtc-data/raw/routeids"
-    os.makedirs(directory_path, exist_ok=True)
+    if (response_data.get('Message') in ["No Records Found",
+                                         "Object reference not set to an instance of an object."]
+            or not response_data.get('Issuccess')):
+        save_empty(ctx, 'SearchRoute_v2', possible_search, data)
+        logging.error(f"No route records found in API call starting with {possible_search}")
+    else:
+        save_recorded(ctx, 'SearchRoute_v2', possible_search, data, body, response_data)
 
-    for possible_search in '0123456789abcdefghijklmnopqrstuvwxyz':
 
-        logging.debug(f"Fetching {possible_search}.json")
+# Function to fetch route IDs and save them if necessary
+async def get_route_ids(ctx):
+    route_parents = {}
 
-        data = json.dumps({"routetext": possible_search})
-        response = session.post(f'{BASE_URL}SearchRoute_v2', headers=HEADERS, data=data)
+    logging.info("Fetching route IDs...")
 
-        if (response.json().get('Message') in ["No Records Found",
-                                               "Object reference not set to an instance of an object."]
-                or not response.json().get('Issuccess')):
-            logging.error(f"No route records found in API call starting with {possible_search}")
-        else:
-            with open(f'{directory_path}/{possible_search}.json', 'w', encoding='utf-8') as f:
-                f.write(response.text)
+    pending_searches = [possible_search for possible_search in '0123456789abcdefghijklmnopqrstuvwxyz'
+                        if is_pending(ctx, 'SearchRoute_v2', possible_search)]
 
-    dir_list = set(os.listdir(directory_path))
+    await gather_logged("route IDs", [fetch_route_ids(ctx, possible_search) for possible_search in pending_searches])
+    await asyncio.to_thread(ctx.writer.flush)
 
-    for filename in dir_list:
-        with open(os.path.join(directory_path, filename), 'r', encoding='utf-8') as file:
-            data = json.load(file)
-            for route in data['data']:
-                if route['routeno'].replace('\t', '') not in route_parents:
-                    route_parents[route['routeno']] = route['routeparentid']
+    for data in ctx.store.load_all('SearchRoute_v2').values():
+        for route in data['data']:
+            if route['routeno'].replace('\t', '') not in route_parents:
+                route_parents[route['routeno']] = route['routeparentid']
 
     logging.info("Finished fetching route IDs!")
 
@@ -90,50 +100,40 @@ def get_route_ids():
 
 
 # Function to fetch a single route line
-def fetch_route_line(route):
-    directory_path = "bmtc-data/raw/routelines"
+async def fetch_route_line(ctx, route):
     routeno = route['routeno'].replace('\t', '')
-    filename = f"{routeno}.json"
 
-    logging.debug(f"Fetching route line : {filename}")
+    logging.debug(f"Fetching route line : {routeno}")
 
     data = json.dumps({"routeid": route['routeid']})
-    response = session.post(f'{BASE_URL}RoutePoints', headers=HEADERS, data=data)
+    body, response_data = await post_recorded(ctx, 'RoutePoints', routeno, data)
 
-    if response.json().get('Message') == "No Records Found" or not response.json().get('Issuccess'):
-        logging.error(f"No route line record found in API call for routeid : {route['routeid']} or route {filename}")
+    if response_data.get('Message') == "No Records Found" or not response_data.get('Issuccess'):
+        save_empty(ctx, 'RoutePoints', routeno, data)
+        logging.error(f"No route line record found in API call for routeid : {route['routeid']} or route {routeno}")
     else:
-        with open(f'{directory_path}/{filename}', 'w', encoding='utf-8') as file:
-            file.write(response.text)
+        save_recorded(ctx, 'RoutePoints', routeno, data, body, response_data)
 
-    logging.debug(f"Fetched route line : {filename}")
+    logging.debug(f"Fetched route line : {routeno}")
 
 
 # Function to fetch route lines and save them
-def get_route_lines(routes):
+async def get_route_lines(ctx, routes):
     logging.info("Fetching route lines...")
 
-    directory_path = "bmtc-data/raw/routelines"
-    os.makedirs(directory_path, exist_ok=True)
-    dir_list = set(os.listdir(directory_path))
-
-    pending_routes = [route for route in routes['data'] if route['routeno'].replace('\t', '') + '.json' not in dir_list]
+    pending_routes = [route for route in routes['data']
+                      if is_pending(ctx, 'RoutePoints', route['routeno'].replace('\t', ''))]
 
-    with ThreadPoolExecutor(max_workers=20) as executor:
-        futures = [executor.submit(fetch_route_line, route) for route in pending_routes]
-        for future in as_completed(futures):
-            future.result()
+    await gather_logged("route line", [fetch_route_line(ctx, route) for route in pending_routes])
 
     logging.info("Finished fetching route lines...")
 
 
 # Function to fetch a single timetable
-def fetch_timetable(route, dow, date):
-    directory_path = f'bmtc-data/raw/timetables/{dow}'
+async def fetch_timetable(ctx, route, dow, date):
     routeno = route['routeno'].replace('\t', '')
-    filename = f"{routeno}.json"
 
-    logging.debug(f"Fetching timetable for route {filename} on {dow}")
+    logging.debug(f"Fetching timetable for route {routeno} on {dow}")
 
     data = json.dumps({
         "routeid": route['routeid'],
@@ -143,114 +143,176 @@ def fetch_timetable(route, dow, date):
         "endtime": date.strftime("%Y-%m-%d") + " 23:59",
         "starttime": date.strftime("%Y-%m-%d") + " 00:00",
     })
-    response = session.post(f'{BASE_URL}GetTimetableByRouteid_v3', headers=HEADERS, data=data)
+    body, response_data = await post_recorded(ctx, 'GetTimetableByRouteid_v3', routeno, data, dow)
 
-    if response.json().get('Message') == "No Records Found" or not response.json().get('Issuccess'):
+    if response_data.get('Message') == "No Records Found" or not response_data.get('Issuccess'):
+        save_empty(ctx, 'GetTimetableByRouteid_v3', routeno, data, dow)
         logging.error(f"No timetable records found In API call for routeid {route['routeid']} "
                       f"/ route : {routeno} between {route['fromstationid']} and {route['tostationid']}"
                       f" for date : {date.strftime('%Y-%m-%d')}")
         return
     else:
-        with open(f'{directory_path}/{filename}', 'w', encoding='utf-8') as file:
-            file.write(response.text)
+        save_recorded(ctx, 'GetTimetableByRouteid_v3', routeno, data, body, response_data, dow)
 
-    logging.debug(f"Fetched timetable for route {filename} on {dow}")
+    logging.debug(f"Fetched timetable for route {routeno} on {dow}")
 
 
-def fetch_timetables_for_day(day, routes):
+async def fetch_timetables_for_day(ctx, day, routes):
     date = datetime.now() + timedelta(days=day)
     dow = date.strftime("%A")
 
-    # Fetch only Monday
-    if dow == "Monday":
-        logging.info(f"Fetching timetables for day of {dow}")
+    logging.info(f"Fetching timetables for day of {dow}")
 
-        directory_path = f'bmtc-data/raw/timetables/{dow}'
-        os.makedirs(directory_path, exist_ok=True)
-        dir_list = set(os.listdir(directory_path))
-        pending_routes = [route for route in routes['data'] if
-                          route['routeno'].replace('\t', '') + '.json' not in dir_list]
+    pending_routes = [route for route in routes['data']
+                      if is_pending(ctx, 'GetTimetableByRouteid_v3', route['routeno'].replace('\t', ''), dow)]
 
-        with ThreadPoolExecutor(max_workers=20) as executor:
-            futures = [executor.submit(fetch_timetable, route, dow, date) for route in pending_routes]
-            for future in as_completed(futures):
-                try:
-                    future.result()
-                except Exception as e:
-                    logging.error(f"Error fetching timetable for route: {e}")
+    await gather_logged("timetable", [fetch_timetable(ctx, route, dow, date) for route in pending_routes])
 
 
 # Function to fetch timetables and save them
-def get_timetables(routes):
+async def get_timetables(ctx, routes):
     logging.info("Fetching timetables...")
 
-    for day in range(1, 8):
-        fetch_timetables_for_day(day, routes)
+    await asyncio.gather(*[fetch_timetables_for_day(ctx, day, routes) for day in range(1, 8)])
 
     logging.info("Finished fetching timetables...")
 
 
-# Function to fetch a single stop list
-def fetch_stop_list(route, route_parent):
-    directory_path = "bmtc-data/raw/stops"
-    filename = f'{route}.json'
-
-    logging.debug(f"Fetching Stops for {filename} with route ID {route}")
+# Function to fetch a single stop list, stored once per route since it holds both directions
+async def fetch_stop_list(ctx, route, route_parent):
+    logging.debug(f"Fetching Stops for {route} with route ID {route_parent}")
 
     data = json.dumps({"routeid": route_parent, "servicetypeid": 0})
     try:
-        response = session.post(f'{BASE_URL}SearchByRouteDetails_v4', headers=HEADERS, data=data)
-        response_data = response.json()
-    except BaseException:
+        body, response_data = await post_recorded(ctx, 'SearchByRouteDetails_v4', route, data)
+    except Exception:
         logging.error(f"Error fetching Stops for route {route_parent} / {route}")
         logging.error(traceback.format_exc())
         return
 
-    if response_data.get("message") == "Data not found" or not response_data.get('issuccess'):
+    if (response_data.get("message") == "Data not found" or not response_data.get('issuccess')
+            or not (response_data.get("up", {}).get("data") or response_data.get("down", {}).get("data"))):
+        save_empty(ctx, 'SearchByRouteDetails_v4', route, data)
         logging.error(f"No stop list records found for Stops In API call for route {route_parent} / {route}")
         return
     else:
-        if response_data.get("up", {}).get("data"):
-            with open(f'{directory_path}/{route} UP.json', 'w', encoding='utf-8') as f:
-                f.write(response.text)
-        if response_data.get("down", {}).get("data"):
-            with open(f'{directory_path}/{route} DOWN.json', 'w', encoding='utf-8') as f:
-                f.write(response.text)
+        save_recorded(ctx, 'SearchByRouteDetails_v4', route, data, body, response_data)
 
-    logging.debug(f"Fetched {filename} with route ID {route_parent} / {route}")
+    logging.debug(f"Fetched {route} with route ID {route_parent}")
 
 
 # Function to fetch stop lists and save them
-def get_stop_lists(routes, route_parents):
+async def get_stop_lists(ctx, routes, route_parents):
     logging.info("Fetching stop lists...")
 
-    directory_path = "bmtc-data/raw/stops"
-    os.makedirs(directory_path, exist_ok=True)
-    dir_list = os.listdir(directory_path)
-    route_list = set([route.replace(" UP.json", "").replace(" DOWN.json", "") for route in dir_list])
-
     pending_routes = set()
     for route in routes['data']:
-        if route['routeno'].replace('\t', '').replace(" UP", "").replace(" DOWN", "") not in route_list:
-            pending_routes.add(route['routeno'].replace('\t', '').replace(" UP", "").replace(" DOWN", ""))
+        route_name = route['routeno'].replace('\t', '').replace(" UP", "").replace(" DOWN", "")
+        if is_pending(ctx, 'SearchByRouteDetails_v4', route_name):
+            pending_routes.add(route_name)
 
-    with ThreadPoolExecutor(max_workers=20) as executor:
-        futures = [executor.submit(fetch_stop_list, route,
-                                   route_parents.get(route)) for route in pending_routes]
-        for future in as_completed(futures):
-            future.result()
+    await gather_logged("stop list", [fetch_stop_list(ctx, route, route_parents.get(route))
+                                      for route in pending_routes])
 
     logging.info("Finished fetching stop lists...")
 
 
-# Main workflow
+# Manifest entries for per-day responses are keyed as <day>/<key>
+def manifest_key(key, day=''):
+    return f'{day}/{key}' if day else key
+
+
+# Whether a fetch is due, either per the manifest or because a successful response is missing from the store
+def is_pending(ctx, endpoint, key, day=''):
+    if ctx.manifest.should_fetch(endpoint, manifest_key(key, day)):
+        return True
+    entry = ctx.manifest.get(endpoint, manifest_key(key, day))
+    return entry['status'] == 'ok' and not ctx.store.has(endpoint, key, day)
+
+
+# POST a request and parse it exactly once, recording transport errors and bad responses as manifest failures.
+# A cancelled or interrupted fetch is not a failure and keeps its retries.
+async def post_recorded(ctx, endpoint, key, data, day=''):
+    try:
+        status, body = await ctx.fetcher.post(endpoint, data)
+        if status != 200:
+            raise RuntimeError(f"{endpoint} returned HTTP {status}")
+        return body, json.loads(body)
+    except Exception:
+        ctx.manifest.record(endpoint, manifest_key(key, day), data, 'failed')
+        raise
+
+
+# Record a successful response and queue the raw bytes for the store if they changed or are missing from it
+def save_recorded(ctx, endpoint, key, data, body, parsed, day=''):
+    changed = ctx.manifest.record(endpoint, manifest_key(key, day), data, 'ok', body)
+    if changed or not ctx.store.has(endpoint, key, day):
+        ctx.writer.put(endpoint, key, body, day, parsed)
+    else:
+        parsed_responses[ctx.manifest.get(endpoint, manifest_key(key, day))['hash']] = parsed
+
+
+# Record an empty response and drop whatever was stored for it before
+def save_empty(ctx, endpoint, key, data, day=''):
+    ctx.manifest.record(endpoint, manifest_key(key, day), data, 'empty')
+    ctx.writer.delete(endpoint, key, day)
+
+
+# Run fetches concurrently, logging failures instead of aborting the whole scrape
+async def gather_logged(name, coroutines):
+    results = await asyncio.gather(*coroutines, return_exceptions=True)
+    for result in results:
+        if isinstance(result, BaseException):
+            logging.error(f"Error fetching {name}: {result!r}")
+            logging.error("".join(traceback.format_exception(result)))
+
+
+async def scrape(fetcher, manifest, store):
+    ctx = Context(fetcher, manifest, store, store.writer())
+    try:
+        routes, route_parents = await asyncio.gather(get_routes(ctx), get_route_ids(ctx))
+        if routes is None:
+            raise RuntimeError("Could not fetch the route list, so there are no route lines, timetables or stop "
+                               "lists to fetch")
+        # Route lines, timetables and stop lists share the fetcher and run side by side
+        await asyncio.gather(
+            get_route_lines(ctx, routes),
+            get_timetables(ctx, routes),
+            get_stop_lists(ctx, routes, route_parents),
+        )
+    finally:
+        await asyncio.to_thread(ctx.writer.close)
+
+
+def create_fetcher(base_url=None, rate_limits=RATE_LIMITS, initial_concurrency=INITIAL_CONCURRENCY,
+                   max_concurrency=MAX_CONCURRENCY, pool_size=POOL_SIZE):
+    return Fetcher(base_url or BASE_URL, HEADERS, rate_limits=rate_limits, initial_concurrency=initial_concurrency,
+                   max_concurrency=max_concurrency, pool_size=pool_size)
+
+
+async def run(manifest, store):
+    async with create_fetcher() as fetcher:
+        try:
+            await scrape(fetcher, manifest, store)
+        finally:
+            metrics.record_requests(fetcher.stats)
+
+
+# Main workflow, returns the manifest keys whose responses changed in this run
 def main():
-    routes = get_routes()
-    route_parents = get_route_ids()
-    get_route_lines(routes)
-    get_timetables(routes)
-    get_stop_lists(routes, route_parents)
+    os.makedirs("bmtc-data/raw", exist_ok=True)
+    manifest = Manifest()
+    with RawStore() as store:
+        try:
+            asyncio.run(run(manifest, store))
+        finally:
+            manifest.save()
+            store.vacuum_blobs()
+    metrics.count("changed responses", len(manifest.changed))
+    return manifest.changed
 
 
 if __name__ == "__main__":
-    main()
+    with metrics.stage("scrape"):
+        main()
+    metrics.write()
@@ -0,0 +1,78 @@
+import argparse
+import logging
+from datetime import datetime
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+
+from scripts.feed import FEED_PATH, load_feed, service_date, service_ids, trip_runs
+from scripts.tiles import write_layer
+
+SEGMENTS_PATH = "bmtc-data/geojson/segments.geojson"
+# Coordinates are grouped as integer millionths of a degree (about 0.1 m), so points repeated across shapes match
+# exactly instead of by float equality
+COORDINATE_SCALE = 10 ** 6
+
+
+# One row per pair of consecutive shape points: the shape and the quantized start and end of the segment between them
+def shape_segments(shapes):
+    order = np.lexsort((shapes['shape_pt_sequence'].to_numpy(), shapes['shape_id'].astype(str).to_numpy()))
+    shape_ids = shapes['shape_id'].astype(str).to_numpy()[order]
+    lats = np.round(shapes['shape_pt_lat'].to_numpy()[order] * COORDINATE_SCALE).astype(np.int64)
+    lons = np.round(shapes['shape_pt_lon'].to_numpy()[order] * COORDINATE_SCALE).astype(np.int64)
+
+    # A segment runs from each point to the next one of the same shape; repeated points make no segment
+    same_shape = shape_ids[1:] == shape_ids[:-1]
+    moved = (lats[1:] != lats[:-1]) | (lons[1:] != lons[:-1])
+    starts = np.flatnonzero(same_shape & moved)
+    return pd.DataFrame({'shape_id': shape_ids[starts],
+                         'start_lat': lats[starts], 'start_lon': lons[starts],
+                         'end_lat': lats[starts + 1], 'end_lon': lons[starts + 1]})
+
+
+# Trips on each road segment on a day, as a GeoDataFrame of two-point lines with their trip_count. Segments are
+# directed: the two directions of a street are counted apart, as the buses running them are. A frequencies.txt
+# template counts once per start time, so the counts do not depend on whether the feed was compacted.
+def segment_frequency(feed, day):
+    services = service_ids(feed, day)
+    trips = feed.trips
+    day_trips = trips.loc[trips['service_id'].astype(str).isin(services)]
+    runs = pd.Series(trip_runs(feed, day_trips['trip_id'].astype(str)))
+    shape_trips = runs.groupby(day_trips['shape_id'].astype(str).to_numpy()).sum().rename('trip_count')
+
+    segments = shape_segments(feed.shapes)
+    segments = segments.join(shape_trips, on='shape_id', how='inner')
+    segments = (segments.groupby(['start_lat', 'start_lon', 'end_lat', 'end_lon'], sort=False)['trip_count']
+                .sum().reset_index())
+
+    coordinates = np.stack([segments[['start_lon', 'start_lat']].to_numpy(),
+                            segments[['end_lon', 'end_lat']].to_numpy()], axis=1) / COORDINATE_SCALE
+    geometry = shapely.linestrings(coordinates)
+    logging.info(f"Counted {runs.sum()} trips of {day:%Y-%m-%d} over {len(segments)} segments")
+    return gpd.GeoDataFrame({'trip_count': segments['trip_count'].to_numpy()}, geometry=geometry, crs="EPSG:4326")
+
+
+def segment_features(gdf):
+    coordinates = shapely.get_coordinates(gdf.geometry.values).reshape(-1, 2, 2)
+    for line, trip_count in zip(coordinates, gdf['trip_count'].tolist()):
+        yield {"type": "Feature", "geometry": {"type": "LineString", "coordinates": line.tolist()},
+               "properties": {"trip_count": trip_count}}
+
+
+# The route frequency layer: every segment of the network with the number of trips over it on the given day
+# (by default today, or the feed's first day of service when nothing runs today)
+def dump_segments(feed, day=None, path=SEGMENTS_PATH):
+    return write_layer(segment_features(segment_frequency(feed, service_date(feed, day))), path)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+    parser = argparse.ArgumentParser(description="Count trips per road segment on a service date")
+    parser.add_argument('--date', type=lambda value: datetime.strptime(value, "%Y-%m-%d").date(),
+                        help="service date as YYYY-MM-DD (default: today, or the feed's first day of service)")
+    parser.add_argument('--feed', default=FEED_PATH)
+    parser.add_argument('--output', default=SEGMENTS_PATH)
+    args = parser.parse_args()
+    dump_segments(load_feed(args.feed), args.date, args.output)
@@ -0,0 +1,237 @@
+import argparse
+import json
+import logging
+import os
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from scripts.feed import FEED_PATH, frequency_starts, load_feed, service_date, service_ids
+from scripts.trip_builder import format_time, parse_time
+
+CUBE_PATH = "bmtc-data/cube/service_cube.npz"
+BUCKET_MINUTES = 15
+# Window over which the busiest stretch of the day, and its headway, is measured
+PEAK_WINDOW = 3600
+SECONDS_PER_DAY = 24 * 3600
+# Properties frequency_properties gives every stop and route direction
+FREQUENCY_PROPERTIES = ["departures", "first_departure", "last_departure", "peak_hour", "peak_headway", "hourly"]
+
+
+# Every departure of the day: stop, route, direction, time, and whether it is the first stop of its trip. Template
+# trips of frequencies.txt are repeated at each start time, shifted from their own first departure.
+def day_departures(feed, day):
+    trips = feed.trips
+    trips = trips.loc[trips['service_id'].astype(str).isin(service_ids(feed, day))]
+    directions = (trips['direction_id'].fillna(0).astype(int) if 'direction_id' in trips.columns
+                  else pd.Series(0, index=trips.index))
+    trip_info = pd.DataFrame({'route_id': trips['route_id'].astype(str).to_numpy(),
+                              'direction_id': directions.to_numpy()},
+                             index=pd.Index(trips['trip_id'].astype(str).to_numpy()))
+
+    stop_times = feed.stop_times
+    trip_ids = stop_times['trip_id'].astype(str)
+    times = np.where(stop_times['departure_time'] >= 0, stop_times['departure_time'], stop_times['arrival_time'])
+    kept = trip_ids.isin(trip_info.index).to_numpy() & (times >= 0)
+    departures = pd.DataFrame({'trip_id': trip_ids.to_numpy()[kept],
+                               'stop_id': stop_times['stop_id'].astype(str).to_numpy()[kept],
+                               'sequence': stop_times['stop_sequence'].to_numpy()[kept], 'time': times[kept]})
+    departures = departures.sort_values(['trip_id', 'sequence'], kind='stable').reset_index(drop=True)
+    trip_change = departures['trip_id'].to_numpy()
+    departures['first'] = np.concatenate([[True], trip_change[1:] != trip_change[:-1]]) if len(departures) else []
+
+    starts = frequency_starts(feed)
+    if starts:
+        templates = departures['trip_id'].isin(starts)
+        copies = []
+        for trip_id, rows in departures.loc[templates].groupby('trip_id', sort=False):
+            trip_starts = starts[trip_id]
+            copy = rows.iloc[np.tile(np.arange(len(rows)), len(trip_starts))].copy()
+            copy['time'] += np.repeat(trip_starts - rows['time'].min(), len(rows))
+            copies.append(copy)
+        departures = pd.concat([departures.loc[~templates]] + copies, ignore_index=True)
+    return departures.join(trip_info, on='trip_id')
+
+
+# Departures per stop and per route direction in fixed time buckets over one service day, as dense integer arrays
+# with the stop IDs and route directions that index their rows. Buckets start at midnight and run on past it as
+# far as the latest departure. first/last hold each row's first and last departure in seconds, -1 for none.
+class ServiceCube:
+    def __init__(self, day, bucket_minutes, stop_ids, stop_counts, stop_first, stop_last,
+                 route_ids, direction_ids, direction_counts, direction_first, direction_last):
+        self.day = day
+        self.bucket_minutes = bucket_minutes
+        self.stop_ids = stop_ids
+        self.stop_counts = stop_counts
+        self.stop_first, self.stop_last = stop_first, stop_last
+        self.route_ids, self.direction_ids = route_ids, direction_ids
+        self.direction_counts = direction_counts
+        self.direction_first, self.direction_last = direction_first, direction_last
+        self.stop_index = pd.Index(stop_ids)
+        self.direction_index = pd.MultiIndex.from_arrays([route_ids, direction_ids])
+
+    @property
+    def bucket_seconds(self):
+        return self.bucket_minutes * 60
+
+    @property
+    def buckets(self):
+        return self.stop_counts.shape[1]
+
+    def save(self, path=CUBE_PATH):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        np.savez_compressed(path, day=self.day.strftime("%Y%m%d"), bucket_minutes=self.bucket_minutes,
+                            stop_ids=self.stop_ids.astype(str), stop_counts=self.stop_counts,
+                            stop_first=self.stop_first, stop_last=self.stop_last,
+                            route_ids=self.route_ids.astype(str), direction_ids=self.direction_ids,
+                            direction_counts=self.direction_counts, direction_first=self.direction_first,
+                            direction_last=self.direction_last)
+        logging.info(f"Saved the service cube of {len(self.stop_ids)} stops and {len(self.route_ids)} route "
+                     f"directions in {self.buckets} buckets of {self.bucket_minutes} minutes to {path}")
+
+    @classmethod
+    def load(cls, path=CUBE_PATH):
+        with np.load(path) as arrays:
+            return cls(datetime.strptime(str(arrays['day']), "%Y%m%d").date(), int(arrays['bucket_minutes']),
+                       arrays['stop_ids'], arrays['stop_counts'], arrays['stop_first'], arrays['stop_last'],
+                       arrays['route_ids'], arrays['direction_ids'], arrays['direction_counts'],
+                       arrays['direction_first'], arrays['direction_last'])
+
+    # (counts, first, last) of a stop, or summed over several stops; zeros and -1 for stops without service
+    def stop(self, stop_ids):
+        rows = self.stop_index.get_indexer(np.atleast_1d(np.asarray(stop_ids, dtype=str)))
+        rows = rows[rows >= 0]
+        return combine(self.stop_counts[rows], self.stop_first[rows], self.stop_last[rows], self.buckets)
+
+    # (counts, first, last) of trips starting in one direction of a route
+    def direction(self, route_id, direction_id):
+        row = self.direction_index.get_indexer([(str(route_id), int(direction_id))])
+        row = row[row >= 0]
+        return combine(self.direction_counts[row], self.direction_first[row], self.direction_last[row], self.buckets)
+
+    # Departures per stop over the whole day, by stop ID
+    def stop_departures(self):
+        return pd.Series(self.stop_counts.sum(axis=1, dtype=np.int64), index=self.stop_index)
+
+    def bucket_range(self, start=None, end=None):
+        first = 0 if start is None else max(start // self.bucket_seconds, 0)
+        last = self.buckets if end is None else min(-(-end // self.bucket_seconds), self.buckets)
+        return first, max(first, last)
+
+    # Departures between start and end (seconds since midnight, rounded out to whole buckets)
+    def departures(self, counts, start=None, end=None):
+        first, last = self.bucket_range(start, end)
+        return int(counts[first:last].sum())
+
+    # Mean minutes between departures between start and end, None without any
+    def headway(self, counts, start, end):
+        first, last = self.bucket_range(start, end)
+        departures = int(counts[first:last].sum())
+        return round((last - first) * self.bucket_minutes / departures, 1) if departures else None
+
+    def hourly(self, counts):
+        per_hour = 60 // self.bucket_minutes
+        padded = np.pad(counts, (0, -len(counts) % per_hour))
+        return padded.reshape(-1, per_hour).sum(axis=1)
+
+    # (start in seconds, departures) of the busiest window of the day, by whole buckets
+    def peak(self, counts, window=PEAK_WINDOW):
+        width = max(window // self.bucket_seconds, 1)
+        totals = np.convolve(counts, np.ones(width, dtype=np.int64), mode='valid') if len(counts) >= width else \
+            np.array([counts.sum()])
+        first = int(np.argmax(totals))
+        departures = int(totals[first])
+        # Start at the window's first departure rather than at empty buckets before it
+        first += int(np.argmax(counts[first:first + width] > 0))
+        return first * self.bucket_seconds, departures
+
+    # Compact frequency properties for a map feature, in place of a full list of departure times
+    def frequency_properties(self, counts, first, last, window=PEAK_WINDOW):
+        peak_start, peak_departures = self.peak(counts, window)
+        return {"departures": int(counts.sum()),
+                "first_departure": format_time(first) if first >= 0 else None,
+                "last_departure": format_time(last) if last >= 0 else None,
+                "peak_hour": format_time(peak_start)[:5] if peak_departures else None,
+                "peak_headway": round(window / 60 / peak_departures, 1) if peak_departures else None,
+                "hourly": self.hourly(counts).tolist()}
+
+
+# One row of counts with its first and last departure, from any number of rows
+def combine(counts, firsts, lasts, buckets):
+    served = firsts >= 0
+    return (counts.sum(axis=0, dtype=np.int64) if len(counts) else np.zeros(buckets, dtype=np.int64),
+            int(firsts[served].min()) if served.any() else -1, int(lasts[served].max()) if served.any() else -1)
+
+
+# Counts of each key's departures per bucket as a keys × buckets array, and each key's first and last departure
+def bucket_counts(codes, times, keys, buckets, bucket_seconds):
+    counts = np.bincount(codes * buckets + times // bucket_seconds, minlength=keys * buckets)
+    first = np.full(keys, -1, dtype=np.int32)
+    last = np.full(keys, -1, dtype=np.int32)
+    if len(codes):
+        order = np.lexsort((times, codes))
+        boundaries = np.flatnonzero(np.diff(codes[order])) + 1
+        starts, ends = np.concatenate([[0], boundaries]), np.concatenate([boundaries, [len(order)]])
+        first[codes[order][starts]] = times[order][starts]
+        last[codes[order][starts]] = times[order][ends - 1]
+    return np.minimum(counts, np.iinfo(np.uint16).max).astype(np.uint16).reshape(keys, buckets), first, last
+
+
+def build_cube(feed, day, bucket_minutes=BUCKET_MINUTES):
+    if 60 % bucket_minutes:
+        raise ValueError(f"Buckets of {bucket_minutes} minutes do not divide an hour")
+    bucket_seconds = bucket_minutes * 60
+    departures = day_departures(feed, day)
+    latest = int(departures['time'].max()) if len(departures) else 0
+    buckets = max(latest // bucket_seconds + 1, SECONDS_PER_DAY // bucket_seconds)
+    times = departures['time'].to_numpy(dtype=np.int64)
+
+    stops = feed.stops
+    if 'location_type' in stops.columns:
+        stops = stops.loc[stops['location_type'].fillna(0) != 1]
+    stop_ids = stops['stop_id'].astype(str).to_numpy()
+    stop_codes = pd.Index(stop_ids).get_indexer(departures['stop_id'])
+    known = stop_codes >= 0
+    stop_counts, stop_first, stop_last = bucket_counts(stop_codes[known], times[known], len(stop_ids), buckets,
+                                                       bucket_seconds)
+
+    starts = departures.loc[departures['first']]
+    directions = starts[['route_id', 'direction_id']].drop_duplicates().sort_values(['route_id', 'direction_id'])
+    direction_index = pd.MultiIndex.from_frame(directions)
+    direction_codes = direction_index.get_indexer(pd.MultiIndex.from_frame(starts[['route_id', 'direction_id']]))
+    direction_counts, direction_first, direction_last = bucket_counts(
+        direction_codes, starts['time'].to_numpy(dtype=np.int64), len(directions), buckets, bucket_seconds)
+
+    logging.info(f"Built the service cube of {day:%Y-%m-%d}: {len(departures)} departures, {len(starts)} trips")
+    return ServiceCube(day, bucket_minutes, stop_ids, stop_counts, stop_first, stop_last,
+                       directions['route_id'].to_numpy(dtype=str), directions['direction_id'].to_numpy(dtype=np.int64),
+                       direction_counts, direction_first, direction_last)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+    parser = argparse.ArgumentParser(description="Build the stop × time service cube, or query a saved one")
+    parser.add_argument('--date', type=lambda value: datetime.strptime(value, "%Y-%m-%d").date(),
+                        help="service date as YYYY-MM-DD (default: today, or the feed's first day of service)")
+    parser.add_argument('--bucket', type=int, default=BUCKET_MINUTES, help="bucket length in minutes")
+    parser.add_argument('--stop', nargs='+', metavar='stop_id', help="print the service of these stops, together")
+    parser.add_argument('--start', type=parse_time, help="start of the queried window as HH:MM")
+    parser.add_argument('--end', type=parse_time, help="end of the queried window as HH:MM")
+    parser.add_argument('--feed', default=FEED_PATH)
+    parser.add_argument('--cube', default=CUBE_PATH)
+    args = parser.parse_args()
+
+    if args.stop:
+        cube = ServiceCube.load(args.cube)
+        counts, first, last = cube.stop(args.stop)
+        summary = cube.frequency_properties(counts, first, last)
+        if args.start is not None or args.end is not None:
+            start = 0 if args.start is None else args.start
+            end = cube.buckets * cube.bucket_seconds if args.end is None else args.end
+            summary["window_departures"] = cube.departures(counts, start, end)
+            summary["window_headway"] = cube.headway(counts, start, end)
+        print(json.dumps(summary))
+    else:
+        feed = load_feed(args.feed)
+        build_cube(feed, service_date(feed, args.date), args.bucket).save(args.cube)
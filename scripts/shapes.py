@@ -0,0 +1,56 @@
+import json
+import logging
+import traceback
+
+from scripts.geometry import simplify
+from scripts.manifest import content_hash
+
+# Douglas–Peucker tolerance for route lines, in metres; 0 keeps every point
+SHAPE_TOLERANCE = 5.0
+# Coordinates are compared at about 10 cm when looking for identical shapes
+COORDINATE_PRECISION = 6
+
+
+def shape_hash(lats, lons):
+    return content_hash(json.dumps([[round(lat, COORDINATE_PRECISION) for lat in lats],
+                                    [round(lon, COORDINATE_PRECISION) for lon in lons]]))
+
+
+# Simplify every route line and merge those that end up with the same points, returns ({shape_id: (lats, lons)},
+# {route line name: shape_id}). A shared shape keeps the name of the first route line that has it.
+def prepare_shapes(route_lines, tolerance=SHAPE_TOLERANCE):
+    shapes = {}
+    shape_ids = {}
+    by_hash = {}
+    points_in = points_simplified = failures = 0
+
+    for name, data in route_lines.items():
+        try:
+            if not data.get("data"):
+                continue
+            lats = [float(point["latitude"]) for point in data["data"]]
+            lons = [float(point["longitude"]) for point in data["data"]]
+            points_in += len(lats)
+            if tolerance > 0:
+                lats, lons = (values.tolist() for values in simplify(lats, lons, tolerance))
+            points_simplified += len(lats)
+
+            shape_ids[name] = by_hash.setdefault(shape_hash(lats, lons), name)
+            if shape_ids[name] == name:
+                shapes[name] = (lats, lons)
+        except Exception:
+            logging.info(f"Failed to process {name}")
+            logging.error(traceback.format_exc())
+            failures += 1
+
+    points_out = sum(len(lats) for lats, _ in shapes.values())
+    logging.info(f"Simplified {points_in} shape points to {points_simplified} "
+                 f"({points_simplified / max(points_in, 1):.1%}) at {tolerance} m")
+    logging.info(f"Deduplicated {len(shape_ids)} route lines to {len(shapes)} shapes with {points_out} points "
+                 f"({points_out / max(points_in, 1):.1%} of the original points, {failures} errors)")
+    return shapes, shape_ids
+
+
+# {route line name: (shape_id, lats, lons)}, what trip_builder needs to project stops onto each direction's shape
+def route_shapes(shapes, shape_ids):
+    return {name: (shape_id, *shapes[shape_id]) for name, shape_id in shape_ids.items()}
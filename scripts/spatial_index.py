@@ -0,0 +1,177 @@
+import math
+
+import numpy as np
+
+from scripts.geometry import to_plane
+
+# Default grid cell, in metres; queries are fastest when the radius is close to it
+CELL_SIZE = 250.0
+
+
+# One int64 per grid cell, for sorting and joining cells as single values
+def cell_key(cells_x, cells_y):
+    return (np.asarray(cells_x, dtype=np.int64) << 32) | (np.asarray(cells_y, dtype=np.int64) & 0xffffffff)
+
+
+# Uniform grid hash over points on the equirectangular plane, for radius and nearest-neighbour queries in metres.
+# Building it is one sort, and a query only looks at the cells its radius overlaps.
+class GridIndex:
+    def __init__(self, lats, lons, cell_size=CELL_SIZE, origin_lat=None):
+        self.lats = np.asarray(lats, dtype=float)
+        self.lons = np.asarray(lons, dtype=float)
+        self.cell_size = cell_size
+        if origin_lat is None:
+            origin_lat = float(np.mean(self.lats)) if len(self.lats) else 0.0
+        self.origin_lat = origin_lat
+        x, y = to_plane(self.lats, self.lons, self.origin_lat)
+        # Metres from here on
+        self.x, self.y = x * 1000, y * 1000
+
+        cells_x = np.floor(self.x / cell_size).astype(np.int64)
+        cells_y = np.floor(self.y / cell_size).astype(np.int64)
+        order = np.lexsort((cells_y, cells_x))
+        keys = np.stack([cells_x[order], cells_y[order]], axis=1)
+        boundaries = np.flatnonzero(np.any(np.diff(keys, axis=0) != 0, axis=1)) + 1
+        starts = np.concatenate([[0], boundaries]) if len(order) else np.array([], dtype=np.int64)
+        ends = np.concatenate([boundaries, [len(order)]]) if len(order) else np.array([], dtype=np.int64)
+        self.cells = {(int(keys[start, 0]), int(keys[start, 1])): order[start:end] for start, end in zip(starts, ends)}
+        self._flat_cells = None
+
+    def __len__(self):
+        return len(self.x)
+
+    def project(self, lats, lons):
+        x, y = to_plane(lats, lons, self.origin_lat)
+        return x * 1000, y * 1000
+
+    def cell_of(self, x, y):
+        return math.floor(x / self.cell_size), math.floor(y / self.cell_size)
+
+    # Indexes of the points in the cells within `rings` cells of (x, y)
+    def candidates(self, x, y, rings):
+        cell_x, cell_y = self.cell_of(x, y)
+        found = [self.cells[(cell_x + dx, cell_y + dy)]
+                 for dx in range(-rings, rings + 1) for dy in range(-rings, rings + 1)
+                 if (cell_x + dx, cell_y + dy) in self.cells]
+        return np.concatenate(found) if found else np.array([], dtype=np.int64)
+
+    # Indexes of the points within radius metres of a location, nearest first, with their distances
+    def query_radius(self, lat, lon, radius):
+        x, y = self.project([lat], [lon])
+        return self._radius(x[0], y[0], radius)
+
+    def _radius(self, x, y, radius):
+        candidates = self.candidates(x, y, math.ceil(radius / self.cell_size))
+        distances = np.hypot(self.x[candidates] - x, self.y[candidates] - y)
+        within = distances <= radius
+        order = np.argsort(distances[within], kind='stable')
+        return candidates[within][order], distances[within][order]
+
+    # query_radius for many locations, returns a list of (indexes, distances) in query order
+    def query_radius_batch(self, lats, lons, radius):
+        xs, ys = self.project(lats, lons)
+        return [self._radius(x, y, radius) for x, y in zip(xs.tolist(), ys.tolist())]
+
+    # Every (query, point) pair within radius metres, for many query locations at once, as (query indexes, point
+    # indexes, distances) arrays. Each neighbouring cell offset is one bulk lookup of all queries' cells, so the cost
+    # grows with the pairs found rather than with queries times points.
+    def query_radius_pairs(self, lats, lons, radius):
+        xs, ys = self.project(lats, lons)
+        keys, starts, ends, order = self.flat_cells()
+        query_x = np.floor(xs / self.cell_size).astype(np.int64)
+        query_y = np.floor(ys / self.cell_size).astype(np.int64)
+        rings = math.ceil(radius / self.cell_size)
+        found_queries, found_points = [], []
+        for dx in range(-rings, rings + 1):
+            for dy in range(-rings, rings + 1):
+                wanted = cell_key(query_x + dx, query_y + dy)
+                slots = np.minimum(np.searchsorted(keys, wanted), max(len(keys) - 1, 0))
+                hit = np.flatnonzero(keys[slots] == wanted) if len(keys) else np.array([], dtype=np.int64)
+                counts = ends[slots[hit]] - starts[slots[hit]]
+                # Ragged ranges of cell members, laid end to end
+                offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+                found_queries.append(np.repeat(hit, counts))
+                found_points.append(order[np.repeat(starts[slots[hit]], counts) + offsets])
+        queries, points = np.concatenate(found_queries), np.concatenate(found_points)
+        distances = np.hypot(self.x[points] - xs[queries], self.y[points] - ys[queries])
+        within = distances <= radius
+        return queries[within], points[within], distances[within]
+
+    def cell_keys(self):
+        return np.floor(self.x / self.cell_size).astype(np.int64), np.floor(self.y / self.cell_size).astype(np.int64)
+
+    # The cells as sorted keys with each one's [start, end) range in `order`, for vectorized lookups
+    def flat_cells(self):
+        if self._flat_cells is None:
+            keys = cell_key(*self.cell_keys())
+            order = np.argsort(keys, kind='stable')
+            unique, starts = np.unique(keys[order], return_index=True)
+            ends = np.append(starts[1:], len(order))
+            self._flat_cells = unique, starts, ends, order
+        return self._flat_cells
+
+    # Indexes of the points in the cells exactly `ring` cells away from a cell, in Chebyshev distance
+    def ring(self, cell_x, cell_y, ring):
+        if ring == 0:
+            cells = [(cell_x, cell_y)]
+        else:
+            cells = [(cell_x + dx, cell_y + dy) for dx in range(-ring, ring + 1) for dy in (-ring, ring)]
+            cells += [(cell_x + dx, cell_y + dy) for dx in (-ring, ring) for dy in range(-ring + 1, ring)]
+        found = [self.cells[cell] for cell in cells if cell in self.cells]
+        return np.concatenate(found) if found else np.array([], dtype=np.int64)
+
+    # Nearest point to each location as (indexes, distances), -1 and inf where none lies within max_distance
+    def nearest_batch(self, lats, lons, max_distance=None):
+        xs, ys = self.project(lats, lons)
+        indexes = np.full(len(xs), -1, dtype=np.int64)
+        distances = np.full(len(xs), np.inf)
+        if not len(self):
+            return indexes, distances
+        keys = np.array(list(self.cells))
+        low_x, low_y = keys.min(axis=0)
+        high_x, high_y = keys.max(axis=0)
+
+        for query, (x, y) in enumerate(zip(xs.tolist(), ys.tolist())):
+            cell_x, cell_y = self.cell_of(x, y)
+            # Rings closer than the nearest occupied cell or beyond the farthest one hold nothing
+            first_ring = max(low_x - cell_x, cell_x - high_x, low_y - cell_y, cell_y - high_y, 0)
+            last_ring = max(high_x - cell_x, cell_x - low_x, high_y - cell_y, cell_y - low_y)
+            if max_distance is not None:
+                last_ring = min(last_ring, math.ceil(max_distance / self.cell_size) + 1)
+            best, best_distance = -1, np.inf
+            # A hit is final once no unvisited ring can hold anything closer: points `ring` cells away are at least
+            # ring - 1 cells' width from anywhere in the query's cell
+            for ring in range(first_ring, last_ring + 1):
+                if best_distance <= (ring - 1) * self.cell_size:
+                    break
+                candidates = self.ring(cell_x, cell_y, ring)
+                if len(candidates):
+                    candidate_distances = np.hypot(self.x[candidates] - x, self.y[candidates] - y)
+                    nearest = int(np.argmin(candidate_distances))
+                    if candidate_distances[nearest] < best_distance:
+                        best, best_distance = candidates[nearest], candidate_distances[nearest]
+            if max_distance is None or best_distance <= max_distance:
+                indexes[query], distances[query] = best, best_distance
+        return indexes, distances
+
+    def nearest(self, lat, lon, max_distance=None):
+        indexes, distances = self.nearest_batch([lat], [lon], max_distance)
+        return int(indexes[0]), float(distances[0])
+
+    # Every pair of indexed points within radius metres of each other, as (i, j, distance) arrays with i < j
+    def pairs_within(self, radius):
+        rings = math.ceil(radius / self.cell_size)
+        firsts, seconds = [], []
+        for (cell_x, cell_y), members in self.cells.items():
+            neighbours = [self.cells[(cell_x + dx, cell_y + dy)]
+                          for dx in range(-rings, rings + 1) for dy in range(-rings, rings + 1)
+                          if (cell_x + dx, cell_y + dy) in self.cells]
+            neighbours = np.concatenate(neighbours)
+            distances = np.hypot(self.x[members, None] - self.x[neighbours], self.y[members, None] - self.y[neighbours])
+            rows, columns = np.nonzero((distances <= radius) & (members[:, None] < neighbours))
+            firsts.append(members[rows])
+            seconds.append(neighbours[columns])
+        if not firsts:
+            return np.array([], dtype=np.int64), np.array([], dtype=np.int64), np.array([])
+        firsts, seconds = np.concatenate(firsts), np.concatenate(seconds)
+        return firsts, seconds, np.hypot(self.x[firsts] - self.x[seconds], self.y[firsts] - self.y[seconds])
@@ -0,0 +1,78 @@
+import re
+from collections import Counter, namedtuple
+from difflib import SequenceMatcher
+
+import numpy as np
+
+from scripts.spatial_index import GridIndex
+
+# Platforms further apart than this are never the same station, in metres
+CLUSTER_RADIUS = 150.0
+# How alike two normalised stop names must be, 0 to 1, for nearby platforms to share a station
+NAME_SIMILARITY = 0.8
+# Prefix of generated parent station IDs, followed by the ID of the station's first platform
+PARENT_PREFIX = "P"
+
+# How stops are grouped into parent stations, None leaves every stop on its own
+ClusterPolicy = namedtuple('ClusterPolicy', ['radius', 'name_similarity'], defaults=[CLUSTER_RADIUS, NAME_SIMILARITY])
+
+# Words that describe the kind of stop rather than where it is
+STOP_WORDS = {"bus", "stop", "stand", "station", "bs", "busstop"}
+# Platform and bay numbers tell platforms of one station apart
+PLATFORM = re.compile(r"\b(platform|bay|pf)\s*(no)?\s*\d*\b")
+
+
+def normalise_name(name):
+    words = re.sub(r"[^a-z0-9 ]+", " ", PLATFORM.sub(" ", name.lower())).split()
+    return " ".join(word for word in words if word not in STOP_WORDS)
+
+
+def names_match(first, second, threshold):
+    return first == second or SequenceMatcher(None, first, second).ratio() >= threshold
+
+
+# Group stops into stations: platforms within radius metres of each other whose names are alike, chained
+# transitively. Returns a cluster label per stop, labels being the position of the cluster's first stop.
+def cluster_stops(names, lats, lons, radius=CLUSTER_RADIUS, name_similarity=NAME_SIMILARITY):
+    parents = np.arange(len(names))
+
+    def find(index):
+        while parents[index] != index:
+            parents[index] = parents[parents[index]]
+            index = parents[index]
+        return index
+
+    normalised = [normalise_name(name) for name in names]
+    firsts, seconds, _ = GridIndex(lats, lons, cell_size=radius).pairs_within(radius)
+    for first, second in zip(firsts.tolist(), seconds.tolist()):
+        if names_match(normalised[first], normalised[second], name_similarity):
+            root_first, root_second = find(first), find(second)
+            if root_first != root_second:
+                parents[max(root_first, root_second)] = min(root_first, root_second)
+
+    return np.array([find(index) for index in range(len(names))], dtype=np.int64)
+
+
+# Parent stations for every cluster of two or more stops, returns (stations, {stop_id: parent station ID}).
+# Each station is a dict of stop_id, stop_name (its platforms' most common name) and their mean position.
+def parent_stations(stop_ids, names, lats, lons, radius=CLUSTER_RADIUS, name_similarity=NAME_SIMILARITY):
+    labels = cluster_stops(names, lats, lons, radius, name_similarity)
+    members = {}
+    for index, label in enumerate(labels.tolist()):
+        members.setdefault(label, []).append(index)
+
+    stations = []
+    parent_ids = {}
+    for label, indexes in members.items():
+        if len(indexes) < 2:
+            continue
+        station_id = f"{PARENT_PREFIX}{stop_ids[label]}"
+        stations.append({
+            "stop_id": station_id,
+            "stop_name": Counter(names[index] for index in indexes).most_common(1)[0][0],
+            "stop_lat": float(np.mean([float(lats[index]) for index in indexes])),
+            "stop_lon": float(np.mean([float(lons[index]) for index in indexes])),
+        })
+        for index in indexes:
+            parent_ids[stop_ids[index]] = station_id
+    return stations, parent_ids
@@ -0,0 +1,222 @@
+import gzip
+import json
+import logging
+import math
+import os
+import sqlite3
+
+import mapbox_vector_tile
+import numpy as np
+import shapely
+from pmtiles.convert import mbtiles_to_pmtiles
+
+MBTILES_PATH = "bmtc-data/tiles/bmtc.mbtiles"
+PMTILES_PATH = "bmtc-data/tiles/bmtc.pmtiles"
+MIN_ZOOM = 8
+MAX_ZOOM = 14
+# Layers are left out of the zooms below theirs, where thousands of stops would only blur into one another
+LAYER_MIN_ZOOMS = {"routes": MIN_ZOOM, "redundancy": MIN_ZOOM, "segments": 10, "aggregated": 10, "stops": 12}
+# List properties (hourly, stop_list, route_list) only go into tiles from this zoom on, where a tile holds few
+# features; lower zooms get the counts alone
+DETAIL_ZOOM = 13
+EXTENT = 4096
+# Features are clipped this many tile units outside their tile, so lines don't show seams at tile edges
+BUFFER = 64
+# Lines are simplified to this many tile units at each zoom
+SIMPLIFY_UNITS = 1.0
+# Half the width of the Web Mercator world, in metres
+MERCATOR_HALF = 20037508.342789244
+MAX_LATITUDE = 85.05112878
+
+
+def to_mercator(coordinates):
+    lons = coordinates[:, 0]
+    lats = np.clip(coordinates[:, 1], -MAX_LATITUDE, MAX_LATITUDE)
+    x = lons * MERCATOR_HALF / 180
+    y = np.log(np.tan(np.radians(90 + lats) / 2)) * MERCATOR_HALF / math.pi
+    return np.stack([x, y], axis=1)
+
+
+def tile_size(zoom):
+    return 2 * MERCATOR_HALF / (1 << zoom)
+
+
+# (minx, miny, maxx, maxy) of a tile in Web Mercator metres, y counting down from the top as in XYZ tile names
+def tile_bounds(zoom, x, y, buffer=0.0):
+    size = tile_size(zoom)
+    return (-MERCATOR_HALF + x * size - buffer, MERCATOR_HALF - (y + 1) * size - buffer,
+            -MERCATOR_HALF + (x + 1) * size + buffer, MERCATOR_HALF - y * size + buffer)
+
+
+# Vector tile properties must be scalars: lists are dropped below DETAIL_ZOOM and sent as JSON from it on
+def tile_properties(properties, zoom):
+    scalars = {}
+    for key, value in properties.items():
+        if isinstance(value, (list, tuple, dict)):
+            if zoom >= DETAIL_ZOOM:
+                scalars[key] = json.dumps(value, ensure_ascii=False)
+        elif value is not None:
+            scalars[key] = value
+    return scalars
+
+
+# Features of one layer at one zoom, simplified and clipped, grouped by the (x, y) of every tile they touch
+def layer_tiles(geometries, properties, zoom):
+    size = tile_size(zoom)
+    simplified = shapely.simplify(geometries, size / EXTENT * SIMPLIFY_UNITS)
+    buffer = size / EXTENT * BUFFER
+    bounds = shapely.bounds(simplified)
+    last = (1 << zoom) - 1
+    first_x = np.clip(np.floor((bounds[:, 0] - buffer + MERCATOR_HALF) / size), 0, last).astype(np.int64)
+    last_x = np.clip(np.floor((bounds[:, 2] + buffer + MERCATOR_HALF) / size), 0, last).astype(np.int64)
+    first_y = np.clip(np.floor((MERCATOR_HALF - bounds[:, 3] - buffer) / size), 0, last).astype(np.int64)
+    last_y = np.clip(np.floor((MERCATOR_HALF - bounds[:, 1] + buffer) / size), 0, last).astype(np.int64)
+
+    members = {}
+    for index in range(len(simplified)):
+        for x in range(first_x[index], last_x[index] + 1):
+            for y in range(first_y[index], last_y[index] + 1):
+                members.setdefault((x, y), []).append(index)
+
+    tiles = {}
+    for (x, y), indexes in members.items():
+        clipped = shapely.clip_by_rect(simplified[indexes], *tile_bounds(zoom, x, y, buffer))
+        features = [{"geometry": geometry, "properties": tile_properties(properties[index], zoom)}
+                    for index, geometry in zip(indexes, clipped) if not geometry.is_empty]
+        if features:
+            tiles[(x, y)] = features
+    return tiles
+
+
+# Web Mercator geometries and properties of a layer's features that have a geometry
+def mercator_layer(layer):
+    geometries, properties = layer
+    present = np.flatnonzero(shapely.is_geometry(geometries))
+    return shapely.transform(geometries[present], to_mercator), [properties[index] for index in present]
+
+
+def field_types(properties):
+    fields = {}
+    for feature_properties in properties:
+        for key, value in feature_properties.items():
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                fields.setdefault(key, "String")
+            else:
+                fields.setdefault(key, "Number")
+    return fields
+
+
+def metadata(layers, min_zoom, max_zoom):
+    geometries = np.concatenate([geometries for geometries, _ in layers.values()] + [np.array([], dtype=object)])
+    geometries = geometries[shapely.is_geometry(geometries)]
+    min_lon, min_lat, max_lon, max_lat = shapely.total_bounds(geometries) if len(geometries) else (0.0,) * 4
+    vector_layers = [{"id": name, "fields": field_types(properties),
+                      "minzoom": max(LAYER_MIN_ZOOMS.get(name, min_zoom), min_zoom), "maxzoom": max_zoom}
+                     for name, (_, properties) in layers.items()]
+    return {
+        "name": "bmtc",
+        "description": "BMTC routes and stops",
+        "format": "pbf",
+        "type": "overlay",
+        "minzoom": str(min_zoom),
+        "maxzoom": str(max_zoom),
+        "bounds": f"{min_lon},{min_lat},{max_lon},{max_lat}",
+        "center": f"{(min_lon + max_lon) / 2},{(min_lat + max_lat) / 2},{min_zoom + 2}",
+        "json": json.dumps({"vector_layers": vector_layers}),
+    }
+
+
+# Write {layer name: layer} as a zoom pyramid of gzipped Mapbox vector tiles in an MBTiles file
+def write_mbtiles(layers, path=MBTILES_PATH, min_zoom=MIN_ZOOM, max_zoom=MAX_ZOOM):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    mercator = {name: mercator_layer(layer) for name, layer in layers.items()}
+
+    connection = sqlite3.connect(tmp_path)
+    with connection:
+        connection.executescript("""
+            CREATE TABLE metadata (name TEXT, value TEXT);
+            CREATE TABLE tiles (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB);
+            CREATE UNIQUE INDEX tile_index ON tiles (zoom_level, tile_column, tile_row);
+        """)
+        connection.executemany("INSERT INTO metadata (name, value) VALUES (?, ?)",
+                               metadata(layers, min_zoom, max_zoom).items())
+        for zoom in range(min_zoom, max_zoom + 1):
+            tiles = {}
+            for name, (geometries, properties) in mercator.items():
+                if zoom < LAYER_MIN_ZOOMS.get(name, min_zoom):
+                    continue
+                for tile, features in layer_tiles(geometries, properties, zoom).items():
+                    tiles.setdefault(tile, []).append({"name": name, "features": features})
+
+            rows = []
+            for (x, y), tile_layers in tiles.items():
+                data = mapbox_vector_tile.encode(tile_layers, default_options={
+                    "quantize_bounds": tile_bounds(zoom, x, y), "extents": EXTENT})
+                # MBTiles number rows from the bottom (TMS), XYZ tile names from the top
+                rows.append((zoom, x, (1 << zoom) - 1 - y, gzip.compress(data, mtime=0)))
+            connection.executemany(
+                "INSERT INTO tiles (zoom_level, tile_column, tile_row, tile_data) VALUES (?, ?, ?, ?)", rows)
+            logging.info(f"Wrote {len(rows)} tiles at zoom {zoom} "
+                         f"({sum(len(row[3]) for row in rows) / 1024:.0f} KiB gzipped)")
+    connection.close()
+    os.replace(tmp_path, path)
+
+
+# The MBTiles tileset and a PMTiles copy of it, which the static site can read with HTTP range requests
+def write_tiles(layers, mbtiles_path=MBTILES_PATH, pmtiles_path=PMTILES_PATH, min_zoom=MIN_ZOOM, max_zoom=MAX_ZOOM):
+    write_mbtiles(layers, mbtiles_path, min_zoom, max_zoom)
+    mbtiles_to_pmtiles(mbtiles_path, pmtiles_path, max_zoom)
+
+
+# Write features as newline-delimited GeoJSON, one feature per line as it comes, so neither the writer nor its
+# readers need the whole layer in memory
+def write_ndjson(features, path):
+    count = 0
+    with open(path, 'w', encoding='utf-8') as f:
+        for feature in features:
+            f.write(json.dumps(feature, ensure_ascii=False, separators=(',', ':')))
+            f.write('\n')
+            count += 1
+    logging.info(f"Wrote {count} features to {path}")
+
+
+def feature_geometry(feature):
+    return shapely.geometry.shape(feature["geometry"]) if feature.get("geometry") else None
+
+
+def geometry_array(geometries):
+    array = np.empty(len(geometries), dtype=object)
+    array[:] = geometries
+    return array
+
+
+# A layer as the tiler and the exports take it: the shapely geometry of each feature (None where it has none) and
+# its properties, without the GeoJSON coordinate lists
+def collect_layer(features):
+    geometries, properties = [], []
+    for feature in features:
+        geometries.append(feature_geometry(feature))
+        properties.append(feature["properties"])
+    return geometry_array(geometries), properties
+
+
+# Write features as they are built into the GeoJSON FeatureCollection geojson.dump would write at path and the same
+# .ndjson next to it, and return them as a layer, so the whole FeatureCollection is never held in memory
+def write_layer(features, path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    geometries, properties = [], []
+    with open(path, 'w') as f:
+        def written():
+            for feature in features:
+                f.write(", " if properties else "")
+                f.write(json.dumps(feature))
+                geometries.append(feature_geometry(feature))
+                properties.append(feature["properties"])
+                yield feature
+        f.write('{"type": "FeatureCollection", "features": [')
+        write_ndjson(written(), f"{os.path.splitext(path)[0]}.ndjson")
+        f.write("]}")
+    return geometry_array(geometries), properties
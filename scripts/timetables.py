@@ -0,0 +1,44 @@
+import datetime
+import json
+
+from scripts.manifest import content_hash
+
+DAYS = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
+
+
+# Hash of what a timetable contributes to the feed, so identical days are detected regardless of response metadata
+def timetable_hash(timetable):
+    data = timetable["data"][0]
+    trips = [(trip["starttime"], trip["endtime"]) for trip in data["tripdetails"]]
+    return content_hash(json.dumps([data["tostationname"], trips]))
+
+
+# Group each route direction's daily timetables into {name: [(days, timetable)]}, one entry per distinct timetable
+def group_timetables(timetables_by_day):
+    variants = {}
+    for day_index, day in enumerate(DAYS):
+        for name, timetable in timetables_by_day.get(day, {}).items():
+            if timetable.get("Message") == "No Records Found." or not timetable.get("data"):
+                continue
+            days, _ = variants.setdefault(name, {}).setdefault(timetable_hash(timetable), ([], timetable))
+            days.append(day_index)
+
+    return {name: [(tuple(days), timetable) for days, timetable in by_hash.values()]
+            for name, by_hash in variants.items()}
+
+
+# Distinct weekly patterns across all route directions, in the order service periods are written
+def weekly_patterns(weekly_timetables):
+    return sorted({days for variants in weekly_timetables.values() for days, _ in variants})
+
+
+# Service IDs spell out the pattern Monday to Sunday, e.g. "1111100" for weekdays
+def service_id(days):
+    return "".join("1" if day_index in days else "0" for day_index in range(len(DAYS)))
+
+
+# The scraped week starts tomorrow
+def service_dates():
+    start_date = datetime.datetime.now() + datetime.timedelta(days=1)
+    end_date = datetime.datetime.now() + datetime.timedelta(days=7)
+    return start_date.strftime("%Y%m%d"), end_date.strftime("%Y%m%d")
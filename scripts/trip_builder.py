@@ -0,0 +1,261 @@
+import functools
+import logging
+import os
+import traceback
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from itertools import compress
+
+import numpy as np
+
+from scripts.fragment_cache import task_hash
+from scripts.geometry import project_onto_shape
+from scripts.metrics import metrics
+
+DIRECTIONS = ["UP", "DOWN"]
+SECONDS_PER_DAY = 24 * 3600
+# Trips whose start times drift from a steady headway by up to this many seconds still count as one run
+HEADWAY_TOLERANCE = 60
+# Shortest run of trips worth replacing with a frequencies.txt row
+MIN_HEADWAY_TRIPS = 3
+
+# How build_all compacts steady-headway runs of trips into frequencies, None keeps every trip
+HeadwayPolicy = namedtuple('HeadwayPolicy', ['tolerance', 'min_trips'], defaults=[HEADWAY_TOLERANCE, MIN_HEADWAY_TRIPS])
+
+
+# "HH:MM" to seconds since midnight, accepting the same values as strptime('%H:%M')
+def parse_time(value):
+    hours, minutes = value.split(':')
+    hours, minutes = int(hours), int(minutes)
+    if not (0 <= hours < 24 and 0 <= minutes < 60):
+        raise ValueError(f"time data {value!r} does not match format '%H:%M'")
+    return hours * 3600 + minutes * 60
+
+
+def format_time(seconds):
+    return f"{seconds // 3600:02d}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+
+
+# Every GTFS time string a trip ending the next day can need, indexed by seconds since midnight
+@functools.lru_cache(maxsize=None)
+def time_strings():
+    return np.array([format_time(seconds) for seconds in range(2 * SECONDS_PER_DAY)], dtype=object)
+
+
+# Where each stop sits between the first and last stop, by distance along the shape, or evenly spaced when the
+# stops do not spread out along it
+def stop_fractions(stop_distances):
+    if len(stop_distances) < 2:
+        return np.zeros(len(stop_distances))
+    total = stop_distances[-1] - stop_distances[0]
+    if total <= 0:
+        return np.linspace(0.0, 1.0, len(stop_distances))
+    return (stop_distances - stop_distances[0]) / total
+
+
+# Stop times of every trip of a direction in one operation, as a trips × stops array of seconds since midnight.
+# Trips ending before they start run past midnight and get times beyond 24:00:00, as GTFS expects.
+def interpolate_stop_times(start_times, end_times, fractions):
+    starts = np.asarray(start_times)
+    ends = np.asarray(end_times)
+    ends = np.where(ends < starts, ends + SECONDS_PER_DAY, ends)
+    return np.rint(starts[:, None] + (ends - starts)[:, None] * fractions[None, :]).astype(np.int64)
+
+
+# Everything one route needs to build its trips, small enough to send to a worker process.
+# route_shapes maps each route line name to its (shape_id, lats, lons), see shapes.route_shapes.
+def route_task(route, route_id, stop_lists, route_shapes, weekly_timetables):
+    directions = {}
+    for direction in DIRECTIONS:
+        name = f"{route} {direction}"
+        stop_list = (stop_lists.get(route) or {}).get(direction.lower(), {}).get("data")
+        shape_id, shape_lats, shape_lons = route_shapes.get(name, (None, None, None))
+        directions[direction] = {
+            "stop_ids": [str(stop["stationid"]) for stop in stop_list] if stop_list else None,
+            "stop_lats": [stop["centerlat"] for stop in stop_list] if stop_list else None,
+            "stop_lons": [stop["centerlong"] for stop in stop_list] if stop_list else None,
+            "shape_id": shape_id,
+            "shape_lats": shape_lats,
+            "shape_lons": shape_lons,
+            "timetables": weekly_timetables.get(name),
+        }
+    return route, route_id, directions
+
+
+# Trips and stop times of one route as a fragment; trip indexes are local and numbered when fragments are merged
+def build_route_fragment(task):
+    route, route_id, directions = task
+    fragment = {
+        "trips": {"route_id": [], "days": [], "trip_headsign": [], "direction_id": [], "shape_id": [],
+                  "start_time": [], "duration": []},
+        "stop_times": {"trip_index": [], "arrival_time": [], "stop_id": [], "stop_sequence": [],
+                       "shape_dist_traveled": []},
+        "added": [], "no_stops": [], "no_timetables": [], "no_shapes": [], "errors": [],
+    }
+    trips, stop_times = fragment["trips"], fragment["stop_times"]
+
+    for direction, inputs in directions.items():
+        name = f"{route} {direction}"
+        if not inputs["stop_ids"]:
+            fragment["no_stops"].append(name)
+            continue
+        if not inputs["shape_lats"]:
+            fragment["no_shapes"].append(name)
+            continue
+        if not inputs["timetables"]:
+            fragment["no_timetables"].append(name)
+            continue
+
+        try:
+            stop_ids = inputs["stop_ids"]
+            # Stops are projected onto the shape once per direction, not once per trip
+            stop_distances = project_onto_shape(inputs["shape_lats"], inputs["shape_lons"],
+                                                inputs["stop_lats"], inputs["stop_lons"])
+            direction_trips, start_times, end_times = [], [], []
+            for days, timetables in inputs["timetables"]:
+                headsign = timetables["data"][0]["tostationname"]
+                for trip in timetables["data"][0]["tripdetails"]:
+                    direction_trips.append((days, headsign))
+                    start_times.append(parse_time(trip["starttime"]))
+                    end_times.append(parse_time(trip["endtime"]))
+            seconds = interpolate_stop_times(start_times, end_times, stop_fractions(stop_distances))
+            durations = (seconds[:, -1] - seconds[:, 0]).tolist()
+            times = time_strings()[seconds.ravel()].tolist()
+        except Exception:
+            fragment["errors"].append((name, traceback.format_exc()))
+            continue
+
+        offset = len(trips["route_id"])
+        for (days, headsign), start_time, duration in zip(direction_trips, start_times, durations):
+            trips["start_time"].append(start_time)
+            trips["duration"].append(duration)
+            trips["route_id"].append(route_id)
+            trips["days"].append(days)
+            trips["trip_headsign"].append(headsign)
+            trips["direction_id"].append(0 if direction == "UP" else 1)
+            trips["shape_id"].append(inputs["shape_id"])
+        stop_times["trip_index"].extend(np.repeat(np.arange(offset, offset + len(direction_trips)),
+                                                  len(stop_ids)).tolist())
+        stop_times["arrival_time"].extend(times)
+        stop_times["stop_id"].extend(stop_ids * len(direction_trips))
+        stop_times["stop_sequence"].extend(list(range(1, len(stop_ids) + 1)) * len(direction_trips))
+        stop_times["shape_dist_traveled"].extend(np.round(stop_distances, 3).tolist() * len(direction_trips))
+        fragment["added"].append(name)
+
+    return fragment
+
+
+# Runs of at least min_trips start times (sorted) whose gaps stay within tolerance of the run's first gap,
+# as (first, last) positions
+def headway_runs(start_times, tolerance, min_trips):
+    runs = []
+    first = 0
+    while first < len(start_times) - 1:
+        headway = start_times[first + 1] - start_times[first]
+        last = first + 1
+        while last + 1 < len(start_times) and abs(start_times[last + 1] - start_times[last] - headway) <= tolerance:
+            last += 1
+        if headway > 0 and last - first + 1 >= min_trips:
+            runs.append((first, last))
+            first = last + 1
+        else:
+            first += 1
+    return runs
+
+
+# Replace each steady-headway run of trips sharing a direction, shape, service days, headsign and running time with
+# its first trip plus a frequency, returns a new fragment with a "frequencies" table keyed by the template trip's index
+def compact_headways(fragment, tolerance=HEADWAY_TOLERANCE, min_trips=MIN_HEADWAY_TRIPS):
+    trips, stop_times = fragment["trips"], fragment["stop_times"]
+    groups = {}
+    for index, key in enumerate(zip(trips["direction_id"], trips["shape_id"], trips["days"], trips["trip_headsign"],
+                                    trips["duration"])):
+        groups.setdefault(key, []).append(index)
+
+    keep = [True] * len(trips["route_id"])
+    runs = {}
+    for indexes in groups.values():
+        indexes.sort(key=lambda index: trips["start_time"][index])
+        start_times = [trips["start_time"][index] for index in indexes]
+        for first, last in headway_runs(start_times, tolerance, min_trips):
+            gaps = {start_times[position + 1] - start_times[position] for position in range(first, last)}
+            headway = round((start_times[last] - start_times[first]) / (last - first))
+            # Trips start every headway from start_time until before end_time, so ending the run after as many
+            # headways as it has trips keeps their number when the headway is rounded down
+            end_time = start_times[first] + (last - first + 1) * headway
+            runs[indexes[first]] = (start_times[first], end_time, headway, int(len(gaps) == 1))
+            for position in range(first + 1, last + 1):
+                keep[indexes[position]] = False
+
+    renumbered = np.cumsum(keep) - 1
+    kept_stop_times = [keep[index] for index in stop_times["trip_index"]]
+    frequencies = {"trip_index": [], "start_time": [], "end_time": [], "headway_secs": [], "exact_times": []}
+    for index in sorted(runs):
+        start_time, end_time, headway, exact_times = runs[index]
+        frequencies["trip_index"].append(int(renumbered[index]))
+        frequencies["start_time"].append(start_time)
+        frequencies["end_time"].append(end_time)
+        frequencies["headway_secs"].append(headway)
+        frequencies["exact_times"].append(exact_times)
+
+    compacted = {**fragment, "frequencies": frequencies}
+    compacted["trips"] = {column: list(compress(values, keep)) for column, values in trips.items()}
+    compacted["stop_times"] = {column: list(compress(values, kept_stop_times)) for column, values in stop_times.items()}
+    compacted["stop_times"]["trip_index"] = renumbered[compacted["stop_times"]["trip_index"]].tolist()
+    return compacted
+
+
+# Build the fragments of every route, across a process pool when more than one worker is asked for.
+# Fragments come back in task order, so the merged feed does not depend on the number of workers.
+def build_fragments(tasks, workers=None):
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or len(tasks) < 2:
+        fragments = [build_route_fragment(task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            fragments = list(executor.map(build_route_fragment, tasks,
+                                          chunksize=max(1, len(tasks) // (workers * 4))))
+    return fragments
+
+
+# Build every route's fragment and log the same summary add_trips always has, returns (fragments, missing lists).
+# With a FragmentCache, only routes whose inputs changed since the last build are rebuilt. With a HeadwayPolicy,
+# steady-headway runs of trips become frequencies.
+def build_all(routes, stop_lists, route_shapes, weekly_timetables, workers=None, cache=None, headways=None):
+    tasks = [route_task(route, route_id, stop_lists, route_shapes, weekly_timetables)
+             for route, route_id in routes.items()]
+
+    with metrics.stage("trips", children=True):
+        if cache is None:
+            fragments = build_fragments(tasks, workers)
+            metrics.count("routes built", len(fragments))
+        else:
+            hashes = {task[0]: task_hash(task) for task in tasks}
+            cached = cache.lookup(hashes)
+            stale_tasks = [task for task in tasks if task[0] not in cached]
+            built = {task[0]: fragment for task, fragment in zip(stale_tasks, build_fragments(stale_tasks, workers))}
+            cache.update(built, hashes)
+            logging.info(f"Reused {len(cached)} cached route fragments, rebuilt {len(built)}")
+            metrics.count("routes reused", len(cached))
+            metrics.count("routes built", len(built))
+            fragments = [cached.get(task[0]) or built[task[0]] for task in tasks]
+
+    for fragment in fragments:
+        for name, error in fragment["errors"]:
+            logging.info(f"Failed to process timetable for route {name}")
+            logging.error(error)
+
+    if headways is not None:
+        trip_count = sum(len(fragment["trips"]["route_id"]) for fragment in fragments)
+        fragments = [compact_headways(fragment, headways.tolerance, headways.min_trips) for fragment in fragments]
+        logging.info(f"Compacted {trip_count} trips into "
+                     f"{sum(len(fragment['trips']['route_id']) for fragment in fragments)} trips and "
+                     f"{sum(len(fragment['frequencies']['trip_index']) for fragment in fragments)} frequencies")
+
+    missing = tuple([name for fragment in fragments for name in fragment[key]]
+                    for key in ("no_timetables", "no_stops", "no_shapes"))
+    logging.info(f"Added {sum(len(fragment['added']) for fragment in fragments)} trips")
+    logging.info(f"Missing timetable for {len(missing[0])} routes")
+    logging.info(f"Missing stops list for {len(missing[1])} routes")
+    logging.info(f"Missing shape for {len(missing[2])} routes")
+    return fragments, missing
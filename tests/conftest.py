@@ -0,0 +1,29 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+from synthetic import build_store, read_zip
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+# A fresh working directory laid out like the repository's, with the synthetic raw store in it
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    for directory in ("logs", "bmtc-data/raw", "bmtc-data/gtfs/intermediate"):
+        (tmp_path / directory).mkdir(parents=True)
+    monkeypatch.chdir(tmp_path)
+    build_store("bmtc-data/raw/raw.db")
+    return tmp_path
+
+
+# Runs scripts.gtfs in its own process, as transitfeed keeps one Schedule per process, and returns the zip's files
+@pytest.fixture
+def build_gtfs(workdir):
+    def build(*args):
+        subprocess.run([sys.executable, "-m", "scripts.gtfs", "--full", *args], cwd=workdir, check=True,
+                       capture_output=True, env={**os.environ, "PYTHONPATH": ROOT})
+        return read_zip(workdir / "bmtc-data/gtfs/intermediate/bmtc.zip")
+    return build
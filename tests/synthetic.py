@@ -0,0 +1,73 @@
+import json
+import random
+import zipfile
+
+from scripts.gtfs_columnar import build_feed, write_feed
+from scripts.raw_store import RawStore
+from scripts.stop_clusters import ClusterPolicy
+from scripts.timetables import DAYS, group_timetables
+
+ROUTES = 6
+STOPS = 40
+
+
+def put_json(store, endpoint, key, data, day=''):
+    store.put(endpoint, key, json.dumps(data).encode('utf-8'), day=day)
+
+
+# Steady trips every 15 minutes, later at weekends, and one trip running past midnight
+def timetable(day_index, offset=0):
+    start = (6 if day_index < 5 else 7) * 60 + offset
+    trips = [{"starttime": f"{(start + k * 15) // 60:02d}:{(start + k * 15) % 60:02d}",
+              "endtime": f"{(start + k * 15 + 50) // 60:02d}:{(start + k * 15 + 50) % 60:02d}"} for k in range(8)]
+    trips.append({"starttime": "23:30", "endtime": "00:20"})
+    return {"data": [{"tostationname": "B", "tripdetails": trips}], "Issuccess": True, "Message": "ok"}
+
+
+# A raw store like the scraper's, with six routes over 40 stops in a line. R0 also calls at a platform next to its
+# third stop, so the feed gets a parent station, and its stops lie on the shape, so some are at distance zero.
+def build_store(path, offsets=None):
+    offsets = offsets or {}
+    points = random.Random(1)
+    stops = [(1000 + i, f"Stop {i}", 12.9 + 0.003 * i, 77.5 + 0.002 * i) for i in range(STOPS)]
+    stops.append((2000, "Stop 3 Platform 1", 12.9 + 0.003 * 3 + 0.0003, 77.5 + 0.002 * 3))
+    routes = {"data": []}
+    with RawStore(path) as store:
+        for r in range(ROUTES):
+            name = f"R{r}"
+            for direction in ("UP", "DOWN"):
+                routes["data"].append({"routeno": f"{name} {direction}", "routeid": r * 10 + (direction == "DOWN"),
+                                       "fromstation": "A", "tostation": "B"})
+            line = stops[r * 5:r * 5 + 10]
+            if r == 0:
+                line = line[:3] + [stops[-1]] + line[3:]
+            up = [{"stationid": sid, "stationname": stop_name, "centerlat": lat, "centerlong": lon}
+                  for sid, stop_name, lat, lon in line]
+            put_json(store, 'SearchByRouteDetails_v4', name, {"up": {"data": up}, "down": {"data": up[::-1]}})
+            for direction, direction_stops in (("UP", line), ("DOWN", line[::-1])):
+                put_json(store, 'RoutePoints', f"{name} {direction}",
+                         {"data": [{"latitude": lat + points.uniform(-1e-5, 1e-5), "longitude": lon}
+                                   for _, _, lat, lon in direction_stops]})
+                for day_index, day in enumerate(DAYS):
+                    put_json(store, 'GetTimetableByRouteid_v3', f"{name} {direction}",
+                             timetable(day_index, offsets.get(name, 0)), day=day)
+        put_json(store, 'GetAllRouteList', 'all', routes)
+        put_json(store, 'SearchRoute_v2', 'r', {"data": [{"routeno": "R0", "routeparentid": 1}]})
+
+
+
+def read_zip(path):
+    with zipfile.ZipFile(path) as archive:
+        return {name: archive.read(name) for name in archive.namelist()}
+
+
+# Build the store in the working directory into a feed at path with the columnar engine and gtfs.py's default
+# parent stations, returns the zip's bytes
+def build_columnar(path, cache=None, headways=None):
+    with RawStore("bmtc-data/raw/raw.db") as store:
+        tables, _ = build_feed(store.load_all('SearchByRouteDetails_v4'), store.get('GetAllRouteList', 'all'),
+                               store.load_all('RoutePoints'),
+                               group_timetables(store.load_by_day('GetTimetableByRouteid_v3')), workers=1,
+                               cache=cache, headways=headways, clusters=ClusterPolicy())
+    write_feed(tables, path)
+    return path.read_bytes()
@@ -0,0 +1,77 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+from scripts import feed as feed_module
+from scripts.feed import FEED_CACHE_PATH, Feed, load_feed
+
+from synthetic import build_columnar, build_store
+
+TABLES = ["agency", "calendar", "stops", "routes", "trips", "stop_times", "shapes"]
+
+
+def test_tables_are_parsed_once_and_cached(workdir, monkeypatch):
+    build_columnar(workdir / "bmtc.zip")
+    parsed = []
+    parse_table = feed_module.parse_table
+    monkeypatch.setattr(feed_module, "parse_table", lambda f: parsed.append(f.name) or parse_table(f))
+
+    feed = Feed(str(workdir / "bmtc.zip"))
+    stop_times = feed.stop_times
+    assert feed.stop_times is stop_times
+    assert parsed == ["stop_times.txt"]
+    pd.testing.assert_frame_equal(Feed(str(workdir / "bmtc.zip")).stop_times, stop_times)
+    assert parsed == ["stop_times.txt"]
+
+
+# Stages running side by side load tables of one shared feed, and of another version of it, at the same time
+def test_concurrent_loads(workdir, monkeypatch):
+    build_columnar(workdir / "bmtc.zip")
+    build_store("bmtc-data/raw/raw.db", offsets={"R1": 5})
+    build_columnar(workdir / "other.zip")
+    parsed = []
+    parse_table = feed_module.parse_table
+    monkeypatch.setattr(feed_module, "parse_table", lambda f: parsed.append(f.name) or parse_table(f))
+    monkeypatch.setattr(feed_module, "_feeds", {})
+
+    paths = [str(workdir / "bmtc.zip"), str(workdir / "other.zip")]
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        loaded = list(executor.map(lambda job: load_feed(paths[job % 2]).table(TABLES[job // 2 % len(TABLES)]),
+                                   range(4 * 2 * len(TABLES))))
+
+    assert sorted(parsed) == sorted([f"{name}.txt" for name in TABLES] * 2)
+    for job, df in enumerate(loaded):
+        assert df is load_feed(paths[job % 2]).table(TABLES[job // 2 % len(TABLES)])
+    digests = sorted(load_feed(path).digest for path in paths)
+    assert sorted(os.listdir(FEED_CACHE_PATH)) == digests
+    for digest in digests:
+        assert sorted(os.listdir(os.path.join(FEED_CACHE_PATH, digest))) == sorted(f"{name}.feather"
+                                                                                  for name in TABLES)
+
+
+# A shared feed is only hashed again once its file changes, and a new version of it replaces the old one
+def test_load_feed_hashes_changed_files_only(workdir, monkeypatch):
+    path = str(workdir / "bmtc.zip")
+    build_columnar(workdir / "bmtc.zip")
+    hashed = []
+    file_hash = feed_module.file_hash
+    monkeypatch.setattr(feed_module, "file_hash", lambda path: hashed.append(path) or file_hash(path))
+    monkeypatch.setattr(feed_module, "_feeds", {})
+
+    feed = load_feed(path)
+    assert load_feed(path) is feed
+    assert hashed == [path]
+
+    os.utime(path, ns=(0, 0))
+    assert load_feed(path) is feed
+    assert len(hashed) == 2
+
+    build_store("bmtc-data/raw/raw.db", offsets={"R1": 5})
+    build_columnar(workdir / "bmtc.zip")
+    os.utime(path, ns=(10 ** 9, 10 ** 9))
+    changed = load_feed(path)
+    assert changed is not feed and changed.digest != feed.digest
+    assert list(feed_module._feeds) == [path]
+    assert load_feed(path) is changed
+    assert len(hashed) == 3
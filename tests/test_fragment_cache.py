@@ -0,0 +1,45 @@
+import pytest
+
+from scripts import trip_builder
+from scripts.fragment_cache import FragmentCache
+
+from synthetic import ROUTES, build_columnar, build_store
+
+
+@pytest.fixture
+def built_routes(monkeypatch):
+    built = []
+    build_route_fragment = trip_builder.build_route_fragment
+
+    def spy(task):
+        built.append(task[0])
+        return build_route_fragment(task)
+    monkeypatch.setattr(trip_builder, "build_route_fragment", spy)
+    return built
+
+
+@pytest.mark.parametrize("headways", [None, trip_builder.HeadwayPolicy()])
+def test_cache_hits_build_the_same_zip_as_a_full_rebuild(workdir, built_routes, headways):
+    full = build_columnar(workdir / "full.zip", headways=headways)
+    with FragmentCache("bmtc-data/gtfs/intermediate/fragments.db") as cache:
+        built_routes.clear()
+        first = build_columnar(workdir / "first.zip", cache, headways)
+        assert len(built_routes) == ROUTES
+        built_routes.clear()
+        cached = build_columnar(workdir / "cached.zip", cache, headways)
+        assert built_routes == []
+    assert first == full
+    assert cached == full
+
+
+# After one route's timetables change, only that route is rebuilt and the feed is still the same as a full rebuild
+def test_changed_route_is_rebuilt(workdir, built_routes):
+    with FragmentCache("bmtc-data/gtfs/intermediate/fragments.db") as cache:
+        before = build_columnar(workdir / "before.zip", cache)
+        build_store("bmtc-data/raw/raw.db", offsets={"R2": 5})
+        built_routes.clear()
+        incremental = build_columnar(workdir / "incremental.zip", cache)
+        assert built_routes == ["R2"]
+    full = build_columnar(workdir / "full.zip")
+    assert incremental == full
+    assert incremental != before
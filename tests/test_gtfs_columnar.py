@@ -0,0 +1,11 @@
+import pytest
+
+
+# The columnar engine writes the same files as transitfeed, byte for byte
+@pytest.mark.parametrize("options", [[], ["--frequencies"], ["--no-parent-stations"]])
+def test_engines_write_the_same_feed(build_gtfs, options):
+    transitfeed = build_gtfs("--engine", "transitfeed", *options)
+    columnar = build_gtfs("--engine", "columnar", *options)
+    assert sorted(columnar) == sorted(transitfeed)
+    for name in transitfeed:
+        assert columnar[name] == transitfeed[name], name
@@ -0,0 +1,99 @@
+import io
+import shutil
+import subprocess
+
+import pandas as pd
+import pytest
+
+from scripts.gtfs_minimizer import minimize, read_tables, short_ids, write_tables
+
+from synthetic import build_columnar
+
+CALENDAR = ["monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday", "start_date", "end_date"]
+
+
+def number(value, digits=6):
+    return round(float(value), digits) if value != "" else None
+
+
+# Every trip of a feed with all of its IDs resolved into what they stand for, as a set: what riders could tell apart
+def resolved_trips(tables):
+    stops = tables['stops.txt'].set_index('stop_id')
+    stop_rows = {stop_id: (row.stop_name, number(row.stop_lat), number(row.stop_lon))
+                 for stop_id, row in stops.iterrows()}
+    routes = tables['routes.txt'].set_index('route_id')
+    calendar = tables['calendar.txt'].set_index('service_id')
+    shapes = {shape_id: tuple((number(row.shape_pt_lat), number(row.shape_pt_lon))
+                              for row in points.sort_values('shape_pt_sequence', key=lambda s: s.astype(int))
+                              .itertuples())
+              for shape_id, points in tables['shapes.txt'].groupby('shape_id')}
+    stop_times = {trip_id: tuple((stop_rows[row.stop_id], row.arrival_time, row.departure_time,
+                                  number(row.shape_dist_traveled, 3) if row.shape_dist_traveled else None)
+                                 for row in rows.sort_values('stop_sequence', key=lambda s: s.astype(int))
+                                 .itertuples())
+                  for trip_id, rows in tables['stop_times.txt'].groupby('trip_id')}
+    frequencies = tables.get('frequencies.txt', pd.DataFrame(columns=['trip_id']))
+    frequencies = {trip_id: tuple(sorted(map(tuple, rows.drop(columns='trip_id').to_numpy().tolist())))
+                   for trip_id, rows in frequencies.groupby('trip_id')}
+    return {(routes.at[trip.route_id, 'route_short_name'], routes.at[trip.route_id, 'route_long_name'],
+             tuple(calendar.loc[trip.service_id, CALENDAR]), trip.trip_headsign, trip.direction_id,
+             shapes[trip.shape_id], stop_times[trip.trip_id], frequencies.get(trip.trip_id, ()))
+            for trip in tables['trips.txt'].itertuples()}
+
+
+# The synthetic feed with a copy of a stop, a shape, a service and a trip under new IDs, for the minimizer to merge
+@pytest.fixture
+def duplicated_feed(workdir):
+    build_columnar(workdir / "feed.zip")
+    tables = read_tables(workdir / "feed.zip")
+    for name, column, old, new in [('stops.txt', 'stop_id', '1005', 'copy'),
+                                   ('shapes.txt', 'shape_id', 'R1 UP', 'copy'),
+                                   ('calendar.txt', 'service_id', '1111100', 'copy')]:
+        df = tables[name]
+        tables[name] = pd.concat([df, df.loc[df[column] == old].assign(**{column: new})], ignore_index=True)
+    trips, stop_times = tables['trips.txt'], tables['stop_times.txt']
+    trip = trips.loc[trips['shape_id'] == 'R1 UP'].iloc[0]['trip_id']
+    tables['trips.txt'] = pd.concat([trips, trips.loc[trips['trip_id'] == trip].assign(
+        trip_id='copy', shape_id='copy', service_id='copy')], ignore_index=True)
+    copied = stop_times.loc[stop_times['trip_id'] == trip].assign(trip_id='copy')
+    tables['stop_times.txt'] = pd.concat([stop_times, copied.assign(
+        stop_id=copied['stop_id'].replace('1005', 'copy'))], ignore_index=True)
+    write_tables(tables, workdir / "duplicated.zip")
+    return workdir / "duplicated.zip"
+
+
+def test_minimize_merges_duplicates_and_keeps_every_trip(workdir, duplicated_feed):
+    minimize(str(duplicated_feed), str(workdir / "minimized.zip"))
+    original, minimized = read_tables(duplicated_feed), read_tables(workdir / "minimized.zip")
+    assert resolved_trips(minimized) == resolved_trips(original)
+    for name, column in [('shapes.txt', 'shape_id'), ('calendar.txt', 'service_id'), ('trips.txt', 'trip_id')]:
+        assert minimized[name][column].nunique() == original[name][column].nunique() - 1, name
+    assert len(minimized['stop_times.txt']) == len(original['stop_times.txt'].query("trip_id != 'copy'"))
+    stops = minimized['stops.txt']
+    assert not stops.drop(columns='stop_id').duplicated().any()
+    used = set(minimized['stop_times.txt']['stop_id']) | set(stops['parent_station']) - {""}
+    assert set(stops['stop_id']) == used
+
+
+# The in-process minimizer and gtfstidy -SCRmcdsOeD, which the tidy stage runs under docker, describe the same trips
+# with as many rows. Needs a gtfstidy binary on the PATH.
+@pytest.mark.skipif(shutil.which("gtfstidy") is None, reason="gtfstidy is not installed")
+def test_minimize_matches_gtfstidy(workdir, duplicated_feed):
+    minimize(str(duplicated_feed), str(workdir / "minimized.zip"))
+    subprocess.run(["gtfstidy", "-SCRmcdsOeD", str(duplicated_feed), "-o", str(workdir / "tidied.zip")], check=True,
+                   capture_output=True)
+    minimized, tidied = read_tables(workdir / "minimized.zip"), read_tables(workdir / "tidied.zip")
+    assert resolved_trips(minimized) == resolved_trips(tidied)
+    for name in ('stops.txt', 'routes.txt', 'trips.txt', 'stop_times.txt', 'shapes.txt', 'calendar.txt'):
+        assert len(minimized[name]) == len(tidied[name]), name
+
+
+# Past 30191 ("nan") the base 36 IDs would spell values pandas reads as missing, which would break joins on them
+def test_short_ids_are_never_read_as_missing():
+    ids = short_ids(40000)
+    assert len(set(ids)) == len(ids)
+    assert ids[:3] == ["0", "1", "2"]
+    assert not {"inf", "nan"} & set(ids)
+    column = pd.read_csv(io.StringIO("\n".join(["trip_id"] + ids)))['trip_id']
+    assert column.notna().all()
+    assert column.astype(str).tolist() == ids
@@ -0,0 +1,50 @@
+import subprocess
+import sys
+import threading
+import time
+
+import numpy as np
+
+from scripts.metrics import Metrics
+
+BUSY = "sum(range(10 ** 7))"
+
+
+# Worker processes only count towards stages that say they start them, never towards stages alongside them
+def test_child_cpu_time_is_kept_apart_from_the_stage_own():
+    metrics = Metrics()
+    started = threading.Event()
+
+    def alongside():
+        with metrics.stage("alongside"):
+            started.set()
+            worker.join()
+
+    def run_worker():
+        started.wait()
+        with metrics.stage("workers", children=True):
+            subprocess.run([sys.executable, "-c", BUSY], check=True)
+
+    worker = threading.Thread(target=run_worker)
+    other = threading.Thread(target=alongside)
+    worker.start()
+    other.start()
+    other.join()
+
+    workers, alongside_entry = metrics.stages["workers"], metrics.stages["alongside"]
+    assert workers['child_cpu_s'] > 0.05
+    assert workers['cpu_s'] < workers['child_cpu_s']
+    assert 'child_cpu_s' not in alongside_entry
+    assert alongside_entry['cpu_s'] < workers['child_cpu_s']
+
+
+# A stage reports the memory it used itself, not the largest any earlier stage reached
+def test_peak_rss_is_sampled_per_stage():
+    metrics = Metrics()
+    with metrics.stage("large"):
+        block = np.ones(32 * 1024 * 1024)
+        time.sleep(0.2)
+        del block
+    with metrics.stage("small"):
+        time.sleep(0.2)
+    assert metrics.stages["large"]['peak_rss_mb'] > metrics.stages["small"]['peak_rss_mb'] + 128
@@ -0,0 +1,52 @@
+import asyncio
+import importlib
+
+import pytest
+
+from scripts.manifest import Manifest
+from scripts.raw_store import RawStore
+
+
+# Answers every request with one status and body, or raises the given exception
+class FakeFetcher:
+    def __init__(self, status=200, body=b'{}', error=None):
+        self.status, self.body, self.error = status, body, error
+        self.posted = []
+
+    async def post(self, endpoint, data=None):
+        self.posted.append(endpoint)
+        if self.error:
+            raise self.error
+        return self.status, self.body
+
+
+# scripts.scrape opens its debug log under logs/ when imported, so it is only imported inside a working directory
+@pytest.fixture
+def scrape_module(workdir):
+    return importlib.import_module("scripts.scrape")
+
+
+@pytest.mark.parametrize("error", [asyncio.CancelledError(), KeyboardInterrupt()])
+def test_interrupted_fetches_are_not_recorded_as_failures(scrape_module, workdir, error):
+    manifest = Manifest(str(workdir / "manifest.json"))
+    ctx = scrape_module.Context(FakeFetcher(error=error), manifest, None, None)
+    with pytest.raises(type(error)):
+        asyncio.run(scrape_module.post_recorded(ctx, 'RoutePoints', '1', '{}'))
+    assert manifest.get('RoutePoints', '1') is None
+
+
+def test_failed_fetches_are_recorded(scrape_module, workdir):
+    manifest = Manifest(str(workdir / "manifest.json"))
+    ctx = scrape_module.Context(FakeFetcher(status=500), manifest, None, None)
+    with pytest.raises(RuntimeError):
+        asyncio.run(scrape_module.post_recorded(ctx, 'RoutePoints', '1', '{}'))
+    assert manifest.get('RoutePoints', '1')['status'] == 'failed'
+
+
+# Without the route list there is nothing to fetch route lines, timetables or stop lists for
+def test_scrape_stops_without_the_route_list(scrape_module, workdir):
+    fetcher = FakeFetcher(status=500, body=b'down')
+    with RawStore(str(workdir / "scrape.db")) as store:
+        with pytest.raises(RuntimeError, match="route list"):
+            asyncio.run(scrape_module.scrape(fetcher, Manifest(str(workdir / "manifest.json")), store))
+    assert set(fetcher.posted) == {'GetAllRouteList', 'SearchRoute_v2'}
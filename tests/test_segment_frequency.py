@@ -0,0 +1,19 @@
+from scripts import trip_builder
+from scripts.feed import load_feed, service_date
+from scripts.segment_frequency import segment_features, segment_frequency
+
+from synthetic import build_columnar
+
+
+def counts(path):
+    feed = load_feed(str(path))
+    features = segment_features(segment_frequency(feed, service_date(feed)))
+    return sorted((feature["geometry"]["coordinates"], feature["properties"]["trip_count"]) for feature in features)
+
+
+# A frequencies.txt template counts once per departure, so compacting the feed does not change the counts
+def test_counts_are_the_same_with_and_without_frequencies(workdir):
+    build_columnar(workdir / "trips.zip")
+    build_columnar(workdir / "frequencies.zip", headways=trip_builder.HeadwayPolicy())
+    assert "frequencies" in load_feed(str(workdir / "frequencies.zip"))
+    assert counts(workdir / "frequencies.zip") == counts(workdir / "trips.zip")
@@ -0,0 +1,43 @@
+import io
+import json
+
+import geopandas as gpd
+import shapely
+from geojson import dump
+
+from scripts.csv_creator import layer_frame
+from scripts.tiles import collect_layer, write_layer
+
+FEATURES = [
+    {"type": "Feature", "geometry": {"type": "LineString", "coordinates": [[77.5, 12.9], [77.51, 12.91]]},
+     "properties": {"name": "R1 → Majestic", "trip_count": 12, "stop_list": ["A", "B"]}},
+    {"type": "Feature", "geometry": None, "properties": {"name": "R2", "trip_count": 0, "stop_list": []}},
+    {"type": "Feature", "geometry": {"type": "Point", "coordinates": [77.52, 12.92]},
+     "properties": {"name": "Stop", "trip_count": 3, "stop_list": None}},
+]
+
+
+# Features streamed from a generator make the same FeatureCollection as geojson.dump of all of them, and the .ndjson
+def test_write_layer_streams_the_same_files(tmp_path):
+    geometries, properties = write_layer((feature for feature in FEATURES), str(tmp_path / "layer.geojson"))
+    expected = io.StringIO()
+    dump({"type": "FeatureCollection", "features": FEATURES}, expected)
+    assert (tmp_path / "layer.geojson").read_text() == expected.getvalue()
+    lines = (tmp_path / "layer.ndjson").read_text(encoding='utf-8').splitlines()
+    assert [json.loads(line) for line in lines] == FEATURES
+    assert properties == [feature["properties"] for feature in FEATURES]
+    assert geometries[1] is None
+    assert shapely.equals(geometries[0], shapely.geometry.shape(FEATURES[0]["geometry"]))
+
+
+def test_layer_frame_matches_from_features():
+    gdf = layer_frame(collect_layer(FEATURES))
+    expected = gpd.GeoDataFrame.from_features(FEATURES, crs="EPSG:4326")
+    assert gdf.to_json() == expected.to_json()
+
+
+def test_empty_layer(tmp_path):
+    geometries, properties = write_layer(iter([]), str(tmp_path / "empty.geojson"))
+    assert json.loads((tmp_path / "empty.geojson").read_text()) == {"type": "FeatureCollection", "features": []}
+    assert (tmp_path / "empty.ndjson").read_text() == ""
+    assert len(geometries) == 0 and properties == []
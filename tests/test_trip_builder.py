@@ -0,0 +1,140 @@
+import numpy as np
+
+from scripts.geometry import cumulative_distances, project_onto_shape
+from scripts.trip_builder import (HEADWAY_TOLERANCE, SECONDS_PER_DAY, build_route_fragment, compact_headways,
+                                  interpolate_stop_times, stop_fractions)
+
+
+def test_stop_fractions_of_no_stop_or_a_single_stop():
+    assert stop_fractions(np.array([])).tolist() == []
+    assert stop_fractions(np.array([2.5])).tolist() == [0.0]
+
+
+def test_stop_fractions_follow_the_distance_along_the_shape():
+    assert stop_fractions(np.array([1.0, 2.0, 4.0, 5.0])).tolist() == [0.0, 0.25, 0.75, 1.0]
+
+
+# Stops that do not spread out along the shape, as on a zero-length one, are spaced evenly instead
+def test_stop_fractions_without_distance_between_the_ends():
+    assert stop_fractions(np.array([3.0, 3.0, 3.0])).tolist() == [0.0, 0.5, 1.0]
+    assert stop_fractions(np.zeros(5)).tolist() == [0.0, 0.25, 0.5, 0.75, 1.0]
+
+
+def test_interpolate_stop_times_matches_a_trip_by_trip_interpolation():
+    starts, ends = [6 * 3600, 7 * 3600 + 30], [6 * 3600 + 3000, 8 * 3600 + 1]
+    fractions = np.array([0.0, 0.1, 0.333, 1.0])
+    seconds = interpolate_stop_times(starts, ends, fractions)
+    assert seconds.shape == (2, 4)
+    for row, start, end in zip(seconds, starts, ends):
+        assert row.tolist() == [round(start + (end - start) * fraction) for fraction in fractions]
+
+
+def test_interpolate_stop_times_of_a_single_stop_and_of_a_trip_without_duration():
+    assert interpolate_stop_times([3600], [3900], np.array([0.0])).tolist() == [[3600]]
+    assert interpolate_stop_times([3600], [3600], np.array([0.0, 0.5, 1.0])).tolist() == [[3600, 3600, 3600]]
+
+
+# A trip ending before it starts runs past midnight, into times beyond 24:00:00
+def test_interpolate_stop_times_past_midnight():
+    seconds = interpolate_stop_times([23 * 3600 + 1800], [1200], np.array([0.0, 0.5, 1.0]))
+    assert seconds.tolist() == [[23 * 3600 + 1800, 23 * 3600 + 3300, SECONDS_PER_DAY + 1200]]
+
+
+def test_project_onto_a_zero_length_shape():
+    assert project_onto_shape([12.9, 12.9], [77.5, 77.5], [12.9, 12.91], [77.5, 77.51]).tolist() == [0.0, 0.0]
+    assert project_onto_shape([12.9], [77.5], [12.9, 12.91], [77.5, 77.51]).tolist() == [0.0, 0.0]
+
+
+def route(stop_points, shape_points, trips):
+    stops = [{"stationid": 100 + index, "centerlat": lat, "centerlong": lon}
+             for index, (lat, lon) in enumerate(stop_points)]
+    timetable = {"data": [{"tostationname": "B", "tripdetails": [{"starttime": start, "endtime": end}
+                                                                 for start, end in trips]}]}
+    inputs = {"stop_ids": [str(stop["stationid"]) for stop in stops],
+              "stop_lats": [stop["centerlat"] for stop in stops], "stop_lons": [stop["centerlong"] for stop in stops],
+              "shape_id": "S", "shape_lats": [lat for lat, _ in shape_points],
+              "shape_lons": [lon for _, lon in shape_points], "timetables": [((0, 1, 2, 3, 4), timetable)]}
+    return "R", "1", {"UP": inputs}
+
+
+def test_fragment_on_a_zero_length_shape_spaces_stops_evenly():
+    fragment = build_route_fragment(route([(12.9, 77.5), (12.91, 77.5), (12.92, 77.5)],
+                                          [(12.9, 77.5), (12.9, 77.5)], [("06:00", "06:30")]))
+    assert not fragment["errors"]
+    assert fragment["stop_times"]["arrival_time"] == ["06:00:00", "06:15:00", "06:30:00"]
+    assert fragment["stop_times"]["shape_dist_traveled"] == [0.0, 0.0, 0.0]
+
+
+def test_fragment_of_a_single_stop_route():
+    fragment = build_route_fragment(route([(12.9, 77.5)], [(12.9, 77.5), (12.91, 77.5)],
+                                          [("06:00", "06:30"), ("23:50", "00:10")]))
+    assert not fragment["errors"]
+    assert fragment["stop_times"]["arrival_time"] == ["06:00:00", "23:50:00"]
+    assert fragment["stop_times"]["stop_sequence"] == [1, 1]
+    assert fragment["trips"]["duration"] == [0, 0]
+
+
+# Every departure of a fragment as (direction, shape, days, headsign, stop times in seconds), with each frequency
+# expanded into the trips it stands for
+def departures(fragment):
+    trips, stop_times = fragment["trips"], fragment["stop_times"]
+    times = {}
+    for index, arrival_time in zip(stop_times["trip_index"], stop_times["arrival_time"]):
+        hours, minutes, seconds = map(int, arrival_time.split(':'))
+        times.setdefault(index, []).append(hours * 3600 + minutes * 60 + seconds)
+    starts = {index: [times[index][0]] for index in times}
+    frequencies = fragment.get("frequencies") or {"trip_index": []}
+    for position, index in enumerate(frequencies["trip_index"]):
+        starts[index] = list(range(frequencies["start_time"][position], frequencies["end_time"][position],
+                                   frequencies["headway_secs"][position]))
+    return sorted((trips["direction_id"][index], trips["shape_id"][index], trips["days"][index],
+                   trips["trip_headsign"][index], tuple(time - times[index][0] + start for time in times[index]))
+                  for index in times for start in starts[index])
+
+
+def timetable_fragment(start_minutes):
+    trips = [(f"{minutes // 60:02d}:{minutes % 60:02d}", f"{(minutes + 45) // 60:02d}:{(minutes + 45) % 60:02d}")
+             for minutes in start_minutes]
+    return build_route_fragment(route([(12.9, 77.5), (12.91, 77.5), (12.92, 77.5)],
+                                      [(12.9, 77.5), (12.92, 77.5)], trips))
+
+
+# Runs at an exact headway, with a trip off the headway between them, expand back into exactly the same departures
+def test_compact_headways_round_trips_exact_runs():
+    fragment = timetable_fragment([360, 375, 390, 405, 420, 433, 480, 500, 520, 540, 560])
+    compacted = compact_headways(fragment)
+    assert compacted["frequencies"]["exact_times"] == [1, 1]
+    assert len(compacted["trips"]["route_id"]) == 3
+    assert departures(compacted) == departures(fragment)
+
+
+# A run whose gaps drift within the tolerance keeps its number of departures, each close to the original one
+def test_compact_headways_keeps_the_departures_of_inexact_runs():
+    fragment = timetable_fragment(np.cumsum([360, 10, 11, 11, 11, 11, 10, 10]).tolist())
+    compacted = compact_headways(fragment, tolerance=HEADWAY_TOLERANCE)
+    assert compacted["frequencies"]["exact_times"] == [0]
+    expanded, original = departures(compacted), departures(fragment)
+    assert len(expanded) == len(original)
+    for (*key, times), (*original_key, original_times) in zip(expanded, original):
+        assert key == original_key
+        drift = max(abs(time - original_time) for time, original_time in zip(times, original_times))
+        assert drift <= 2 * HEADWAY_TOLERANCE
+
+
+# On a loop the last stop is beside the first one, yet it is reached at the end of the shape, not back at its start
+def test_project_onto_a_loop():
+    shape_lats, shape_lons = [12.9, 12.9, 12.91, 12.91, 12.9], [77.5, 77.51, 77.51, 77.5, 77.5]
+    distances = project_onto_shape(shape_lats, shape_lons, [12.9, 12.9, 12.91, 12.89995],
+                                   [77.5001, 77.51, 77.505, 77.50005])
+    assert np.all(np.diff(distances) > 0)
+    assert np.isclose(distances[-1], cumulative_distances(shape_lats, shape_lons)[-1])
+
+
+# A road driven out and back passes each stop twice: stops on the way out take the first pass, on the way back the
+# second
+def test_project_onto_an_out_and_back_shape():
+    shape_lats, shape_lons = [12.9, 12.9, 12.9], [77.5, 77.52, 77.5]
+    distances = project_onto_shape(shape_lats, shape_lons, [12.9] * 4, [77.505, 77.515, 77.512, 77.503])
+    along = [cumulative_distances([12.9, 12.9], [77.5, lon])[-1] for lon in (77.505, 77.515, 77.512, 77.503)]
+    total = cumulative_distances(shape_lats, shape_lons)[-1]
+    assert np.allclose(distances, [along[0], along[1], total - along[2], total - along[3]])